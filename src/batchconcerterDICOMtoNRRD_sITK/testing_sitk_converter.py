@@ -4,6 +4,7 @@ Created on Fri Nov 06 14:38:31 2015
 
 @author: Vivek Narayan
 """
+from __future__ import print_function
 
 import SimpleITK as sitk
 import collections
@@ -12,8 +13,26 @@ import os
 import fnmatch
 import csv
 import glob
+import argparse
+import multiprocessing
+import sys
 
-# order dicom files in seriesinstanceuid by sopinstanceuid.split('.')[-1]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'batchconverterDICOMtoNRRD_3DSlicer'))
+from batchConverterTools.ArchiveReader import isArchive, getPatientDirName
+from batchConverterTools.FileDiscovery import discoveryThreads, discoverDicomFilesList, DiscoveredFiles, addDiscoveryArguments, getDiscoverySettings
+from batchConverterTools.ScanIndex import ScanIndex
+from batchConverterTools.MetadataExtractor import getQueryPatientFiles, getPatientMemoryEstimates
+from batchConverterTools.MetadataStore import addMetadataStoreArguments, getMetadataStoreSettings
+from batchConverterTools.MemoryAdmission import addMemoryBudgetArguments, getMemoryBudgetSettings, getUnknownEstimate, getLargestFirst, admitImapUnordered
+from batchConverterTools.SeriesGrouping import groupDicomSeries
+from batchConverterTools.SeriesGeometry import checkSeriesGeometry
+from batchConverterTools.VolumeAssembly import assembleVolume, narrowImage, readSeriesImage
+from batchConverterTools.OutputCompression import compressionModes_list, compressOutputFile, getCompressionLogLine, getWriterCompression
+from batchConverterTools.RunLog import RunLog
+from batchConverterTools.ConversionManifest import ConversionManifest, getInputFingerprint, getManifestEntry, getNodeManifestFileName
+from batchConverterTools.SeriesDedup import SeriesContentIndex, getDuplicateOutputs, getNodeContentIndexFileName, addDedupArguments, getDedupSettings
+from batchConverterTools.PrefetchPipeline import ByteBudget, SeriesPrefetcher, OutputWriter, PendingOutput, addPipelineArguments, getPipelineSettings
+from batchConverterTools.WorkQueue import addWorkQueueArguments, getWorkQueueSettings, isDistributed, getNodeWorkItems, boundedImapUnordered
 
 def setHeaderTagsToNamesDict():
     headerTagsNames_dict = collections.OrderedDict()
@@ -23,85 +42,340 @@ def setHeaderTagsToNamesDict():
     return headerTagsNames_dict
 
 headerTagsNames_dict = setHeaderTagsToNamesDict()
-    
-dirin = ""
-dirout = ""
 
-logfp = os.path.join(dirout, 'logfile.txt')
+# Manifest of a previous run, loaded once per worker process when resuming
+resumeManifest = None
+# Content index of the output directory, loaded once per worker process with dedup
+contentIndex = None
 
-dcmReader = sitk.ImageSeriesReader()
-nrrdWriter = sitk.ImageFileWriter()
 
-patientDirs = glob.glob(os.path.join(dirin,'*'))
-for ind, patientDir in enumerate(patientDirs):
-    dicomFiles_list = []
-    for r,d,f in os.walk(patientDir):
-        if True#'CT' in r:
-          [dicomFiles_list.append(str(os.path.join(r,fle))) for fle in f if '._' not in fle] #fnmatch.filter(f,'*.dcm')]
-        
-    dicomSeriesFileList_Dict = {}
-    for dicomFile in dicomFiles_list:
-        dicomFileHeader = dicom.read_file(dicomFile, force=True)
-        try:
-          seriesInstanceUID = str(dicomFileHeader[2097166].value)
-        except KeyError:
-          continue
-        
-        dicomFileDict = {tag:str(element.value) for (tag,element) in dicomFileHeader.iteritems() if '\x00' not in str(element.value)}
-        dicomFileDict = collections.OrderedDict(sorted(dicomFileDict.items(), key=lambda t: t[0]))
-        dicomFileDict['Filepath'] = str(dicomFile)   
-        if dicomFileDict[524384] == 'RTSTRUCT': continue
-        else:  
-            if seriesInstanceUID in reversed(dicomSeriesFileList_Dict.keys()):
-                dicomSeriesFileList_Dict[seriesInstanceUID].append(dicomFileDict)
-            else: 
-                dicomSeriesFileList_Dict[seriesInstanceUID] = []
-                dicomSeriesFileList_Dict[seriesInstanceUID].append(dicomFileDict)
+def getImageBytes(image):
+    # Memory held by a decoded volume; 0 for volumes memmap assembly wrote straight to disk
+    if image is None: return 0
+    return sitk.GetArrayViewFromImage(image).nbytes
 
-    for series in dicomSeriesFileList_Dict:
-        with open(logfp, 'a') as logfile:
-            logfile.write('Converting Series: ' + series + ' from Patient: ' + os.path.basename(patientDir))
-        patientID = os.path.basename(patientDir)
-        outputPatientDir = os.path.join(dirout, patientID)
-        if not os.path.exists(outputPatientDir): os.mkdir(outputPatientDir)
+
+def getPatientDicomFiles(patientDir, threads=discoveryThreads):
+    # DICOM files of a patient directory or patient archive; archives inside the directory are read in place
+    return [str(dicomFile) for dicomFile in discoverDicomFilesList(patientDir, threads)]
+
+
+def convertPatient(patientDir, dirout, converterSettings, runLog, selectedFiles=None):
+    # Converts every series of a single patient directory, or those of selectedFiles in it. Log events go to runLog;
+    # manifest and content index entries are returned instead of written, so that parallel workers never share the
+    # log or the manifest
+    manifestEntries_dict = {}
+    contentEntries_dict = {}
+    dcmReader = sitk.ImageSeriesReader()
+    nrrdWriter = sitk.ImageFileWriter()
+    patientID = getPatientDirName(patientDir)
+
+    # The discovery threads walk the patient directory while the files they found are scanned
+    discoveredFiles = DiscoveredFiles(patientDir, converterSettings['discoverythreads'], selectedFiles=selectedFiles)
+    scanIndex = None
+    if converterSettings['scanindex'] is not None:
+        scanIndex = ScanIndex(converterSettings['scanindex'])
+        scanIndex.preload(patientDir)
+    try:
+        # Reads the headers and groups the files by SeriesInstanceUID
+        with runLog.stage('scan', patient=patientID) as stageEvent:
+            dicomSeriesFileList_Dict = groupDicomSeries(discoveredFiles, scanMode=converterSettings['scanmode'], scanIndex=scanIndex)
+            stageEvent['numberseries'] = len(dicomSeriesFileList_Dict)
+            stageEvent['files'] = len(discoveredFiles.dicomFiles_list)
+            stageEvent['bytes'] = discoveredFiles.numberBytes
+    finally:
+        if scanIndex is not None: scanIndex.close()
+
+    def saveVolume(series, outpath, dcmImage, fps):
+        # Writes a volume decoded by the reader (memmap assembly has written it already) and compresses it;
+        # runs on the writer thread when pipelined
+        isWriterCompressed = False
+        if dcmImage is not None:
+            outpath, isWriterCompressed = getWriterCompression(outpath, converterSettings['compression'])
+            with runLog.stage('save', patient=patientID, series=series):
+                nrrdWriter.SetFileName(outpath)
+                nrrdWriter.SetUseCompression(isWriterCompressed)
+                nrrdWriter.Execute(dcmImage)
+        runLog.message('Converted Volume: ' + outpath, patient=patientID, series=series, files=fps)
+        # The writer compresses gzip volumes itself; parallelgzip and memmap-assembled volumes are written raw
+        # and compressed afterwards
+        if converterSettings['compression'] != 'raw' and not isWriterCompressed:
+            with runLog.stage('compress', patient=patientID, series=series):
+                outpath, compressionStatistics_dict = compressOutputFile(outpath, converterSettings['compression'], converterSettings['compressionlevel'], converterSettings['compressionthreads'])
+            runLog.message(getCompressionLogLine(outpath, compressionStatistics_dict), patient=patientID, series=series, **compressionStatistics_dict)
+        return outpath
+
+    # Pipelined, the files of the next series are read ahead while one is decoded and the decoded volumes
+    # are written by a background thread; read-ahead files and queued volumes share the memory cap
+    pipelineBudget = ByteBudget(converterSettings['pipelinememory'])
+    prefetcher = None
+    if converterSettings['prefetchdepth'] > 0:
+        prefetcher = SeriesPrefetcher([(series, [dicomFileDict['Filepath'] for dicomFileDict in dicomSeriesFileList_Dict[series]]) for series in dicomSeriesFileList_Dict],
+                                      converterSettings['prefetchdepth'], pipelineBudget, converterSettings['prefetchthreads']).start()
+    outputWriter = OutputWriter(converterSettings['writedepth'], pipelineBudget) if converterSettings['writedepth'] > 0 else None
+    # (series, fingerprint, [(output path or PendingOutput, content fingerprint)]) of the series read without error
+    seriesOutputs_list = []
+    try:
+        for series in dicomSeriesFileList_Dict:
+            if prefetcher is not None: prefetcher.consume(series)
+            fingerprint = getInputFingerprint([dicomFileDict['Filepath'] for dicomFileDict in dicomSeriesFileList_Dict[series]])
+            if resumeManifest is not None and resumeManifest.isComplete(series, fingerprint):
+                runLog.message('Skipping Series: ' + series + ' from Patient: ' + patientID + ' (already converted)', patient=patientID, series=series)
+                continue
+            runLog.message('Converting Series: ' + series + ' from Patient: ' + patientID, patient=patientID, series=series)
+            outputPatientDir = os.path.join(dirout, patientID)
+            if not os.path.exists(outputPatientDir): os.mkdir(outputPatientDir)
         
-        try:
-            studyDate = dicomSeriesFileList_Dict[series][0][524320]
-        except KeyError:
-            studyDate = 'UnknownStudy'
-        finally:
-            studyDate = ''.join(x for x in studyDate if x not in "-',;\/:*?<>|").strip()
-            if studyDate == '': studyDate = 'UnknownStudy'             
-            outputStudyDir = os.path.join(outputPatientDir, studyDate)
-            if not os.path.exists(outputStudyDir): os.mkdir(outputStudyDir)
+            try:
+                studyDate = dicomSeriesFileList_Dict[series][0][524320]
+            except KeyError:
+                studyDate = 'UnknownStudy'
+            finally:
+                studyDate = ''.join(x for x in studyDate if x not in "-',;\/:*?<>|").strip()
+                if studyDate == '': studyDate = 'UnknownStudy'             
+                outputStudyDir = os.path.join(outputPatientDir, studyDate)
+                if not os.path.exists(outputStudyDir): os.mkdir(outputStudyDir)
           
-        outputReconstructionsDir = os.path.join(outputStudyDir, 'Reconstructions')
-        outputSegmentationsDir = os.path.join(outputStudyDir, 'Segmentations')
-        outputResourcesDir = os.path.join(outputStudyDir, 'Resources')
-        if not os.path.exists(outputReconstructionsDir): os.mkdir(outputReconstructionsDir)
-        if not os.path.exists(outputSegmentationsDir): os.mkdir(outputSegmentationsDir) 
-        if not os.path.exists(outputResourcesDir): os.mkdir(outputResourcesDir)
+            outputReconstructionsDir = os.path.join(outputStudyDir, 'Reconstructions')
+            outputSegmentationsDir = os.path.join(outputStudyDir, 'Segmentations')
+            outputResourcesDir = os.path.join(outputStudyDir, 'Resources')
+            if not os.path.exists(outputReconstructionsDir): os.mkdir(outputReconstructionsDir)
+            if not os.path.exists(outputSegmentationsDir): os.mkdir(outputSegmentationsDir) 
+            if not os.path.exists(outputResourcesDir): os.mkdir(outputResourcesDir)
           
-        try: 
-            seriesDescription = dicomSeriesFileList_Dict[series][0][528432]
-        except KeyError:
-            seriesDescription = patientID + '_' + studyDate + '_' + 'CT'
-        finally:  
-            seriesDescription = ''.join(x for x in seriesDescription if x not in "-',;\/:*?<>|").strip()
-            outputFilename = str(seriesDescription + '.nrrd')
+            try: 
+                seriesDescription = dicomSeriesFileList_Dict[series][0][528432]
+            except KeyError:
+                seriesDescription = patientID + '_' + studyDate + '_' + 'CT'
+            finally:  
+                seriesDescription = ''.join(x for x in seriesDescription if x not in "-',;\/:*?<>|").strip()
+                outputFilename = str(seriesDescription + '.nrrd')
+        
+            # Order the slices from the scanned headers and split or reject series with inconsistent geometry
+            # before any pixel data is read
+            with runLog.stage('group', patient=patientID, series=series):
+                seriesVolumes, geometryMessages = checkSeriesGeometry(dicomSeriesFileList_Dict[series], converterSettings['geometrypolicy'])
+            for message in geometryMessages: runLog.message('GEOMETRY: ' + message, patient=patientID, series=series)
+            if not seriesVolumes:
+                runLog.message('GEOMETRYERROR: Series rejected: ' + series, patient=patientID, series=series)
+                manifestEntries_dict[series] = getManifestEntry(fingerprint, [], 'rejected')
+                continue
         
-        fps = []
-        dirp = os.path.dirname(dicomSeriesFileList_Dict[series][0]['Filepath'])
-        fps = glob.glob(os.path.join(dirp,'*'))
-        dcmReader.SetFileNames(fps)
-        dcmImage = dcmReader.Execute()
-        with open(logfp, 'a') as logfile:
-            [logfile.write('\t' + fp +'\n') for fp in fps]
-        #if file naming schema is like CT.rtp1.1.surv_43062.1.T.-7.4.CT.dcm --- take last two numbers as slice positions (i.e. -7.4mm) and re arrange filepaths list accordingly    
-        outpath = os.path.join(outputReconstructionsDir, outputFilename)
-        nrrdWriter.SetFileName(outpath)
-        nrrdWriter.Execute(dcmImage)
-        print 'Converted:', patientID, '------', ind+1, 'out of', len(patientDirs)
+            outputs = []
+            try:
+                for volumeIndex, volumeFileDict_list in enumerate(seriesVolumes):
+                    # Read exactly the files of this series; other series or RTSTRUCTs stored in the same directory are not touched
+                    fps = [dicomFileDict['Filepath'] for dicomFileDict in volumeFileDict_list]
+                    if len(seriesVolumes) > 1: outpath = os.path.join(outputReconstructionsDir, seriesDescription + '_' + str(volumeIndex + 1) + '.nrrd')
+                    else: outpath = os.path.join(outputReconstructionsDir, outputFilename)
+                    # Volumes whose content was converted before, e.g. from another patient directory, are referenced or linked
+                    contentFingerprint = None
+                    if contentIndex is not None:
+                        with runLog.stage('dedup', patient=patientID, series=series):
+                            duplicatePaths, contentFingerprint = getDuplicateOutputs(contentIndex, series, volumeFileDict_list, outputReconstructionsDir,
+                                                                                     converterSettings['dedup'], converterSettings['deduppixeldigest'])
+                        if duplicatePaths is not None:
+                            runLog.message('Duplicate Volume: ' + ', '.join(duplicatePaths) + ' (' + converterSettings['dedup'] + ')', patient=patientID, series=series)
+                            outputs.extend((duplicatePath, None) for duplicatePath in duplicatePaths)
+                            continue
+                    # memmap assembly reads the slices and writes them straight into the output file, so it is timed as one read stage;
+                    # anything it does not handle goes through the reader
+                    with runLog.stage('read', patient=patientID, series=series, files=len(fps)) as stageEvent:
+                        stageEvent['assembly'] = 'sitk'
+                        dcmImage = None
+                        if converterSettings['assembly'] == 'memmap' and assembleVolume(volumeFileDict_list, outpath):
+                            stageEvent['assembly'] = 'memmap'
+                        else:
+                            dcmImage = narrowImage(readSeriesImage(dcmReader, volumeFileDict_list))
+                    if outputWriter is not None:
+                        outputs.append((outputWriter.submit(saveVolume, (series, outpath, dcmImage, fps), getImageBytes(dcmImage)), contentFingerprint))
+                    else:
+                        outputs.append((saveVolume(series, outpath, dcmImage, fps), contentFingerprint))
+                    dcmImage = None
+            except Exception as e:
+                runLog.message('CONVERSIONERROR: Series: ' + series + ': ' + str(e), patient=patientID, series=series)
+                manifestEntries_dict[series] = getManifestEntry(fingerprint, [output for output, contentFingerprint in outputs if not isinstance(output, PendingOutput)], 'failed')
+                continue
+            seriesOutputs_list.append((series, fingerprint, outputs))
+    finally:
+        if prefetcher is not None: prefetcher.stop()
+        if outputWriter is not None: outputWriter.close()
+
+    for series, fingerprint, outputs in seriesOutputs_list:
+        outpaths = []
+        try:
+            for output, contentFingerprint in outputs:
+                outpath = output.result() if isinstance(output, PendingOutput) else output
+                outpaths.append(outpath)
+                if contentFingerprint is not None:
+                    contentIndex.record(contentFingerprint, series, [outpath])
+                    contentEntries_dict[contentFingerprint] = contentIndex.contentEntries_dict[contentFingerprint]
+        except Exception as e:
+            runLog.message('CONVERSIONERROR: Series: ' + series + ': ' + str(e), patient=patientID, series=series)
+            manifestEntries_dict[series] = getManifestEntry(fingerprint, outpaths, 'failed')
+            continue
+        manifestEntries_dict[series] = getManifestEntry(fingerprint, outpaths, 'complete')
+    return manifestEntries_dict, contentEntries_dict
+
+
+def initWorker(numberOfThreads, manifestDir=None, contentIndexDir=None):
+    # Cap the ITK thread pool of each worker process so that processes x threads
+    # does not oversubscribe the node
+    global resumeManifest, contentIndex
+    if numberOfThreads is not None: sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(numberOfThreads)
+    if manifestDir is not None: resumeManifest = ConversionManifest(manifestDir)
+    if contentIndexDir is not None: contentIndex = SeriesContentIndex(contentIndexDir)
+
+
+def convertPatientTask(task):
+    # The events of each patient are collected in memory and returned to the parent, which owns the log file
+    patientDir, dirout, converterSettings, selectedFiles = task
+    runLog = RunLog()
+    succeeded = True
+    try:
+        manifestEntries_dict, contentEntries_dict = convertPatient(patientDir, dirout, converterSettings, runLog, selectedFiles)
+    except Exception as e:
+        runLog.message('CONVERSIONERROR: ' + getPatientDirName(patientDir) + ': ' + str(e), patient=getPatientDirName(patientDir))
+        manifestEntries_dict, contentEntries_dict = {}, {}
+        succeeded = False
+    return patientDir, succeeded, runLog.events, manifestEntries_dict, contentEntries_dict
+
+
+def getFailedTaskResult(task, message):
+    # Result of a patient whose task raised outside convertPatient or whose worker process died, so that it is
+    # logged and its claim released like a patient that failed
+    patientDir = task[0]
+    runLog = RunLog()
+    runLog.message('CONVERSIONERROR: ' + getPatientDirName(patientDir) + ': ' + message, patient=getPatientDirName(patientDir))
+    return patientDir, False, runLog.events, {}, {}
+
+
+def batchConvert(dirin, dirout, converterSettings):
+    logfp = os.path.join(dirout, 'logfile.jsonl')
+    # A patient entry is a directory or a zip or tar archive of one
+    patientDirs = [patientDir for patientDir in glob.glob(os.path.join(dirin,'*')) if os.path.isdir(patientDir) or isArchive(patientDir)]
+
+    # Only the parent process writes the manifest; it is saved after every patient so an
+    # interrupted run loses at most the patients that were in progress
+    manifest = ConversionManifest(dirout)
+    manifestDir = dirout if converterSettings['resume'] else None
+    outputContentIndex = SeriesContentIndex(dirout) if converterSettings['dedup'] != 'off' else None
+    contentIndexDir = dirout if outputContentIndex is not None else None
+
+    # On several nodes sharing dirin and dirout, each node converts its shard of the patient directories
+    # and/or the directories it claims, and writes its own log and manifest
+    patientDirs, workQueue = getNodeWorkItems(patientDirs, converterSettings)
+    if isDistributed(converterSettings):
+        logfp = os.path.join(dirout, 'logfile_' + converterSettings['nodename'] + '.jsonl')
+        manifest = ConversionManifest(dirout, getNodeManifestFileName(converterSettings['nodename']))
+        if outputContentIndex is not None: outputContentIndex = SeriesContentIndex(dirout, getNodeContentIndexFileName(converterSettings['nodename']))
+
+    processes = converterSettings['processes']
+    threadsPerProcess = converterSettings['threadsperprocess']
+    if processes > 1:
+        if threadsPerProcess is None:
+            threadsPerProcess = max(1, multiprocessing.cpu_count() // processes)
+        if converterSettings['compressionthreads'] is None:
+            converterSettings = dict(converterSettings, compressionthreads=threadsPerProcess)
+    runLog = RunLog(logfp)
+    # With a series query only the files of the matching series are scanned; the metadata store lists them
+    queryPatientFiles_Dict = {}
+    if converterSettings['seriesquery']:
+        queryPatientFiles_Dict = getQueryPatientFiles(dirin, converterSettings, runLog=runLog)
+        patientDirs = [patientDir for patientDir in patientDirs if patientDir in queryPatientFiles_Dict]
+    tasks = [(patientDir, dirout, converterSettings, queryPatientFiles_Dict.get(patientDir)) for patientDir in patientDirs]
+    memoryBudget = converterSettings['memorybudget'] if processes > 1 else 0
+    if memoryBudget > 0:
+        # Patients are started largest first, and only while their estimated peak memory fits in the budget
+        patientEstimates_dict = getPatientMemoryEstimates(dirin, converterSettings, runLog)
+        unknownEstimate = getUnknownEstimate(patientEstimates_dict, memoryBudget)
+        numberUnknown = sum(1 for task in tasks if task[0] not in patientEstimates_dict)
+        if numberUnknown: runLog.message('ESTIMATE: No memory estimate for ' + str(numberUnknown) + ' patients, each counted as ' + '%.0f MB' % (unknownEstimate / float(1 << 20)))
+        getTaskBytes = lambda task: patientEstimates_dict.get(task[0], unknownEstimate)
+        tasks = getLargestFirst(tasks, getTaskBytes)
+    if workQueue is not None:
+        # Claimed one at a time as workers become free
+        tasks = workQueue.claimItems(tasks, lambda task: task[0])
+        workQueue.start()
+    if processes <= 1:
+        initWorker(threadsPerProcess, manifestDir, contentIndexDir)
+        results = (convertPatientTask(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=initWorker, initargs=(threadsPerProcess, manifestDir, contentIndexDir))
+        if memoryBudget > 0: results = admitImapUnordered(pool, convertPatientTask, tasks, getTaskBytes, memoryBudget, processes, getFailedTaskResult)
+        elif workQueue is not None: results = boundedImapUnordered(pool, convertPatientTask, tasks, processes, getFailedTaskResult)
+        else: results = pool.imap_unordered(convertPatientTask, tasks)
+
+    try:
+        # Patients complete out of order in parallel mode; the events of each patient are
+        # written as one contiguous block and flushed together with the manifest
+        for ind, (patientDir, succeeded, events, manifestEntries_dict, contentEntries_dict) in enumerate(results):
+            runLog.addEvents(events)
+            runLog.flush()
+            manifest.update(manifestEntries_dict)
+            manifest.save()
+            if outputContentIndex is not None and contentEntries_dict:
+                outputContentIndex.update(contentEntries_dict)
+                outputContentIndex.save()
+            if workQueue is not None:
+                # A patient that failed as a whole is released rather than marked done, so another node retries it
+                if succeeded: workQueue.complete(patientDir)
+                else: workQueue.release(patientDir)
+            print('Converted:', getPatientDirName(patientDir), '------', ind+1, 'out of', len(patientDirs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if workQueue is not None: workQueue.stop()
+        summary_dict = runLog.close()
+
+    for stageName in sorted(summary_dict['stages']):
+        print('Stage:', stageName, '------', '%.2f s wall, %.2f s CPU' % (summary_dict['stages'][stageName]['wall'], summary_dict['stages'][stageName]['cpu']))
+    for slowest in summary_dict.get('slowestpatient', [])[:5]:
+        print('Slowest patient:', slowest['patient'], '------', '%.2f s' % slowest['wall'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch convert DICOM series to NRRD with SimpleITK')
+    parser.add_argument('dirin', help='Input directory containing one subdirectory per patient')
+    parser.add_argument('dirout', help='Output directory for the converted data hierarchy')
+    parser.add_argument('--processes', type=int, default=1, help='Number of patients converted in parallel (default: 1)')
+    parser.add_argument('--threads-per-process', type=int, default=None, help='SimpleITK threads per worker process (default: cores / processes)')
+    parser.add_argument('--scan-mode', choices=['header', 'full'], default='header', help='Read only the grouping tags of each file (header) or every complete file (full)')
+    parser.add_argument('--scan-index', default=None, help='SQLite scan index; files unchanged since the last run are not parsed again')
+    parser.add_argument('--resume', action='store_true', help='Skip series recorded as converted in the output manifest whose input files are unchanged')
+    parser.add_argument('--geometry-policy', choices=['split', 'reject'], default='split', help='Split series with repeated positions, gaps or mixed orientations into several volumes, or reject them')
+    parser.add_argument('--assembly', choices=['sitk', 'memmap'], default='sitk', help='Load whole series with ImageSeriesReader (sitk) or write slices one at a time into a memory-mapped NRRD (memmap)')
+    parser.add_argument('--compression', choices=compressionModes_list, default='raw', help='Write volumes uncompressed (raw), gzip compressed on one thread (gzip) or on several threads (parallelgzip)')
+    parser.add_argument('--compression-level', type=int, default=6, choices=range(1, 10), help='gzip compression level, 1 (fastest) to 9 (smallest), of parallelgzip and of memmap-assembled volumes; gzip volumes written by the image writer use its default level (default: 6)')
+    parser.add_argument('--compression-threads', type=int, default=None, help='Threads per process for parallelgzip (default: cores / processes)')
+    addDiscoveryArguments(parser)
+    addMetadataStoreArguments(parser)
+    addMemoryBudgetArguments(parser)
+    addDedupArguments(parser)
+    addPipelineArguments(parser)
+    addWorkQueueArguments(parser)
+    args = parser.parse_args()
+
+    converterSettings = {}
+    converterSettings['processes'] = args.processes
+    converterSettings['threadsperprocess'] = args.threads_per_process
+    converterSettings['scanmode'] = args.scan_mode
+    converterSettings['scanindex'] = args.scan_index
+    converterSettings['resume'] = args.resume
+    converterSettings['geometrypolicy'] = args.geometry_policy
+    converterSettings['assembly'] = args.assembly
+    converterSettings['compression'] = args.compression
+    converterSettings['compressionlevel'] = args.compression_level
+    converterSettings['compressionthreads'] = args.compression_threads
+    converterSettings.update(getDiscoverySettings(args))
+    converterSettings.update(getMetadataStoreSettings(args))
+    converterSettings.update(getMemoryBudgetSettings(args))
+    converterSettings.update(getDedupSettings(args))
+    converterSettings.update(getPipelineSettings(args))
+    converterSettings.update(getWorkQueueSettings(args))
+    batchConvert(args.dirin, args.dirout, converterSettings)
 
 """            
 dicomFiles_list = []
@@ -200,4 +474,8 @@ with open(outputCSVFile, 'wb') as csvf:
     writer = csv.writer(csvf)
     for row in dicomHeaderInformationTable:
         writer.writerow(row)         
-"""
\ No newline at end of file
+"""
+
+
+if __name__ == "__main__":
+    main()
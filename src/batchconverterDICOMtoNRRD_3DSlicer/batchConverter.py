@@ -48,6 +48,14 @@ class batchConverterWidget:
         self.converterSettings["inferpatientid"] = "metadata"
         self.converterSettings["centerimages"] = False
         self.converterSettings["centerlabels"] = False
+        self.converterSettings["resume"] = False
+        self.converterSettings["dryrun"] = False
+        self.converterSettings["dedup"] = "off"
+        self.converterSettings["deduppixeldigest"] = False
+        self.converterSettings["segmentationformat"] = "perfile"
+        self.converterSettings["compression"] = "gzip"
+        self.converterSettings["compressionlevel"] = 6
+        self.converterSettings["compressionthreads"] = None
         
     def setup(self):    
         #---------------------------------------------------------
@@ -132,6 +140,49 @@ class batchConverterWidget:
         self.fileFormatSelectFrame.layout().addRow(self.nrrdButton, self.niftiButton)        
         self.settingsCollapsibleButton.layout().addRow(self.fileFormatLabel, self.fileFormatSelectFrame)
         
+        # Raw, gzip or parallel gzip output
+        self.compressionLabel = qt.QLabel("Output Compression:  ", self.settingsCollapsibleButton)
+        self.compressionLabel.toolTip = "Write uncompressed files (fastest), or gzip compress them on one or on all processor cores at the selected level"
+        
+        self.compressionSelectFrame = qt.QFrame(self.settingsCollapsibleButton)
+        self.compressionSelectFrame.setLayout(qt.QFormLayout())
+        self.compressionGroup = qt.QButtonGroup(self.compressionSelectFrame)
+        self.rawCompressionButton = qt.QRadioButton("Raw")
+        self.gzipCompressionButton = qt.QRadioButton("Gzip")
+        self.gzipCompressionButton.checked = True
+        self.parallelGzipCompressionButton = qt.QRadioButton("Parallel Gzip")
+        self.compressionGroup.addButton(self.rawCompressionButton)
+        self.compressionGroup.addButton(self.gzipCompressionButton)
+        self.compressionGroup.addButton(self.parallelGzipCompressionButton)
+        self.compressionLevelSpinBox = qt.QSpinBox()
+        self.compressionLevelSpinBox.minimum = 1
+        self.compressionLevelSpinBox.maximum = 9
+        self.compressionLevelSpinBox.value = 6
+        self.compressionLevelSpinBox.toolTip = "gzip compression level, 1 (fastest) to 9 (smallest)"
+        self.compressionSelectFrame.layout().addRow(self.rawCompressionButton, self.gzipCompressionButton)
+        self.compressionSelectFrame.layout().addRow(self.parallelGzipCompressionButton, self.compressionLevelSpinBox)
+        self.settingsCollapsibleButton.layout().addRow(self.compressionLabel, self.compressionSelectFrame)
+        
+        # One label map file per contour, or all contours of a study in one file, or cropped label maps
+        self.segmentationFormatLabel = qt.QLabel("Segmentation Output:  ", self.settingsCollapsibleButton)
+        self.segmentationFormatLabel.toolTip = "Save one full-size label map per contour, all contours of a study in one multi-label or bit-packed file, or each contour cropped to its bounding box"
+        
+        self.segmentationFormatSelectFrame = qt.QFrame(self.settingsCollapsibleButton)
+        self.segmentationFormatSelectFrame.setLayout(qt.QFormLayout())
+        self.segmentationFormatGroup = qt.QButtonGroup(self.segmentationFormatSelectFrame)
+        self.perFileSegmentationButton = qt.QRadioButton("Per Contour")
+        self.perFileSegmentationButton.checked = True
+        self.multiLabelSegmentationButton = qt.QRadioButton("Multi-label")
+        self.bitPackedSegmentationButton = qt.QRadioButton("Bit-packed")
+        self.croppedSegmentationButton = qt.QRadioButton("Cropped")
+        self.segmentationFormatGroup.addButton(self.perFileSegmentationButton)
+        self.segmentationFormatGroup.addButton(self.multiLabelSegmentationButton)
+        self.segmentationFormatGroup.addButton(self.bitPackedSegmentationButton)
+        self.segmentationFormatGroup.addButton(self.croppedSegmentationButton)
+        self.segmentationFormatSelectFrame.layout().addRow(self.perFileSegmentationButton, self.multiLabelSegmentationButton)
+        self.segmentationFormatSelectFrame.layout().addRow(self.bitPackedSegmentationButton, self.croppedSegmentationButton)
+        self.settingsCollapsibleButton.layout().addRow(self.segmentationFormatLabel, self.segmentationFormatSelectFrame)
+        
         # Use input DICOM Patient Directory names as PatientID or infer from DICOM Metadata
         self.patientIDLabel = qt.QLabel("Infer Patient IDs from:  ", self.settingsCollapsibleButton)
         self.patientIDLabel.toolTip = "Use input DICOM Patient Directory names as PatientID or infer from DICOM Metadata"
@@ -175,6 +226,54 @@ class batchConverterWidget:
         self.centerLabelsSelectFrame.layout().addRow(self.centerLabelsButton, self.noCenterLabelsButton)        
         self.settingsCollapsibleButton.layout().addRow(self.centerLabelsLabel, self.centerLabelsSelectFrame)
         
+        # Resume option
+        self.resumeLabel = qt.QLabel("Resume Previous Run:  ", self.settingsCollapsibleButton)
+        self.resumeLabel.toolTip = "Skip studies recorded as converted in the output directory's ConversionManifest.json whose DICOM files are unchanged"
+        
+        self.resumeSelectFrame = qt.QFrame(self.settingsCollapsibleButton)
+        self.resumeSelectFrame.setLayout(qt.QFormLayout())
+        self.resumeGroup = qt.QButtonGroup(self.resumeSelectFrame)
+        self.resumeButton = qt.QRadioButton("Yes")
+        self.noResumeButton = qt.QRadioButton("No")
+        self.noResumeButton.checked = True
+        self.resumeGroup.addButton(self.resumeButton)
+        self.resumeGroup.addButton(self.noResumeButton)
+        self.resumeSelectFrame.layout().addRow(self.resumeButton, self.noResumeButton)        
+        self.settingsCollapsibleButton.layout().addRow(self.resumeLabel, self.resumeSelectFrame)
+        
+        # Dry run option
+        self.dryRunLabel = qt.QLabel("Contour Filter Dry Run:  ", self.settingsCollapsibleButton)
+        self.dryRunLabel.toolTip = "Only write ROIFilterReport.csv to the output directory, listing the ROIs of every patient that match the contour filters"
+        
+        self.dryRunSelectFrame = qt.QFrame(self.settingsCollapsibleButton)
+        self.dryRunSelectFrame.setLayout(qt.QFormLayout())
+        self.dryRunGroup = qt.QButtonGroup(self.dryRunSelectFrame)
+        self.dryRunButton = qt.QRadioButton("Yes")
+        self.noDryRunButton = qt.QRadioButton("No")
+        self.noDryRunButton.checked = True
+        self.dryRunGroup.addButton(self.dryRunButton)
+        self.dryRunGroup.addButton(self.noDryRunButton)
+        self.dryRunSelectFrame.layout().addRow(self.dryRunButton, self.noDryRunButton)        
+        self.settingsCollapsibleButton.layout().addRow(self.dryRunLabel, self.dryRunSelectFrame)
+        
+        # Studies whose series were all converted before, e.g. from another patient directory, are not converted again
+        self.dedupLabel = qt.QLabel("Duplicate Studies:  ", self.settingsCollapsibleButton)
+        self.dedupLabel.toolTip = "Convert every copy of a study, or link copies of studies converted before to their outputs"
+        
+        self.dedupSelectFrame = qt.QFrame(self.settingsCollapsibleButton)
+        self.dedupSelectFrame.setLayout(qt.QFormLayout())
+        self.dedupGroup = qt.QButtonGroup(self.dedupSelectFrame)
+        self.noDedupButton = qt.QRadioButton("Convert")
+        self.noDedupButton.checked = True
+        self.referenceDedupButton = qt.QRadioButton("Manifest Reference")
+        self.hardlinkDedupButton = qt.QRadioButton("Hard Link")
+        self.dedupGroup.addButton(self.noDedupButton)
+        self.dedupGroup.addButton(self.referenceDedupButton)
+        self.dedupGroup.addButton(self.hardlinkDedupButton)
+        self.dedupSelectFrame.layout().addRow(self.noDedupButton, self.referenceDedupButton)
+        self.dedupSelectFrame.layout().addRow(self.hardlinkDedupButton)
+        self.settingsCollapsibleButton.layout().addRow(self.dedupLabel, self.dedupSelectFrame)
+        
         # Parse and Save DICOM Metadata to CSV
         self.metadataExtractLabel = qt.QLabel("DICOM Metadata Extraction", self.settingsCollapsibleButton)
         self.metadataExtractLabel.toolTip = "Extract and Save all DICOM Metadata to a CSV file"
@@ -185,10 +284,14 @@ class batchConverterWidget:
         self.extractCSVButton = qt.QRadioButton("CSV")
         self.extractCSVButton.checked = True
         #self.extractJSONButton = qt.QRadioButton("JSON")        
+        self.extractParquetButton = qt.QRadioButton("Parquet")
+        self.extractParquetButton.toolTip = "Requires pyarrow"
         self.doNotExtractButton = qt.QRadioButton("None")
         self.metadataExtractGroup.addButton(self.extractCSVButton)
+        self.metadataExtractGroup.addButton(self.extractParquetButton)
         self.metadataExtractGroup.addButton(self.doNotExtractButton)
-        self.metadataExtractSelectFrame.layout().addRow(self.extractCSVButton, self.doNotExtractButton)       
+        self.metadataExtractSelectFrame.layout().addRow(self.extractCSVButton, self.extractParquetButton)       
+        self.metadataExtractSelectFrame.layout().addRow(self.doNotExtractButton)       
         self.settingsCollapsibleButton.layout().addRow(self.metadataExtractLabel, self.metadataExtractSelectFrame)
                    
         # Apply Batch Convert button
@@ -240,6 +343,16 @@ class batchConverterWidget:
         if self.nrrdButton.checked: self.converterSettings["fileformat"] = ".nrrd"
         elif self.niftiButton.checked: self.converterSettings["fileformat"] = ".nii"
         
+        if self.rawCompressionButton.checked: self.converterSettings["compression"] = "raw"
+        elif self.gzipCompressionButton.checked: self.converterSettings["compression"] = "gzip"
+        elif self.parallelGzipCompressionButton.checked: self.converterSettings["compression"] = "parallelgzip"
+        self.converterSettings["compressionlevel"] = self.compressionLevelSpinBox.value
+        
+        if self.perFileSegmentationButton.checked: self.converterSettings["segmentationformat"] = "perfile"
+        elif self.multiLabelSegmentationButton.checked: self.converterSettings["segmentationformat"] = "multilabel"
+        elif self.bitPackedSegmentationButton.checked: self.converterSettings["segmentationformat"] = "bitpacked"
+        elif self.croppedSegmentationButton.checked: self.converterSettings["segmentationformat"] = "cropped"
+        
         if self.metadataButton.checked: self.converterSettings["inferpatientid"] = "metadata"
         elif self.inputDirButton.checked: self.converterSettings["inferpatientid"] = "inputdir"
         
@@ -263,14 +376,31 @@ class batchConverterWidget:
         else:
             self.converterSettings["centerlabels"] = True        
             
+        if self.noResumeButton.checked:
+            self.converterSettings["resume"] = False
+        else:
+            self.converterSettings["resume"] = True
+            
+        # A dry run only applies when contours are selected by filters
+        self.converterSettings["dryrun"] = self.dryRunButton.checked and self.converterSettings['convertcontours'] == 'Select'
+        
+        if self.referenceDedupButton.checked:
+            self.converterSettings["dedup"] = "reference"
+        elif self.hardlinkDedupButton.checked:
+            self.converterSettings["dedup"] = "hardlink"
+        else:
+            self.converterSettings["dedup"] = "off"
+            
         #batchConverterTools.BatchConvertDICOMtoNRRD.batchConvert(self.inputPatientDir, self.outputPatientDir, self.contourFilters, self.converterSettings)
         batchConverterLogic = batchConverterTools.BatchConvertDICOMtoNRRD.BatchConverterLogic(self.inputPatientDir, self.outputPatientDir, self.contourFilters, self.converterSettings)
         batchConverterLogic.batchConvert()
         
-        if self.extractCSVButton.checked:
-            DicomHeaderParserInstance = batchConverterTools.MetadataExtractor.DicomHeaderParser(self.inputPatientDir)
+        if self.extractCSVButton.checked or self.extractParquetButton.checked:
+            DicomHeaderParserInstance = batchConverterTools.MetadataExtractor.DicomHeaderParser(self.inputPatientDir, scanMode='header',
+                scanIndexPath=os.path.join(self.inputPatientDir, 'DatabaseDirectory', 'ScanIndex.sqlite'))
             DicomHeaderParserInstance.ExecuteDicomHeaderParser()
-            DicomHeaderParserInstance.WriteToCSVFile(outputDir=self.outputPatientDir)        
+            if self.extractCSVButton.checked: DicomHeaderParserInstance.WriteToCSVFile(outputDir=self.outputPatientDir)        
+            else: DicomHeaderParserInstance.WriteToColumnarFile(outputDir=self.outputPatientDir, fileFormat='parquet')
             
         self.applyBatchButton.enabled = True
         self.applyBatchButton.text = "Apply Batch Convert"
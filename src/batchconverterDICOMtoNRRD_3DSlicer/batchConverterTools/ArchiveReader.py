@@ -0,0 +1,306 @@
+import os
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import threading
+import contextlib
+import collections
+import multiprocessing.util
+import dicom
+
+# Files inside zip and tar archives are addressed by virtual paths: the archive path, this separator and the
+# member name, e.g. /data/Patient01.zip!/CT/IM0001.dcm. Zip and uncompressed tar archives are read where they
+# are; compressed tar archives are extracted once to a temporary directory when their files are read (see
+# getExtractedArchive)
+archiveMemberSeparator = '!/'
+
+# Longest extensions first, so that Patient01.tar.gz is not taken for a .gz file
+archiveExtensions_list = ['.tar.bz2', '.tar.gz', '.tbz2', '.tgz', '.tar', '.zip']
+
+FileStat = collections.namedtuple('FileStat', ['st_size', 'st_mtime'])
+
+# Member lists of the archives opened by this process: {archive path: (archive mtime, {member name: member info})}
+archiveIndexes_dict = {}
+archiveIndexLock = threading.Lock()
+# Open archive handles of each thread; zip and tar handles keep a file position and are not shared between threads
+threadArchives = threading.local()
+# Compressed tar archives extracted by this process: {archive path: (archive mtime, directory, {member name: path})},
+# least recently used first. Older extractions beyond maxExtractedArchives are removed
+extractedArchives_dict = collections.OrderedDict()
+extractedArchiveLock = threading.Lock()
+maxExtractedArchives = 4
+
+
+def getArchiveExtension(path):
+    lowerPath = path.lower()
+    for extension in archiveExtensions_list:
+        if lowerPath.endswith(extension): return extension
+    return None
+
+
+def isArchive(path):
+    return getArchiveExtension(path) is not None and os.path.isfile(path)
+
+
+def getArchiveMemberPath(archivePath, memberName):
+    return archivePath + archiveMemberSeparator + memberName
+
+
+def splitArchiveMemberPath(path):
+    # (archive path, member name) of a file inside an archive, (path, None) for any other file
+    archivePath, separator, memberName = path.partition(archiveMemberSeparator)
+    if not separator: return path, None
+    return archivePath, memberName
+
+
+def isArchiveMember(path):
+    return archiveMemberSeparator in path
+
+
+def getAbsolutePath(path):
+    # os.path.abspath that leaves the member name of a file inside an archive untouched
+    archivePath, memberName = splitArchiveMemberPath(path)
+    if memberName is None: return os.path.abspath(path)
+    return getArchiveMemberPath(os.path.abspath(archivePath), memberName)
+
+
+def getPatientDirName(patientDir):
+    # Name of a patient directory, or of a patient archive without its extension (Patient01.zip -> Patient01)
+    patientDirName = os.path.basename(patientDir.rstrip('/\\'))
+    extension = getArchiveExtension(patientDirName)
+    if extension is not None and os.path.isfile(patientDir): return patientDirName[:-len(extension)]
+    return patientDirName
+
+
+def isArchiveFileName(memberName):
+    # Regular files of an archive, leaving out the resource forks macOS adds ('._' files and __MACOSX)
+    return not memberName.endswith('/') and '._' not in os.path.basename(memberName) and not memberName.startswith('__MACOSX/')
+
+
+def getArchiveIndex(archivePath):
+    # {member name: ZipInfo or TarInfo} of the regular files of an archive, read once per process. Listing a
+    # compressed tar archive decompresses it once; zip archives list their members from the central directory
+    archiveMtime = os.stat(archivePath).st_mtime
+    with archiveIndexLock:
+        archiveIndex = archiveIndexes_dict.get(archivePath)
+        if archiveIndex is not None and archiveIndex[0] == archiveMtime: return archiveIndex[1]
+    if getArchiveExtension(archivePath) == '.zip':
+        with zipfile.ZipFile(archivePath) as archive:
+            members_dict = collections.OrderedDict((member.filename, member) for member in archive.infolist() if isArchiveFileName(member.filename))
+    else:
+        with tarfile.open(archivePath) as archive:
+            members_dict = collections.OrderedDict((member.name, member) for member in archive.getmembers() if member.isfile() and isArchiveFileName(member.name))
+    with archiveIndexLock: archiveIndexes_dict[archivePath] = (archiveMtime, members_dict)
+    return members_dict
+
+
+def isCompressedTar(archivePath):
+    return getArchiveExtension(archivePath) not in ['.zip', '.tar']
+
+
+def listArchiveFiles(archivePath, archiveOrder=False):
+    # Paths of the files of an archive, sorted like the files of a directory walk, or in the order they are
+    # stored in with archiveOrder. Reading the files of a compressed tar archive that is not extracted (see
+    # readFileHead) is only cheap in archive order: every step back restarts decompression from the start
+    memberNames = list(getArchiveIndex(archivePath)) if archiveOrder else sorted(getArchiveIndex(archivePath))
+    return [getArchiveMemberPath(archivePath, memberName) for memberName in memberNames]
+
+
+def removeExtractedArchive(extractDir):
+    shutil.rmtree(extractDir, ignore_errors=True)
+
+
+def getExtractedArchive(archivePath):
+    # {member name: path of the extracted file} of a compressed tar archive, extracted in one pass of its
+    # decompressed stream the first time this process reads one of its files. Scans and slice decoding read
+    # the files by name and by position in the volume; read from the archive in that order, each file would be
+    # decompressed from the start of the archive again. The extraction takes as much temporary disk space as
+    # the archive holds, and is removed when this process exits or when more than maxExtractedArchives
+    # archives have been extracted since
+    archiveMtime = os.stat(archivePath).st_mtime
+    with extractedArchiveLock:
+        extractedArchive = extractedArchives_dict.pop(archivePath, None)
+        if extractedArchive is not None and extractedArchive[0] != archiveMtime:
+            removeExtractedArchive(extractedArchive[1])
+            extractedArchive = None
+        if extractedArchive is None:
+            extractDir = tempfile.mkdtemp(prefix='batchConverterArchive_')
+            # Removed on exit of the process, including pool workers, which skip atexit
+            multiprocessing.util.Finalize(None, removeExtractedArchive, args=(extractDir,), exitpriority=0)
+            extractedPaths_dict = {}
+            try:
+                with tarfile.open(archivePath, 'r|*') as archive:
+                    for member in archive:
+                        if not member.isfile() or not isArchiveFileName(member.name): continue
+                        # Member names may hold any path; the files are numbered instead
+                        extractedPath = os.path.join(extractDir, '%06d' % len(extractedPaths_dict))
+                        with open(extractedPath, 'wb') as extractedFile:
+                            shutil.copyfileobj(archive.extractfile(member), extractedFile)
+                        extractedPaths_dict[member.name] = extractedPath
+            except Exception:
+                removeExtractedArchive(extractDir)
+                raise
+            extractedArchive = (archiveMtime, extractDir, extractedPaths_dict)
+        extractedArchives_dict[archivePath] = extractedArchive
+        while len(extractedArchives_dict) > maxExtractedArchives:
+            removeExtractedArchive(extractedArchives_dict.popitem(last=False)[1][1])
+    return extractedArchive[2]
+
+
+def isExtractedArchive(archivePath):
+    with extractedArchiveLock: return archivePath in extractedArchives_dict
+
+
+def getExtractedMemberPath(archivePath, memberName, path):
+    try: return getExtractedArchive(archivePath)[memberName]
+    except KeyError: raise IOError('No such file in archive: ' + path)
+
+
+class ArchiveMemberFile(object):
+    # Seekable file object of a file inside a zip or uncompressed tar archive. Bytes are read from the
+    # sequential stream of the file only as far as they are asked for, so reading a header does not read the
+    # pixel data, and are kept so that earlier positions can be read again
+
+    def __init__(self, stream, size, name):
+        self.stream = stream
+        self.size = size
+        self.name = name
+        self.data = ''
+        self.position = 0
+
+    def fill(self, end):
+        end = min(end, self.size)
+        while len(self.data) < end:
+            # Reads at least as much as is held already, so the copies of self.data add up to linear time
+            chunk = self.stream.read(min(self.size - len(self.data), max(end - len(self.data), len(self.data), 1 << 16)))
+            if not chunk: break
+            self.data += chunk
+
+    def read(self, numberBytes=-1):
+        end = self.size if numberBytes is None or numberBytes < 0 else self.position + numberBytes
+        self.fill(end)
+        data = self.data[self.position:end]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1: offset += self.position
+        elif whence == 2: offset += self.size
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def getThreadArchive(archivePath):
+    # Handle of an archive for the calling thread. Handles opened before a pool forked its workers would share
+    # their file position with the parent, so the handles of another process are dropped
+    if getattr(threadArchives, 'pid', None) != os.getpid():
+        threadArchives.pid = os.getpid()
+        threadArchives.archives_dict = {}
+    archive = threadArchives.archives_dict.get(archivePath)
+    if archive is None:
+        if getArchiveExtension(archivePath) == '.zip': archive = zipfile.ZipFile(archivePath)
+        else: archive = tarfile.open(archivePath)
+        threadArchives.archives_dict[archivePath] = archive
+    return archive
+
+
+def getArchiveMember(path):
+    archivePath, memberName = splitArchiveMemberPath(path)
+    try: return archivePath, memberName, getArchiveIndex(archivePath)[memberName]
+    except KeyError: raise IOError('No such file in archive: ' + path)
+
+
+def readArchiveMember(path):
+    # Contents of a file inside an archive. Zip members are read by random access, uncompressed tar members
+    # straight from their offset in the archive, and members of compressed tar archives from their extraction
+    archivePath, memberName, member = getArchiveMember(path)
+    if isinstance(member, zipfile.ZipInfo): return getThreadArchive(archivePath).read(member)
+    if getArchiveExtension(archivePath) == '.tar':
+        with open(archivePath, 'rb') as archiveFile:
+            archiveFile.seek(member.offset_data)
+            return archiveFile.read(member.size)
+    with open(getExtractedMemberPath(archivePath, memberName, path), 'rb') as extractedFile: return extractedFile.read()
+
+
+def readFileHead(path, numberBytes):
+    # First numberBytes of a file or of a file inside an archive, without reading the rest of it. A compressed
+    # tar archive that is not extracted yet is read from its decompressed stream, which is only cheap for files
+    # taken in archive order (see listArchiveFiles)
+    if not isArchiveMember(path):
+        with open(path, 'rb') as headFile: return headFile.read(numberBytes)
+    archivePath, memberName, member = getArchiveMember(path)
+    if isCompressedTar(archivePath) and not isExtractedArchive(archivePath):
+        return getThreadArchive(archivePath).extractfile(member).read(numberBytes)
+    with openDicomFile(path) as headFile: return headFile.read(numberBytes)
+
+
+def openDicomFile(path):
+    # Binary file object of a file or of a file inside an archive. Files inside zip and uncompressed tar archives
+    # are read as far as the reader gets, so reading only a header does not read the whole file
+    if not isArchiveMember(path): return open(path, 'rb')
+    archivePath, memberName, member = getArchiveMember(path)
+    if isinstance(member, zipfile.ZipInfo): return ArchiveMemberFile(getThreadArchive(archivePath).open(member), member.file_size, path)
+    if getArchiveExtension(archivePath) == '.tar':
+        archiveFile = open(archivePath, 'rb')
+        archiveFile.seek(member.offset_data)
+        return ArchiveMemberFile(archiveFile, member.size, path)
+    return open(getExtractedMemberPath(archivePath, memberName, path), 'rb')
+
+
+def readDicomFile(path, **kwargs):
+    # dicom.read_file for files and files inside archives. Deferred values are read again from the file by
+    # name, which a file inside an archive does not have, so its values are never deferred
+    if not isArchiveMember(path): return dicom.read_file(path, **kwargs)
+    kwargs['defer_size'] = None
+    with openDicomFile(path) as dicomFile: return dicom.read_file(dicomFile, **kwargs)
+
+
+def getFileStat(path):
+    # Size and modification time of a file; files inside an archive have their own size and the time of the archive
+    if not isArchiveMember(path):
+        fileStat = os.stat(path)
+        return FileStat(fileStat.st_size, fileStat.st_mtime)
+    archivePath, memberName = splitArchiveMemberPath(path)
+    try: member = getArchiveIndex(archivePath)[memberName]
+    except KeyError: raise OSError('No such file in archive: ' + path)
+    return FileStat(member.file_size if isinstance(member, zipfile.ZipInfo) else member.size, os.stat(archivePath).st_mtime)
+
+
+@contextlib.contextmanager
+def extractedFiles(paths):
+    # Real paths for readers that only take file names (SimpleITK): files inside zip and uncompressed tar
+    # archives are extracted to a temporary directory, in order, and removed on exit; files inside compressed
+    # tar archives are taken from the extraction of the archive, and other files are passed through
+    if not any(isArchiveMember(path) for path in paths):
+        yield list(paths)
+        return
+    extractDir = tempfile.mkdtemp(prefix='batchConverterArchive_')
+    try:
+        extractedPaths = []
+        for index, path in enumerate(paths):
+            if not isArchiveMember(path):
+                extractedPaths.append(path)
+                continue
+            archivePath, memberName = splitArchiveMemberPath(path)
+            if isCompressedTar(archivePath):
+                extractedPaths.append(getExtractedMemberPath(archivePath, memberName, path))
+                continue
+            extractedPath = os.path.join(extractDir, '%06d_' % index + os.path.basename(splitArchiveMemberPath(path)[1]))
+            with open(extractedPath, 'wb') as extractedFile:
+                extractedFile.write(readArchiveMember(path))
+            extractedPaths.append(extractedPath)
+        yield extractedPaths
+    finally:
+        shutil.rmtree(extractDir, ignore_errors=True)
@@ -10,40 +10,55 @@ from datetime import datetime
 import SimpleITK as sitk
 import sitkUtils as su
 import dicom
+import numpy
+from vtk.util import numpy_support
 
 from slicer.ScriptedLoadableModule import *
 
+from ConversionManifest import ConversionManifest, getInputFingerprint
+from RunLog import RunLog
+from HeadlessConverter import createDataHierarchy
+from OutputCompression import compressOutputFile, getCompressionLogLine, getWriterCompression
+from VolumeAssembly import getNarrowedDtype, writeRescaledValues
+from SegmentationPacking import packLabelImages, writeSegmentationSidecar
+from SeriesDedup import SeriesContentIndex, getSeriesContentFingerprint, getStudyContentFingerprint, linkDuplicateOutputs
+from ROIIndex import ContourFilterSet, buildROIIndex, getMatchingStudies, writeROIReport
+
 #from BatchRTStructConversion import BatchRTStructConversionLogic
 #from DatabaseHandler import DatabaseHandler
 
 import pdb
  
 
-def VolumeIntensityCorrection(volume, logFilePath):
-    spacing = volume.GetSpacing()
-    origin = volume.GetOrigin()
-    ras2ijk = vtk.vtkMatrix4x4()
-    ijk2ras = vtk.vtkMatrix4x4()
-    volume.GetRASToIJKMatrix(ras2ijk)
-    volume.GetIJKToRASMatrix(ijk2ras)
-    
-    imgsitk = su.PullFromSlicer(volume.GetName())
-    imgsitk_array = sitk.GetArrayFromImage(imgsitk)
-    imgsitk_array = imgsitk_array.__sub__(imgsitk_array.min())
-    imgsitk = sitk.GetImageFromArray(imgsitk_array)
-    outputImageName = volume.GetName() + '_corrected'
-    su.PushToSlicer(imgsitk, outputImageName)
-    volumeCorrected = slicer.util.getNode(outputImageName)
-          
-    volumeCorrected.SetOrigin(origin)
-    volumeCorrected.SetSpacing(spacing)
-    volumeCorrected.SetRASToIJKMatrix(ras2ijk)
-    volumeCorrected.SetIJKToRASMatrix(ijk2ras)
-    
-    with open(logFilePath,mode='a') as logfile: logfile.write("\tCORRECTED: Image intensity values corrected: " + volumeCorrected.GetName() + '\n')
-    return volumeCorrected
+def RescaleVolume(volume, rescaleSlope=1, rescaleIntercept=0):
+    # Applies voxel * rescaleSlope + rescaleIntercept to the image data of volume and stores the result in the
+    # narrowest type preserving it (getNarrowedDtype). The voxels are rewritten in the buffer of the node if its
+    # type is kept, else written once into a buffer of the new type that replaces the scalars of the same node,
+    # so no second node is created and the geometry is untouched. Returns the type of the voxels
+    imageData = volume.GetImageData()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+    dtype = getNarrowedDtype(voxels, rescaleSlope, rescaleIntercept)
+    if dtype == voxels.dtype:
+        writeRescaledValues(voxels, voxels, rescaleSlope, rescaleIntercept)
+    else:
+        rescaledVoxels = numpy.empty(voxels.shape, dtype=dtype)
+        writeRescaledValues(rescaledVoxels, voxels, rescaleSlope, rescaleIntercept)
+        # numpy_to_vtk keeps a reference to the buffer, which the image data now owns
+        scalars = numpy_support.numpy_to_vtk(rescaledVoxels, deep=0)
+        scalars.SetName(imageData.GetPointData().GetScalars().GetName())
+        imageData.GetPointData().SetScalars(scalars)
+    imageData.Modified()
+    volume.Modified()
+    return dtype
+
+def VolumeIntensityCorrection(volume, runLog):
+    # Shifts the intensities so that the minimum is 0, in place
+    minValue = volume.GetImageData().GetScalarRange()[0]
+    dtype = RescaleVolume(volume, 1, -minValue)
+    runLog.message("CORRECTED: Image intensity values corrected: " + volume.GetName() + " (" + dtype.name + ")")
+    return volume
 
-def SaveLabelMapContours(labelMapContours, outputSegmentationsDir, fileFormat, logFilePath):    
+def SaveLabelMapContours(labelMapContours, outputSegmentationsDir, fileFormat, runLog):    
     volumesLogic = slicer.vtkSlicerVolumesLogic()
     for labelMapContour in labelMapContours:
         volumesLogic.CenterVolume(labelMapContour)
@@ -51,7 +66,7 @@ def SaveLabelMapContours(labelMapContours, outputSegmentationsDir, fileFormat, l
         savenamelabel = ''.join(x for x in savenamelabel if x not in "',;\/:*?<>|") + fileFormat
         savelabel = slicer.util.saveNode(labelMapContour, os.path.join(outputSegmentationsDir, savenamelabel), properties={"filetype": fileFormat})
         if not savelabel:
-            with open(logFilePath,mode='a') as logfile: logfile.write("\tSAVEERROR: Could not save data" + labelMapContour.GetName() + '\n')     
+            runLog.message("SAVEERROR: Could not save data" + labelMapContour.GetName())     
         
 
 class BatchConverterLogic():
@@ -62,9 +77,12 @@ class BatchConverterLogic():
         self.converterSettings = converterSettings
         
         logTime = str(datetime.now().strftime(('%Y-%m-%d--%H-%M')))
-        self.logFilePath = os.path.join(outputPatientDir, 'BatchConverterLog_' + logTime + '.txt')
+        self.logFilePath = os.path.join(outputPatientDir, 'BatchConverterLog_' + logTime + '.jsonl')
+        self.runLog = RunLog(self.logFilePath)
         
         self.PatientDirs = [patDir for patDir in glob.glob(os.path.join(inputPatientDir, '*')) if os.path.isdir(patDir)]
+        self.manifest = ConversionManifest(outputPatientDir)
+        self.contentIndex = SeriesContentIndex(outputPatientDir) if converterSettings['dedup'] != 'off' else None
         
         self.dblogic = DatabaseHandler(inputPatientDir)
         if converterSettings['convertcontours']=='All':
@@ -87,57 +105,116 @@ class BatchConverterLogic():
         self.progressBar.setValue(index)
         slicer.app.processEvents()  
     
-    def createDataHierarchy(self, patientID, studyDate, studyDescription):
-        # Create Output Patient Directory
-        outputPatientIDDir = str(os.path.join(self.outputPatientDir,patientID))
-        if not os.path.exists(outputPatientIDDir): os.mkdir(outputPatientIDDir) 
+    def GetStudyContentFingerprint(self, seriesListStudy):
+        # Content fingerprint of a study from the SOPInstanceUIDs of its series in the DICOM database
+        seriesContentFingerprints = []
+        for series in seriesListStudy:
+            seriesFileDict_list = [{524312: str(slicer.dicomDatabase.fileValue(fle, '0008,0018')), 'Filepath': fle} for fle in slicer.dicomDatabase.filesForSeries(series)]
+            seriesContentFingerprints.append(getSeriesContentFingerprint(series, seriesFileDict_list, self.converterSettings['deduppixeldigest']))
+        return getStudyContentFingerprint(seriesContentFingerprints)
         
-        # Create Output Study Directory Within Patient Directory
-        studyDateDirName = studyDate + '_' + studyDescription
-        studyDateDirName = ''.join(x for x in studyDateDirName if x not in "-',;\/:*?<>|")         
-        outputStudyDateDir = str(os.path.join(outputPatientIDDir,studyDateDirName))      
-        if not os.path.exists(outputStudyDateDir): os.mkdir(outputStudyDateDir)
+    def LinkStudyOutputs(self, outputPaths, reconstructionsDir, segmentationsDir):
+        # Hard links the outputs of an earlier copy of a study into the matching directories of this copy
+        linkedPaths = []
+        for outputPath in outputPaths:
+            outputDir = segmentationsDir if os.path.basename(os.path.dirname(outputPath)) == 'Segmentations' else reconstructionsDir
+            linkedPaths.extend(linkDuplicateOutputs([outputPath], outputDir))
+        return linkedPaths
         
-        # Create Reconstructions, Segmentations, and Resources Directories
-        outputReconstructionsDir = os.path.join(outputStudyDateDir, 'Reconstructions')
-        outputSegmentationsDir = os.path.join(outputStudyDateDir, 'Segmentations')
-        outputResourcesDir = os.path.join(outputStudyDateDir, 'Resources')
-        if not os.path.exists(outputReconstructionsDir): os.mkdir(outputReconstructionsDir)
-        if not os.path.exists(outputSegmentationsDir): os.mkdir(outputSegmentationsDir) 
-        if not os.path.exists(outputResourcesDir): os.mkdir(outputResourcesDir)
-
-        return outputReconstructionsDir, outputSegmentationsDir, outputResourcesDir
+    def createDataHierarchy(self, patientID, studyDate, studyDescription):
+        # Shared with the headless converter so both write the same layout
+        return createDataHierarchy(self.outputPatientDir, patientID, studyDate, studyDescription)
 
     def saveVolumes(self, listVolumes, outputDir, isLabelMap=False):
         volumesLogic = slicer.vtkSlicerVolumesLogic()
+        savedPaths = []
         for volume in listVolumes:
             if self.converterSettings["centerlabels"] and isLabelMap:
                 volumesLogic.CenterVolume(volume)
             elif self.converterSettings["centerimages"] and not isLabelMap:
                 volumesLogic.CenterVolume(volume)
+            if not isLabelMap:
+                # Volumes loaded as float with integral values, e.g. rescaled CT, are saved as integers
+                RescaleVolume(volume)
                 
             savename = volume.GetName() 
             savename = ''.join(x for x in savename if x not in "',;\/:*?<>|") + self.converterSettings["fileformat"]       
-            savevol = slicer.util.saveNode(volume, os.path.join(outputDir, savename), properties={"filetype": self.converterSettings["fileformat"]})
+            # Slicer compresses gzip files itself; parallelgzip files are written uncompressed and compressed afterwards
+            savePath, isWriterCompressed = getWriterCompression(os.path.join(outputDir, savename), self.converterSettings["compression"])
+            savevol = slicer.util.saveNode(volume, savePath, properties={"filetype": ".nii.gz" if savePath.endswith(".nii.gz") else self.converterSettings["fileformat"], "useCompression": int(isWriterCompressed)})
             if not savevol:
-                with open(self.logFilePath,mode='a') as logfile: logfile.write("\tSAVEERROR: Could not save data" + volume.GetName() + '\n')        
+                self.runLog.message("SAVEERROR: Could not save data" + volume.GetName())        
+            else:
+                savedPaths.append(savePath if isWriterCompressed else self.compressSavedFile(savePath, volume.GetName()))
+        return savedPaths
+        
+    def compressSavedFile(self, savedPath, volumeName):
+        if self.converterSettings["compression"] != "raw":
+            with self.runLog.stage('compress', volume=volumeName):
+                savedPath, compressionStatistics_dict = compressOutputFile(savedPath, self.converterSettings["compression"], self.converterSettings["compressionlevel"], self.converterSettings["compressionthreads"])
+            self.runLog.message(getCompressionLogLine(savedPath, compressionStatistics_dict), **compressionStatistics_dict)
+        return savedPath
+        
+    def saveSegmentations(self, listLabelMapContours, outputDir):
+        # One file per label map, or all label maps of the study packed into one file or cropped to their ROIs
+        if self.converterSettings["segmentationformat"] == "perfile":
+            return self.saveVolumes(listLabelMapContours, outputDir, isLabelMap=True)
+        volumesLogic = slicer.vtkSlicerVolumesLogic()
+        labelImages = []
+        for labelMapContour in listLabelMapContours:
+            if self.converterSettings["centerlabels"]:
+                volumesLogic.CenterVolume(labelMapContour)
+            labelImages.append((labelMapContour.GetName(), su.PullFromSlicer(labelMapContour.GetName())))
+        outputs, messages = packLabelImages(labelImages, self.converterSettings["segmentationformat"])
+        for message in messages: self.runLog.message(message)
+        savedPaths = []
+        for outputName, image, segments in outputs:
+            savename = ''.join(x for x in outputName if x not in "',;\/:*?<>|") + self.converterSettings["fileformat"]
+            savePath, isWriterCompressed = getWriterCompression(os.path.join(outputDir, savename), self.converterSettings["compression"])
+            try: sitk.WriteImage(image, savePath, isWriterCompressed)
+            except Exception:
+                self.runLog.message("SAVEERROR: Could not save data" + outputName)
+                continue
+            # NIfTI has no key/value header for the label names
+            if self.converterSettings["fileformat"] != ".nrrd":
+                savedPaths.append(writeSegmentationSidecar(os.path.join(outputDir, savename), segments))
+            savedPaths.append(savePath if isWriterCompressed else self.compressSavedFile(savePath, outputName))
+        return savedPaths
             
     def batchConvert(self):
+        # With contour filters, the ROI names of all RTSTRUCTs are indexed first so that patients and studies
+        # without a matching ROI are never imported or loaded
+        matchingStudies_Dict = None
+        if self.converterSettings['convertcontours'] == 'Select':
+            with self.runLog.stage('discover') as stageEvent:
+                roiIndex_Dict = buildROIIndex(self.PatientDirs, runLog=self.runLog)
+                matchingStudies_Dict = getMatchingStudies(roiIndex_Dict, self.RTStructConversionlogic.contourFilterSet)
+                stageEvent['patients'] = len(matchingStudies_Dict)
+            writeROIReport(roiIndex_Dict, self.RTStructConversionlogic.contourFilterSet, os.path.join(self.outputPatientDir, 'ROIFilterReport.csv'))
+        if self.converterSettings['dryrun']:
+            self.runLog.close()
+            return
+        
         self.InitializeProgressBar(len(self.PatientDirs))
         
         for index,patientDir in enumerate(self.PatientDirs):
             patientDirName = os.path.basename(patientDir) 
             self.UpdateProgressBar(patientDirName, index)              
-            with open(self.logFilePath,mode='a') as logfile: logfile.write("\nPROCESSING: " + patientDirName + '\n')
+            if matchingStudies_Dict is not None and patientDir not in matchingStudies_Dict:
+                self.runLog.message("SKIPPED: No contours match the contour filters: " + patientDirName, patient=patientDirName)
+                continue
+            self.runLog.message("PROCESSING: " + patientDirName, patient=patientDirName)
             
             # Import Directory into ctkDICOMIndexer. If that fails, instantiate a new database file
             # Check if import added any new patients to the database
-            try: patientsAdded = self.dblogic.ImportStudy(patientDir)
-            except:
-                self.dblogic.SetAndOpenNewDatabase()
-                patientsAdded = self.dblogic.ImportStudy(patientDir)       
+            # The DICOM indexer discovers and scans the files of the directory in one step
+            with self.runLog.stage('scan', patient=patientDirName):
+                try: patientsAdded = self.dblogic.ImportStudy(patientDir)
+                except:
+                    self.dblogic.SetAndOpenNewDatabase()
+                    patientsAdded = self.dblogic.ImportStudy(patientDir)       
             if patientsAdded == 0:    
-                with open(self.logFilePath,mode='a') as logfile: logfile.write("\tPATIENTERROR: No new patients added to database from directory: " + patientDirName + '\n')
+                self.runLog.message("PATIENTERROR: No new patients added to database from directory: " + patientDirName, patient=patientDirName)
                 slicer.mrmlScene.Clear(0)
                 continue
 
@@ -145,17 +222,30 @@ class BatchConverterLogic():
             for patient in patientsAdded:
                 try: studiesList = slicer.dicomDatabase.studiesForPatient(patient)
                 except:
-                    with open(self.logFilePath,mode='a') as logfile: logfile.write("\tSTUDYERROR: could not find studies for Patient: " + patientDirName + ' with DB Index: ' + patient + '\n')
+                    self.runLog.message("STUDYERROR: could not find studies for Patient: " + patientDirName + ' with DB Index: ' + patient, patient=patientDirName)
                     slicer.mrmlScene.Clear(0)
                     continue
                           
                 for study in studiesList:
                     try: seriesListStudy = slicer.dicomDatabase.seriesForStudy(study)
                     except:
-                        with open(self.logFilePath,mode='a') as logfile: logfile.write("\tSERIESERROR: could not find Series for Study: " + study + " for Patient: " + patientDirName + '\n')
+                        self.runLog.message("SERIESERROR: could not find Series for Study: " + study + " for Patient: " + patientDirName, patient=patientDirName)
                         slicer.mrmlScene.Clear(0)
                         continue
                     
+                    if matchingStudies_Dict is not None and study not in [studyInstanceUID for patientID, studyInstanceUID in matchingStudies_Dict[patientDir]]:
+                        self.runLog.message("SKIPPED: No contours match the contour filters: " + study + " for Patient: " + patientDirName, patient=patientDirName)
+                        continue
+                    
+                    # Skip the study if all of its series were converted from the same files by a previous run
+                    seriesFingerprints = {}
+                    with self.runLog.stage('group', patient=patientDirName, study=study):
+                        for series in seriesListStudy:
+                            seriesFingerprints[series] = getInputFingerprint(slicer.dicomDatabase.filesForSeries(series))
+                    if self.converterSettings["resume"] and all(self.manifest.isComplete(series, seriesFingerprints[series]) for series in seriesListStudy):
+                        self.runLog.message("SKIPPED: Study already converted: " + study + " for Patient: " + patientDirName, patient=patientDirName)
+                        continue
+                    
                     # Establish current patient ID
                     if self.converterSettings["inferpatientid"] == "metadata":
                         try: patientID = str(self.dblogic.GetDicomHeaderAttribute(seriesListStudy[0],'0010,0020'))
@@ -173,6 +263,22 @@ class BatchConverterLogic():
                     # Create Data Directory Hierarchy in output directory
                     reconstructionsDir, segmentationsDir, resourcesDir = self.createDataHierarchy(patientID, studyDate, studyDescription)
                     
+                    # A study whose series were all converted before, e.g. from another patient directory, is not loaded:
+                    # the manifest references the earlier outputs, which are hard linked into this study with dedup hardlink
+                    studyContentFingerprint = None
+                    if self.contentIndex is not None:
+                        with self.runLog.stage('dedup', patient=patientDirName, study=study):
+                            studyContentFingerprint = self.GetStudyContentFingerprint(seriesListStudy)
+                            duplicatePaths = self.contentIndex.getOutputs(studyContentFingerprint) if studyContentFingerprint is not None else None
+                            if duplicatePaths is not None and self.converterSettings["dedup"] == "hardlink":
+                                duplicatePaths = self.LinkStudyOutputs(duplicatePaths, reconstructionsDir, segmentationsDir)
+                        if duplicatePaths is not None:
+                            self.runLog.message("DUPLICATE: Study already converted: " + study + " for Patient: " + patientDirName, patient=patientDirName, outputs=duplicatePaths)
+                            for series in seriesListStudy:
+                                self.manifest.record(series, seriesFingerprints[series], duplicatePaths, 'complete')
+                            self.manifest.save()
+                            continue
+                    
                     """
                     ###BRAINLAB####
                     # within a timepoint/studydate, manually defining pre-op and post-op images based on series date
@@ -200,33 +306,52 @@ class BatchConverterLogic():
                     
                     # Load Images from Study into Slicer
                     listVolumes = []
-                    listVolumes = self.dblogic.LoadPatientsIntoSlicer(study)
+                    with self.runLog.stage('load', patient=patientDirName, study=study) as stageEvent:
+                        listVolumes = self.dblogic.LoadPatientsIntoSlicer(study)
+                        stageEvent['volumes'] = len(listVolumes)
 
                     # Load contours into slicer and convert to label maps if specified by user
                     listLabelMapContours = []                    
                     if (self.converterSettings['convertcontours'] != 'None') or (len(self.contourFilters) != 0):
                         # Get label map contours         
-                        listLabelMapContours = self.RTStructConversionlogic.ConvertContoursToLabelmap(listVolumes, self.logFilePath)                  
+                        with self.runLog.stage('contours', patient=patientDirName, study=study):
+                            listLabelMapContours = self.RTStructConversionlogic.ConvertContoursToLabelmap(listVolumes, self.runLog)                  
 
                     # Save images as NRRD    
+                    imagePaths = []
+                    labelPaths = []
                     if listVolumes: 
                         # Perform intensity correction on images and save them         
-                        # listVolumes = [VolumeIntensityCorrection(volume, logFilePath=logFilePath) if volume.GetImageData().GetScalarRange()[0] > 32000.0 else volume for volume in listVolumes]      
-                        self.saveVolumes(listVolumes, reconstructionsDir)  
+                        # listVolumes = [VolumeIntensityCorrection(volume, runLog=self.runLog) if volume.GetImageData().GetScalarRange()[0] > 32000.0 else volume for volume in listVolumes]      
+                        with self.runLog.stage('save', patient=patientDirName, study=study):
+                            imagePaths = self.saveVolumes(listVolumes, reconstructionsDir)  
                     else:
-                        with open(self.logFilePath, mode='a') as logfile: logfile.write("\tIMAGEERROR: could not Parse Images: " + patientDirName + ', study: ' + studyDate + '\n')
+                        self.runLog.message("IMAGEERROR: could not Parse Images: " + patientDirName + ', study: ' + studyDate, patient=patientDirName)
                     
                     # Save label maps as NRRD 
-                    if len(listLabelMapContours) > 0:                 
-                        self.saveVolumes(listLabelMapContours, segmentationsDir, isLabelMap=True)            
+                    if listLabelMapContours and len(listLabelMapContours) > 0:                 
+                        with self.runLog.stage('save', patient=patientDirName, study=study):
+                            labelPaths = self.saveSegmentations(listLabelMapContours, segmentationsDir)            
                     else:
-                        with open(self.logFilePath,mode='a') as logfile: logfile.write("\tRTSTRUCTERROR: could not Parse RTSTRUCTs: " + patientDirName + ', study: ' + studyDate + '\n')  
+                        self.runLog.message("RTSTRUCTERROR: could not Parse RTSTRUCTs: " + patientDirName + ', study: ' + studyDate, patient=patientDirName)  
+                    
+                    # Record the study's series in the manifest; a study is only complete if every loaded volume was saved
+                    if listVolumes and len(imagePaths) == len(listVolumes): status = 'complete'
+                    else: status = 'failed'
+                    for series in seriesListStudy:
+                        self.manifest.record(series, seriesFingerprints[series], imagePaths + labelPaths, status)
+                    self.manifest.save()
+                    if studyContentFingerprint is not None and status == 'complete':
+                        self.contentIndex.record(studyContentFingerprint, study, imagePaths + labelPaths)
+                        self.contentIndex.save()
                     
                     # Clear data within Slicer
                     slicer.mrmlScene.Clear(0)
                 slicer.mrmlScene.Clear(0)    
             slicer.mrmlScene.Clear(0)         
+            self.runLog.flush()
         slicer.mrmlScene.Clear(0)
+        self.runLog.close()
         self.progressBar.close()
         self.progressBar = None
     
@@ -242,8 +367,9 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
         else:
             self.convertAll = False
             self.contourFilters = contourFilters
+        self.contourFilterSet = ContourFilterSet(self.contourFilters, self.convertAll)
         
-    def ConvertContoursToLabelmap(self, listVolumes, logFilePath):
+    def ConvertContoursToLabelmap(self, listVolumes, runLog):
         import vtkSlicerContoursModuleLogic
         
         referenceVolume = None 
@@ -259,7 +385,7 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
                 contourFilterTest = self.TestContourNode(contourNode.GetName(), self.contourFilters )
                 
             if contourFilterTest:
-                with open(logFilePath,mode='a') as logfile: logfile.write('\tCONVERTING: Contour: ' + contourNode.GetName() + '\n')
+                runLog.message('CONVERTING: Contour: ' + contourNode.GetName())
                 
                 # Set referenced volume as rasterization reference 
                 referenceVolume = vtkSlicerContoursModuleLogic.vtkSlicerContoursModuleLogic.GetReferencedVolumeByDicomForContour(contourNode)
@@ -276,11 +402,11 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
                 """
                 
                 if not referenceVolume:
-                    with open(logFilePath,mode='a') as logfile: logfile.write('\tREFERENCEERROR: No reference volume found for contour: ' + contourNode.GetName() + '\n')
+                    runLog.message('REFERENCEERROR: No reference volume found for contour: ' + contourNode.GetName())
                     continue
                   
                 contourNode.SetAndObserveRasterizationReferenceVolumeNodeId(referenceVolume.GetID())
-                with open(logFilePath,mode='a') as logfile: logfile.write("\tREFERENCED: Label: " + contourNode.GetName() + ' Reference: ' + referenceVolume.GetName() + '\n')
+                runLog.message("REFERENCED: Label: " + contourNode.GetName() + ' Reference: ' + referenceVolume.GetName())
                 
                 # Perform conversion
                 x = vtkSlicerContoursModuleLogic.vtkSlicerContoursModuleLogic.GetIndexedLabelmapWithGivenGeometry(contourNode, referenceVolume, contourNode)
@@ -291,37 +417,19 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
                 # Resample and Center Label Map
                 #if referenceVolume.GetSpacing() != contourLabelmapNode.GetSpacing():
                 #    self.ResampleScalarVolumeCLI(referenceVolume, contourLabelmapNode)
-                #    with open(logFilePath,mode='a') as logfile:logfile.write("\tRESAMPLED: Label Resampled to Image and Centered: " + contourLabelmapNode.GetName() + '\n')
+                #    runLog.message("RESAMPLED: Label Resampled to Image and Centered: " + contourLabelmapNode.GetName())
                 
                 # Binarize Label Map
-                #contourLabelmapNode = self.BinarizeLabelMap(contourLabelmapNode, logFilePath)
+                #contourLabelmapNode = self.BinarizeLabelMap(contourLabelmapNode, runLog)
                 
                 # Append contour to list
                 labelmapsToSave.append(contourLabelmapNode)
         return labelmapsToSave
         
     def TestContourNode(self, contourName, contourFilters):
-        contourName = contourName.upper()
-        filterSuccess = False
-        for contourFilter in contourFilters:
-            if len(contourFilter['Include']) == 0:
-                if len(contourFilter['Exclude']) == 0:
-                    filterSuccess = contourFilter
-                    break
-                else:
-                    if (not any(substring.upper() in contourName for substring in contourFilter['Exclude'])):
-                        filterSuccess = contourFilter
-                        break
-            else: 
-                if len(contourFilter['Exclude']) == 0:
-                    if (all(substring.upper() in contourName for substring in contourFilter['Include'])):
-                        filterSuccess = contourFilter
-                        break                        
-                else:
-                    if (all(substring.upper() in contourName for substring in contourFilter['Include']) and (not any(substring.upper() in contourName for substring in contourFilter['Exclude']))):
-                        filterSuccess = contourFilter
-                        break                      
-        return filterSuccess 
+        # The filters are compiled once by SetContourFilters
+        if contourFilters is not self.contourFilters: return ContourFilterSet(contourFilters).match(contourName)
+        return self.contourFilterSet.match(contourName)
         
     def ResampleScalarVolumeCLI(self, image, label):
         outputSpacing = image.GetSpacing()
@@ -333,7 +441,7 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
         resamplevolume = slicer.modules.resamplescalarvolume 
         return (slicer.cli.run(resamplevolume, None, parameters, wait_for_completion = True))
               
-    def BinarizeLabelMap(self, labelNode, logFilePath):
+    def BinarizeLabelMap(self, labelNode, runLog):
         labelNodeImageData = labelNode.GetImageData()
         change = slicer.vtkImageLabelChange()
         change.SetInputData(labelNodeImageData)
@@ -345,7 +453,7 @@ class BatchRTStructConversionLogic(ScriptedLoadableModuleLogic):
             change.Update()
             
         labelNode.SetAndObserveImageData(labelNodeImageData)
-        with open(logFilePath,mode='a') as logfile: logfile.write("\tBINARIZED: LabelMap Binarized: " + labelNode.GetName() + '\n')
+        runLog.message("BINARIZED: LabelMap Binarized: " + labelNode.GetName())
           
         return labelNode
 
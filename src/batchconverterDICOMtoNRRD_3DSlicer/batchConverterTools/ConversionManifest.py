@@ -0,0 +1,70 @@
+import os
+import glob
+import json
+import hashlib
+from datetime import datetime
+
+from ArchiveReader import getAbsolutePath, getFileStat
+
+
+def getInputFingerprint(dicomFiles_list):
+    # Fingerprint of a set of input files from their paths, sizes and modification times
+    fingerprint = hashlib.sha1()
+    for dicomFile in sorted(getAbsolutePath(dicomFile) for dicomFile in dicomFiles_list):
+        fileStat = getFileStat(dicomFile)
+        fingerprint.update('%s|%d|%r\n' % (dicomFile, fileStat.st_size, fileStat.st_mtime))
+    return fingerprint.hexdigest()
+
+
+def getManifestEntry(fingerprint, outputPaths, status):
+    return {'fingerprint': fingerprint, 'outputs': list(outputPaths), 'status': status,
+            'time': str(datetime.now().strftime('%Y-%m-%d--%H-%M-%S'))}
+
+
+def getNodeManifestFileName(nodeName):
+    # Nodes converting into the same output directory each write their own manifest
+    return 'ConversionManifest_' + nodeName + '.json'
+
+
+class ConversionManifest:
+    # Record of every series converted into an output directory, used to resume interrupted runs.
+    # Entries are keyed by SeriesInstanceUID and hold the input fingerprint, output paths and status.
+    # The entries of all manifests in the output directory (one per node of a distributed run) are
+    # loaded, the most recent entry of a series winning; only this manifest's file is written
+
+    def __init__(self, outputDir, manifestFileName='ConversionManifest.json'):
+        self.manifestPath = os.path.join(outputDir, manifestFileName)
+        self.seriesEntries_dict = {}
+        for manifestPath in sorted(glob.glob(os.path.join(outputDir, 'ConversionManifest*.json'))):
+            try:
+                with open(manifestPath, 'r') as manifestFile:
+                    manifestEntries_dict = json.load(manifestFile)
+            except (IOError, ValueError):
+                # Another node may be replacing its manifest
+                continue
+            for seriesInstanceUID, seriesEntry in manifestEntries_dict.items():
+                if seriesInstanceUID not in self.seriesEntries_dict or seriesEntry['time'] > self.seriesEntries_dict[seriesInstanceUID]['time']:
+                    self.seriesEntries_dict[seriesInstanceUID] = seriesEntry
+
+    def isComplete(self, seriesInstanceUID, fingerprint):
+        # A series is complete if it was converted from the same input files and all of its outputs still exist
+        try: seriesEntry = self.seriesEntries_dict[seriesInstanceUID]
+        except KeyError: return False
+        if seriesEntry['status'] != 'complete' or seriesEntry['fingerprint'] != fingerprint: return False
+        return all(os.path.exists(outputPath) for outputPath in seriesEntry['outputs'])
+
+    def record(self, seriesInstanceUID, fingerprint, outputPaths, status):
+        self.seriesEntries_dict[seriesInstanceUID] = getManifestEntry(fingerprint, outputPaths, status)
+
+    def update(self, seriesEntries_dict):
+        self.seriesEntries_dict.update(seriesEntries_dict)
+
+    def save(self):
+        # Write to a temporary file and rename it over the manifest so that a crash never leaves a partial manifest
+        tmpManifestPath = self.manifestPath + '.tmp'
+        with open(tmpManifestPath, 'w') as manifestFile:
+            json.dump(self.seriesEntries_dict, manifestFile, indent=1, sort_keys=True)
+            manifestFile.flush()
+            os.fsync(manifestFile.fileno())
+        if os.name == 'nt' and os.path.exists(self.manifestPath): os.remove(self.manifestPath)
+        os.rename(tmpManifestPath, self.manifestPath)
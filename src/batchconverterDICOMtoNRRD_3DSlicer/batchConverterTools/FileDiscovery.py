@@ -0,0 +1,142 @@
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport of os.scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from ArchiveReader import isArchive, listArchiveFiles, readFileHead, getFileStat
+
+# Threads listing directories and reading file heads; on network storage most of the walk is waiting for the server
+discoveryThreads = 8
+
+# A DICOM file has 'DICM' after its 128 byte preamble
+dicomPrefixOffset = 128
+dicomPrefix = b'DICM'
+# Files without preamble (ACR-NEMA style or stripped by some exporters) start with an element of the file meta
+# group or of the identifying group
+headerGroups_set = set([0x0002, 0x0008])
+
+
+def addDiscoveryArguments(parser):
+    parser.add_argument('--discovery-threads', type=int, default=discoveryThreads, help='Threads walking the input directories and identifying DICOM files (default: ' + str(discoveryThreads) + ')')
+
+
+def getDiscoverySettings(args):
+    return {'discoverythreads': args.discovery_threads}
+
+
+def isDicomHead(head):
+    # Classifies a file by its first bytes: the DICM prefix, or for files without preamble a first element of
+    # group 0002 or 0008 in either byte order, followed by an explicit VR or a plausible implicit VR length
+    if len(head) >= dicomPrefixOffset + len(dicomPrefix) and head[dicomPrefixOffset:dicomPrefixOffset + len(dicomPrefix)] == dicomPrefix: return True
+    if len(head) < 8: return False
+    for byteOrder in '<>':
+        group, element = struct.unpack(byteOrder + 'HH', head[:4])
+        if group not in headerGroups_set: continue
+        valueRepresentation = head[4:6]
+        if valueRepresentation.isalpha() and valueRepresentation.isupper(): return True
+        if struct.unpack(byteOrder + 'I', head[4:8])[0] < 0x10000: return True
+    return False
+
+
+def isDicomFile(filePath):
+    # Unreadable files are left out like the directories os.walk cannot list
+    try: return isDicomHead(readFileHead(filePath, dicomPrefixOffset + len(dicomPrefix)))
+    except (IOError, OSError): return False
+
+
+def listDirectory(dirPath):
+    # ([(file name, file path, size)], [subdirectory paths]), each sorted by name. Like os.walk, links to
+    # directories are not followed
+    files, subDirs = [], []
+    try:
+        if scandir is not None:
+            for entry in scandir(dirPath):
+                if entry.is_dir():
+                    if not entry.is_symlink(): subDirs.append(entry.path)
+                elif entry.is_file():
+                    files.append((entry.name, entry.path, entry.stat().st_size))
+        else:
+            for name in os.listdir(dirPath):
+                path = os.path.join(dirPath, name)
+                if os.path.isdir(path):
+                    if not os.path.islink(path): subDirs.append(path)
+                elif os.path.isfile(path):
+                    files.append((name, path, os.path.getsize(path)))
+    except OSError:
+        pass
+    return sorted(files), sorted(subDirs)
+
+
+def scanDirectory(pool, dirPath, sniff):
+    # Runs on the pool: lists one directory, submits its subdirectories before classifying its own files, and
+    # returns ([(path, size)] of the DICOM files, [pending results of the subdirectories]). Archives are listed
+    # in place of their files
+    files, subDirs = listDirectory(dirPath)
+    pendingSubDirs = [pool.apply_async(scanDirectory, (pool, subDir, sniff)) for subDir in subDirs]
+    dicomFiles = []
+    for fileName, filePath, fileSize in files:
+        if '._' in fileName: continue
+        if isArchive(filePath): dicomFiles.extend(getArchiveDicomFiles(filePath, sniff))
+        elif not sniff or isDicomFile(filePath): dicomFiles.append((filePath, fileSize))
+    return dicomFiles, pendingSubDirs
+
+
+def getArchiveDicomFiles(archivePath, sniff=True):
+    # Files are sniffed in archive order, which reads a compressed tar archive in one pass, and sorted afterwards
+    dicomFiles = [(filePath, getFileStat(filePath).st_size) for filePath in listArchiveFiles(archivePath, archiveOrder=True) if not sniff or isDicomFile(filePath)]
+    return sorted(dicomFiles)
+
+
+def discoverDicomFiles(rootDir, threads=discoveryThreads, sniff=True):
+    # Lazily yields (path, size) of the DICOM files below rootDir, or inside rootDir if it is a zip or tar
+    # archive, in the order of a sorted os.walk: the files of a directory by name, then its subdirectories by
+    # name. Threads list the directories and read the first 132 bytes of every file ahead of the consumer, so
+    # the scan of the first files starts while the rest of the tree is still being walked. With sniff False
+    # every file is yielded as before, except '._' AppleDouble files
+    if isArchive(rootDir):
+        for dicomFile in getArchiveDicomFiles(rootDir, sniff): yield dicomFile
+        return
+    pool = ThreadPool(max(1, threads))
+    try:
+        pendingDirs = [pool.apply_async(scanDirectory, (pool, rootDir, sniff))]
+        while pendingDirs:
+            dicomFiles, pendingSubDirs = pendingDirs.pop().get()
+            pendingDirs.extend(reversed(pendingSubDirs))
+            for dicomFile in dicomFiles: yield dicomFile
+    finally:
+        pool.terminate()
+
+
+def discoverDicomFilesList(rootDir, threads=discoveryThreads, sniff=True):
+    return [dicomFile for dicomFile, fileSize in discoverDicomFiles(rootDir, threads, sniff)]
+
+
+class DiscoveredFiles:
+    # Iterable over the paths discoverDicomFiles yields that records them and their total size as it passes them
+    # on, so that a scan consumes the walk while it runs and the file list is still there afterwards. Files
+    # selected beforehand, e.g. by a series query, are passed as selectedFiles and not walked for
+
+    def __init__(self, rootDir, threads=discoveryThreads, sniff=True, selectedFiles=None):
+        self.rootDir = rootDir
+        self.threads = threads
+        self.sniff = sniff
+        self.selectedFiles = selectedFiles
+        self.dicomFiles_list = []
+        self.numberBytes = 0
+
+    def getDicomFiles(self):
+        if self.selectedFiles is None: return discoverDicomFiles(self.rootDir, self.threads, self.sniff)
+        return ((dicomFile, getFileStat(dicomFile).st_size) for dicomFile in self.selectedFiles)
+
+    def __iter__(self):
+        for dicomFile, fileSize in self.getDicomFiles():
+            self.dicomFiles_list.append(str(dicomFile))
+            self.numberBytes += fileSize
+            yield str(dicomFile)
@@ -0,0 +1,170 @@
+import array
+import bisect
+import dicom
+from dicom.dataelem import RawDataElement
+from dicom.values import convert_value
+from dicom.UID import UID
+
+# Value representations of binary data; values of these VRs longer than recordValueSizeLimit bytes (pixel
+# data, overlays, lookup tables, private blobs) are left out of header records without being converted
+binaryVRs_set = set(['OB', 'OW', 'OF', 'OD', 'OL', 'UN', 'OB or OW', 'OW or OB', 'OW/OB', 'OB/OW', 'US or SS', 'US or OW', 'US or SS or OW', 'US\\US or SS\\US'])
+# Value representations of binary numbers; they are recorded as backslash separated text like DS and IS values
+numberVRs_dict = {'UL': int, 'SL': int, 'US': int, 'SS': int, 'FL': float, 'FD': float}
+recordValueSizeLimit = 1024
+
+
+def getElementVR(tag, element):
+    # VR of an element; implicit VR files leave it to the dictionary, and private tags it does not know are binary
+    if element.VR is not None: return element.VR
+    try: return dicom.datadict.dictionaryVR(tag)
+    except KeyError: return 'OB'
+
+
+def getNumberText(value):
+    if isinstance(value, (list, tuple)): return '\\'.join(repr(v) for v in value)
+    return repr(value)
+
+
+def getTextValue(VR, value):
+    # Text of a raw value, or None for binary data. Text values (UIDs in particular) may be padded to an even
+    # length with '\x00', which is dropped; a value still holding '\x00' after its padding is binary. Padding
+    # with ' ' is kept and dropped when the value is converted, as pydicom does
+    if VR in binaryVRs_set: return None if '\x00' in value else value
+    if '\x00' in value.rstrip('\x00 '): return None
+    return value.rstrip('\x00')
+
+
+def getRecordValue(tag, element):
+    # (VR, text) of an element for a header record, or None if it is left out: sequences, deferred and long
+    # binary values, and binary values holding '\x00' like the header dictionaries this record replaces. Raw
+    # text values are recorded as read, without converting them
+    VR = getElementVR(tag, element)
+    if VR == 'SQ' or VR == 'AT': return None
+    if isinstance(element, RawDataElement):
+        if element.value is None or (VR in binaryVRs_set and element.length > recordValueSizeLimit): return None
+        if VR in numberVRs_dict:
+            if element.length > recordValueSizeLimit: return None
+            return VR, getNumberText(convert_value(VR, element))
+        value = getTextValue(VR, element.value)
+        if value is None: return None
+        return VR, value
+    # Elements that were accessed are already converted
+    value = element.value
+    if VR in numberVRs_dict: return VR, getNumberText(value)
+    if isinstance(value, (list, tuple)): value = '\\'.join(str(v) for v in value)
+    else: value = str(value)
+    if VR in binaryVRs_set and len(value) > recordValueSizeLimit: return None
+    value = getTextValue(VR, value)
+    if value is None: return None
+    return VR, value
+
+
+def getHeaderRecord(dicomFileHeader):
+    # HeaderRecord of the elements of a dataset, read from the raw elements without converting the text values
+    tags, VRs, values = [], [], []
+    for tag in sorted(dict.keys(dicomFileHeader)):
+        recordValue = getRecordValue(tag, dict.__getitem__(dicomFileHeader, tag))
+        if recordValue is None: continue
+        tags.append(tag)
+        VRs.append(recordValue[0])
+        values.append(recordValue[1])
+    return HeaderRecord(tags, VRs, values)
+
+
+def getValueText(value):
+    # str(element.value) of a pydicom element with this value, e.g. ['1', '0', '0'] for several values, except
+    # that UIDs are given as the UID rather than the name of a well-known UID
+    if isinstance(value, list): return "['" + "', '".join(getValueText(v) for v in value) + "']"
+    if isinstance(value, UID): return str.__str__(value)
+    return str(value)
+
+
+class HeaderRecord(object):
+    # Compact header values of one file, in place of {tag: str(value), 'Filepath': path} dictionaries: the
+    # sorted tags in an array, their two letter VRs in one string, and the text of their values in one string
+    # with an array of offsets into it. record.getValue(tag) converts the text to its typed value when it is
+    # asked for, and record[tag] returns str of the typed value like the dictionaries did, without the padding
+    # of text values and with several values as a list, so exports read as before. A header of a few hundred
+    # elements takes a few KB instead of the tens of KB of a dictionary of strings. Tags and offsets are 4 byte
+    # unsigned integers, so pickled records (in the scan index) read the same on every platform
+    __slots__ = ('tags', 'VRs', 'valueOffsets', 'valueBytes', 'filePath')
+
+    def __init__(self, tags=(), VRs=(), values=(), filePath=None):
+        self.tags = array.array('I', tags)
+        # VRs such as 'OB or OW' are only recorded for binary values, which have no typed conversion
+        self.VRs = ''.join(VR if len(VR) == 2 else 'OB' for VR in VRs)
+        self.valueOffsets = array.array('I', [0])
+        for value in values: self.valueOffsets.append(self.valueOffsets[-1] + len(value))
+        self.valueBytes = ''.join(values)
+        self.filePath = filePath
+
+    def __getstate__(self):
+        return (self.tags.tostring(), self.VRs, self.valueOffsets.tostring(), self.valueBytes, self.filePath)
+
+    def __setstate__(self, state):
+        tags, self.VRs, valueOffsets, self.valueBytes, self.filePath = state
+        self.tags = array.array('I')
+        self.tags.fromstring(tags)
+        self.valueOffsets = array.array('I')
+        self.valueOffsets.fromstring(valueOffsets)
+
+    def getIndex(self, tag):
+        index = bisect.bisect_left(self.tags, tag)
+        if index < len(self.tags) and self.tags[index] == tag: return index
+        return None
+
+    def getString(self, index):
+        return self.valueBytes[self.valueOffsets[index]:self.valueOffsets[index + 1]]
+
+    def getValue(self, tag, default=None):
+        index = self.getIndex(tag)
+        if index is None: return default
+        VR, value = self.VRs[2 * index:2 * index + 2], self.getString(index)
+        if VR in numberVRs_dict:
+            numbers = [numberVRs_dict[VR](number) for number in value.split('\\') if number]
+            return numbers[0] if len(numbers) == 1 else numbers
+        return convert_value(VR, RawDataElement(tag, VR, len(value), value, 0, True, True))
+
+    def getText(self, index):
+        # Values that do not convert, e.g. a malformed DS, are returned as recorded
+        try: return getValueText(self.getValue(self.tags[index]))
+        except Exception: return self.getString(index)
+
+    def __getitem__(self, key):
+        # Tags may be dicom Tags, which cannot be compared with strings
+        if not isinstance(key, (int, long)):
+            if key == 'Filepath' and self.filePath is not None: return self.filePath
+            raise KeyError(key)
+        index = self.getIndex(key)
+        if index is None: raise KeyError(key)
+        return self.getText(index)
+
+    def __setitem__(self, key, value):
+        if key != 'Filepath': raise TypeError('Only the Filepath of a header record can be set')
+        self.filePath = value
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.tags) + (self.filePath is not None)
+
+    def iterkeys(self):
+        for tag in self.tags: yield int(tag)
+        if self.filePath is not None: yield 'Filepath'
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        for index, tag in enumerate(self.tags): yield int(tag), self.getText(index)
+        if self.filePath is not None: yield 'Filepath', self.filePath
+
+    def items(self):
+        return list(self.iteritems())
@@ -0,0 +1,59 @@
+import dicom
+from dicom.filereader import read_partial
+
+from ArchiveReader import isArchiveMember, openDicomFile, readDicomFile
+
+# Tags needed to assign a file to its series
+groupingHeaderTag_list = [524312,524384,2097166]
+#524312: SOP Instance UID
+#524384: Modality
+#2097166: Series Instance UID
+
+# Tags needed to order the slices of a series and check its geometry
+geometryHeaderTag_list = [1572944,2097171,2097202,2097207,2621442,2621456,2621457,2621488,2621696]
+#1572944: Slice Thickness
+#2097171: Instance Number
+#2097202: Image Position (Patient)
+#2097207: Image Orientation (Patient)
+#2621442: Samples per Pixel
+#2621456: Rows
+#2621457: Columns
+#2621488: Pixel Spacing
+#2621696: Bits Allocated
+
+# Tags needed to convert stored pixel values
+pixelHeaderTag_list = [2621448,2621697,2621699,2625618,2625619]
+#2621448: Number of Frames
+#2621697: Bits Stored
+#2621699: Pixel Representation
+#2625618: Rescale Intercept
+#2625619: Rescale Slope
+
+# Values larger than this are left on disk unless they are accessed
+deferSize = 4096
+
+
+def getScanHeaderTagList(initHeaderTag_list=None):
+    scanHeaderTag_list = set(groupingHeaderTag_list) | set(geometryHeaderTag_list) | set(pixelHeaderTag_list)
+    if initHeaderTag_list is not None: scanHeaderTag_list |= set(initHeaderTag_list)
+    return sorted(scanHeaderTag_list)
+
+
+def readDicomHeader(dicomFile, headerTag_list=None, force=False):
+    # Reads the header of dicomFile without its pixel data. If headerTag_list is given, parsing
+    # stops after the highest tag in the list and only the listed elements are kept, which avoids
+    # reading the bulk of the file for the many files whose full header is never needed
+    if headerTag_list is None:
+        return readDicomFile(dicomFile, defer_size=deferSize, stop_before_pixels=True, force=force)
+
+    headerTag_set = set(headerTag_list)
+    lastHeaderTag = max(headerTag_set)
+    def stopAfterLastHeaderTag(tag, VR, length):
+        return tag > lastHeaderTag
+
+    # Values of files inside archives cannot be read again by name, see readDicomFile
+    with openDicomFile(dicomFile) as fp:
+        dicomFileHeader = read_partial(fp, stop_when=stopAfterLastHeaderTag, defer_size=None if isArchiveMember(dicomFile) else deferSize, force=force)
+    for tag in list(dicomFileHeader.keys()):
+        if tag not in headerTag_set: del dicomFileHeader[tag]
+    return dicomFileHeader
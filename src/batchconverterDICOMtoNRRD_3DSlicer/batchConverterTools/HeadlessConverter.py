@@ -0,0 +1,530 @@
+from __future__ import print_function
+
+import os
+import glob
+import errno
+import argparse
+import collections
+import multiprocessing
+from datetime import datetime
+
+import SimpleITK as sitk
+
+from ArchiveReader import isArchive, getPatientDirName
+from FileDiscovery import DiscoveredFiles, addDiscoveryArguments, getDiscoverySettings
+from MetadataExtractor import getQueryPatientFiles, getPatientMemoryEstimates
+from MetadataStore import addMetadataStoreArguments, getMetadataStoreSettings
+from MemoryAdmission import addMemoryBudgetArguments, getMemoryBudgetSettings, getUnknownEstimate, getLargestFirst, admitImapUnordered
+from HeaderScanner import readDicomHeader
+from ScanIndex import ScanIndex
+from SeriesGrouping import groupDicomSeries
+from SeriesGeometry import checkSeriesGeometry
+from VolumeAssembly import assembleVolume, narrowImage, readSeriesImage
+from RTStructRasterizer import readRTStruct, getVolumeGeometry, rasterizeROIs, getReferencedVolume
+from SegmentationPacking import segmentationFormats_list, packLabelImages, writeSegmentationSidecar
+from ROIIndex import ContourFilterSet, tryReadROINames, buildROIIndex, getMatchingStudies, writeROIReport
+from OutputCompression import compressionModes_list, compressOutputFile, getCompressionLogLine, getWriterCompression
+from ConversionManifest import ConversionManifest, getInputFingerprint, getManifestEntry, getNodeManifestFileName
+from SeriesDedup import SeriesContentIndex, getDuplicateOutputs, getNodeContentIndexFileName, addDedupArguments, getDedupSettings
+from WorkQueue import addWorkQueueArguments, getWorkQueueSettings, isDistributed, getNodeWorkItems, boundedImapUnordered
+from RunLog import RunLog
+
+
+def makeDirectory(directory):
+    # Like the exists/mkdir checks of the converters, but safe when parallel workers create the same directory
+    try: os.mkdir(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST: raise
+
+
+def createDataHierarchy(outputPatientDir, patientID, studyDate, studyDescription):
+    # <output>/<PatientID>/<StudyDate>_<StudyDescription>/{Reconstructions,Segmentations,Resources}
+    outputPatientIDDir = str(os.path.join(outputPatientDir, patientID))
+    makeDirectory(outputPatientIDDir)
+
+    studyDateDirName = studyDate + '_' + studyDescription
+    studyDateDirName = ''.join(x for x in studyDateDirName if x not in "-',;\/:*?<>|")
+    outputStudyDateDir = str(os.path.join(outputPatientIDDir, studyDateDirName))
+    makeDirectory(outputStudyDateDir)
+
+    outputReconstructionsDir = os.path.join(outputStudyDateDir, 'Reconstructions')
+    outputSegmentationsDir = os.path.join(outputStudyDateDir, 'Segmentations')
+    outputResourcesDir = os.path.join(outputStudyDateDir, 'Resources')
+    for outputDir in [outputReconstructionsDir, outputSegmentationsDir, outputResourcesDir]: makeDirectory(outputDir)
+    return outputReconstructionsDir, outputSegmentationsDir, outputResourcesDir
+
+
+def getVolumeName(seriesHeader):
+    # Volume name given by the Slicer DICOM scalar volume plugin: '<SeriesNumber>: <SeriesDescription>'
+    seriesName = str(getattr(seriesHeader, 'SeriesDescription', '')).strip()
+    if seriesName == '': seriesName = 'Unnamed Series'
+    seriesNumber = str(getattr(seriesHeader, 'SeriesNumber', '')).strip()
+    if seriesNumber != '': seriesName = seriesNumber + ': ' + seriesName
+    return seriesName
+
+
+def getUniqueName(name, usedNames):
+    # Slicer makes node names unique within the scene by appending _1, _2, ...
+    uniqueName = name
+    suffix = 0
+    while uniqueName in usedNames:
+        suffix += 1
+        uniqueName = name + '_' + str(suffix)
+    usedNames.add(uniqueName)
+    return uniqueName
+
+
+def getContourFilterDict(contourFilterString):
+    # 'INCLUDE1,INCLUDE2:EXCLUDE1,EXCLUDE2' -> {'Include': [...], 'Exclude': [...]} as ContourFilterWidget.getContourFilterDict
+    includeKeywords, _, excludeKeywords = contourFilterString.partition(':')
+    return {'Include': [str(keyword.strip()) for keyword in includeKeywords.split(',') if keyword.strip()],
+            'Exclude': [str(keyword.strip()) for keyword in excludeKeywords.split(',') if keyword.strip()]}
+
+
+def centerImage(image):
+    # Same origin as vtkSlicerVolumesLogic.CenterVolume: the centre of the voxel grid is moved to (0,0,0)
+    direction = [image.GetDirection()[3 * i:3 * i + 3] for i in range(3)]
+    extent = [spacing * (size - 1) for spacing, size in zip(image.GetSpacing(), image.GetSize())]
+    image.SetOrigin([-0.5 * sum(direction[i][j] * extent[j] for j in range(3)) for i in range(3)])
+    return image
+
+
+class HeadlessBatchConverterLogic():
+    # Batch conversion with pydicom and SimpleITK that reproduces BatchConverterLogic without 3D Slicer:
+    # the same output hierarchy, patient ID inference, study naming, volume names, centering, file
+    # formats, manifest and log. Patient directories can be converted by a pool of processes
+
+    def __init__(self, inputPatientDir, outputPatientDir, contourFilters, converterSettings):
+        self.inputPatientDir = inputPatientDir
+        self.outputPatientDir = outputPatientDir
+        self.contourFilters = contourFilters
+        self.converterSettings = converterSettings
+        self.contourFilterSet = ContourFilterSet(contourFilters, convertAll=(converterSettings['convertcontours'] == 'All'))
+
+        logTime = str(datetime.now().strftime(('%Y-%m-%d--%H-%M')))
+        self.logFilePath = os.path.join(outputPatientDir, 'BatchConverterLog_' + logTime + '.jsonl')
+
+        # A patient entry is a directory or a zip or tar archive of one
+        self.PatientDirs = sorted(patDir for patDir in glob.glob(os.path.join(inputPatientDir, '*')) if (os.path.isdir(patDir) or isArchive(patDir)) and os.path.basename(patDir) != 'DatabaseDirectory')
+        self.manifest = ConversionManifest(outputPatientDir)
+        self.contentIndex = SeriesContentIndex(outputPatientDir) if converterSettings['dedup'] != 'off' else None
+        if isDistributed(converterSettings):
+            # Nodes sharing the output directory each write their own log, manifest and content index
+            self.logFilePath = os.path.join(outputPatientDir, 'BatchConverterLog_' + logTime + '_' + converterSettings['nodename'] + '.jsonl')
+            self.manifest = ConversionManifest(outputPatientDir, getNodeManifestFileName(converterSettings['nodename']))
+            if self.contentIndex is not None: self.contentIndex = SeriesContentIndex(outputPatientDir, getNodeContentIndexFileName(converterSettings['nodename']))
+
+    def createDataHierarchy(self, patientID, studyDate, studyDescription):
+        return createDataHierarchy(self.outputPatientDir, patientID, studyDate, studyDescription)
+
+    def getStudies(self, patientDir, runLog, selectedFiles=None):
+        # Groups the image series of a patient directory by patient and study like the Slicer DICOM database:
+        # {(PatientID, StudyInstanceUID): [(SeriesInstanceUID, series header, file dictionaries)]}, and the
+        # RTSTRUCT files in the same way: {(PatientID, StudyInstanceUID): [file paths]}. With selectedFiles
+        # only those files are scanned
+        patientDirName = getPatientDirName(patientDir)
+        # The discovery threads walk the patient directory while the files they found are scanned
+        discoveredFiles = DiscoveredFiles(patientDir, self.converterSettings['discoverythreads'], selectedFiles=selectedFiles)
+        scanIndex = None
+        if self.converterSettings['scanindex'] is not None:
+            scanIndex = ScanIndex(self.converterSettings['scanindex'])
+            scanIndex.preload(patientDir)
+        rtStructFiles_list = []
+        try:
+            with runLog.stage('scan', patient=patientDirName) as stageEvent:
+                dicomSeriesFileList_Dict = groupDicomSeries(discoveredFiles, scanMode=self.converterSettings['scanmode'], scanIndex=scanIndex, rtStructFiles_list=rtStructFiles_list)
+                stageEvent['numberseries'] = len(dicomSeriesFileList_Dict)
+                stageEvent['files'] = len(discoveredFiles.dicomFiles_list)
+                stageEvent['bytes'] = discoveredFiles.numberBytes
+        finally:
+            if scanIndex is not None: scanIndex.close()
+
+        studies_Dict = collections.OrderedDict()
+        with runLog.stage('group', patient=patientDirName):
+            for series, dicomFileDict_list in dicomSeriesFileList_Dict.items():
+                seriesHeader = readDicomHeader(dicomFileDict_list[0]['Filepath'], force=True)
+                # Only series with pixel data are loaded as volumes
+                if 'Rows' not in seriesHeader: continue
+                studyKey = (str(getattr(seriesHeader, 'PatientID', '')), str(getattr(seriesHeader, 'StudyInstanceUID', '')))
+                studies_Dict.setdefault(studyKey, []).append((series, seriesHeader, dicomFileDict_list))
+            rtStructs_Dict = {}
+            for rtStructFile in rtStructFiles_list:
+                rtStructHeader = readDicomHeader(rtStructFile, [1048608, 2097165], force=True)
+                studyKey = (str(getattr(rtStructHeader, 'PatientID', '')), str(getattr(rtStructHeader, 'StudyInstanceUID', '')))
+                rtStructs_Dict.setdefault(studyKey, []).append(rtStructFile)
+        return studies_Dict, rtStructs_Dict
+
+    def getVolumes(self, seriesList, patientDirName, runLog):
+        # Splits the series of a study into sorted volumes: [(SeriesInstanceUID, volume name, file dictionaries, file paths)]
+        volumes = []
+        for series, seriesHeader, dicomFileDict_list in seriesList:
+            seriesName = getVolumeName(seriesHeader)
+            with runLog.stage('group', patient=patientDirName, series=series):
+                seriesVolumes, geometryMessages = checkSeriesGeometry(dicomFileDict_list, self.converterSettings['geometrypolicy'])
+            for message in geometryMessages: runLog.message('GEOMETRY: ' + message, patient=patientDirName, series=series)
+            if not seriesVolumes:
+                runLog.message('IMAGEERROR: Series rejected: ' + series, patient=patientDirName, series=series)
+                continue
+            for volumeIndex, volumeFileDict_list in enumerate(seriesVolumes):
+                volumeName = seriesName if len(seriesVolumes) == 1 else seriesName + '_' + str(volumeIndex + 1)
+                fps = [dicomFileDict['Filepath'] for dicomFileDict in volumeFileDict_list]
+                volumes.append((series, volumeName, volumeFileDict_list, fps))
+        return volumes
+
+    def saveVolume(self, volumeName, volumeFileDict_list, fps, outputDir, patientDirName, series, runLog, dcmReader):
+        # Reads one volume and writes it as <volume name><fileformat>, compressed as configured; returns the output path
+        savename = ''.join(x for x in volumeName if x not in "',;\/:*?<>|") + self.converterSettings['fileformat']
+        savePath = os.path.join(outputDir, savename)
+        with runLog.stage('read', patient=patientDirName, series=series, files=len(fps)) as stageEvent:
+            # memmap assembly writes the volume while reading it; it does not move the origin, so centred
+            # images and NIfTI output go through the reader
+            stageEvent['assembly'] = 'sitk'
+            if (self.converterSettings['assembly'] == 'memmap' and self.converterSettings['fileformat'] == '.nrrd'
+                    and not self.converterSettings['centerimages'] and assembleVolume(volumeFileDict_list, savePath)):
+                stageEvent['assembly'] = 'memmap'
+            else:
+                image = narrowImage(readSeriesImage(dcmReader, volumeFileDict_list))
+                stageEvent['pixeltype'] = image.GetPixelIDTypeAsString()
+        if stageEvent['assembly'] == 'sitk':
+            if self.converterSettings['centerimages']: centerImage(image)
+            savePath, isWriterCompressed = getWriterCompression(savePath, self.converterSettings['compression'])
+            with runLog.stage('save', patient=patientDirName, series=series):
+                sitk.WriteImage(image, savePath, isWriterCompressed)
+            if isWriterCompressed: return savePath
+        return self.compressOutput(savePath, patientDirName, series, runLog)
+
+    def getDuplicateOutputs(self, series, volumeFileDict_list, outputDir, patientDirName, runLog):
+        # Outputs of an earlier copy of the volume and its content fingerprint; (None, fingerprint) if the volume
+        # has to be converted
+        if self.contentIndex is None: return None, None
+        with runLog.stage('dedup', patient=patientDirName, series=series):
+            outputPaths, contentFingerprint = getDuplicateOutputs(self.contentIndex, series, volumeFileDict_list, outputDir,
+                                                                  self.converterSettings['dedup'], self.converterSettings['deduppixeldigest'])
+        if outputPaths is not None:
+            runLog.message('DUPLICATE: Series already converted: ' + ', '.join(outputPaths) + ' (' + self.converterSettings['dedup'] + ')', patient=patientDirName, series=series)
+        return outputPaths, contentFingerprint
+
+    def compressOutput(self, savePath, patientDirName, series, runLog):
+        if self.converterSettings['compression'] != 'raw':
+            with runLog.stage('compress', patient=patientDirName, series=series):
+                savePath, compressionStatistics_dict = compressOutputFile(savePath, self.converterSettings['compression'], self.converterSettings['compressionlevel'], self.converterSettings['compressionthreads'])
+            runLog.message(getCompressionLogLine(savePath, compressionStatistics_dict), patient=patientDirName, series=series, **compressionStatistics_dict)
+        return savePath
+
+    def getLabelImage(self, labelmap, geometry):
+        # Label map on the grid of its reference volume, centred if configured
+        origin, directions, spacings, sizes = geometry
+        image = sitk.GetImageFromArray(labelmap)
+        image.SetOrigin([float(value) for value in origin])
+        image.SetSpacing([float(value) for value in spacings])
+        image.SetDirection([float(value) for value in directions.T.ravel()])
+        if self.converterSettings['centerlabels']: centerImage(image)
+        return image
+
+    def saveLabelImages(self, labelImages, outputDir, patientDirName, usedNames, runLog):
+        # Writes the label maps [(label name, image)] of a study as <label name><fileformat>, or packed into
+        # Segmentation<fileformat> or cropped as configured; returns the output paths
+        segmentationFormat = self.converterSettings['segmentationformat']
+        packedName = getUniqueName('Segmentation', usedNames) if segmentationFormat in ['multilabel', 'bitpacked'] else None
+        outputs, messages = packLabelImages(labelImages, segmentationFormat, packedName)
+        for message in messages: runLog.message(message, patient=patientDirName)
+        savedPaths = []
+        for outputName, image, segments in outputs:
+            savename = ''.join(x for x in outputName if x not in "',;\/:*?<>|") + self.converterSettings['fileformat']
+            savePath = os.path.join(outputDir, savename)
+            writePath, isWriterCompressed = getWriterCompression(savePath, self.converterSettings['compression'])
+            with runLog.stage('save', patient=patientDirName, volume=outputName):
+                sitk.WriteImage(image, writePath, isWriterCompressed)
+            # NIfTI has no key/value header for the label names
+            if segmentationFormat != 'perfile' and self.converterSettings['fileformat'] != '.nrrd':
+                savedPaths.append(writeSegmentationSidecar(savePath, segments))
+            savedPaths.append(writePath if isWriterCompressed else self.compressOutput(writePath, patientDirName, None, runLog))
+        return savedPaths
+
+    def convertContours(self, rtStructFiles_list, volumes, frameOfReferenceUIDs_dict, outputDir, patientDirName, usedNames, runLog):
+        # Rasterizes the ROIs of the RTSTRUCTs of a study that pass the contour filters onto their referenced
+        # volumes and saves them; returns the label map paths. The label maps are handed to saveLabelImages as
+        # they are rasterized, so packed formats never hold all of them at once
+        threads = max(1, multiprocessing.cpu_count() // self.converterSettings['processes'])
+        def getLabelImages():
+            for rtStructFile in rtStructFiles_list:
+                try:
+                    rtStruct_dict = readRTStruct(rtStructFile)
+                    rois = [roi for roi in rtStruct_dict['rois'] if self.contourFilterSet.match(roi[1])]
+                    if not rois: continue
+                    referencedVolume = getReferencedVolume(rtStruct_dict, volumes, frameOfReferenceUIDs_dict)
+                    if referencedVolume is None:
+                        for roi in rois: runLog.message('REFERENCEERROR: No reference volume found for contour: ' + roi[1], patient=patientDirName)
+                        continue
+                    for roi in rois:
+                        runLog.message('CONVERTING: Contour: ' + roi[1], patient=patientDirName)
+                        runLog.message('REFERENCED: Label: ' + roi[1] + ' Reference: ' + referencedVolume[1], patient=patientDirName)
+                    geometry = getVolumeGeometry(referencedVolume[2])
+                    for roiName, labelmap in rasterizeROIs(rois, geometry, threads):
+                        yield getUniqueName(roiName, usedNames), self.getLabelImage(labelmap, geometry)
+                except Exception as e:
+                    runLog.message('RTSTRUCTERROR: ' + rtStructFile + ': ' + str(e), patient=patientDirName)
+        try:
+            return self.saveLabelImages(getLabelImages(), outputDir, patientDirName, usedNames, runLog)
+        except Exception as e:
+            runLog.message('SAVEERROR: Could not save label maps: ' + str(e), patient=patientDirName)
+            return []
+
+    def convertPatient(self, index, patientDir, runLog, resumeManifest=None, selectedFiles=None):
+        # Converts the studies of one patient directory, or of selectedFiles in it; returns the manifest entries
+        # of its series and the content index entries of the volumes it converted
+        patientDirName = getPatientDirName(patientDir)
+        manifestEntries_dict = {}
+        contentEntries_dict = {}
+        runLog.message('PROCESSING: ' + patientDirName, patient=patientDirName)
+        studies_Dict, rtStructs_Dict = self.getStudies(patientDir, runLog, selectedFiles)
+        if not studies_Dict:
+            runLog.message('PATIENTERROR: No new patients added to database from directory: ' + patientDirName, patient=patientDirName)
+            return manifestEntries_dict, contentEntries_dict
+
+        dcmReader = sitk.ImageSeriesReader()
+        usedNames = set()
+        for (studyPatientID, study), seriesList in studies_Dict.items():
+            if self.converterSettings['convertcontours'] == 'Select':
+                roiNames = []
+                for rtStructFile in rtStructs_Dict.get((studyPatientID, study), []):
+                    roiNamesEntry = tryReadROINames(rtStructFile, runLog, patient=patientDirName, study=study)
+                    if roiNamesEntry is not None: roiNames.extend(roiNamesEntry[2])
+                if not self.contourFilterSet.matchAny(roiNames):
+                    runLog.message('SKIPPED: No contours match the contour filters: ' + study + ' for Patient: ' + patientDirName, patient=patientDirName, study=study)
+                    continue
+            seriesFingerprints = {}
+            for series, seriesHeader, dicomFileDict_list in seriesList:
+                seriesFingerprints[series] = getInputFingerprint([dicomFileDict['Filepath'] for dicomFileDict in dicomFileDict_list])
+            if resumeManifest is not None and all(resumeManifest.isComplete(series, seriesFingerprints[series]) for series in seriesFingerprints):
+                runLog.message('SKIPPED: Study already converted: ' + study + ' for Patient: ' + patientDirName, patient=patientDirName, study=study)
+                continue
+
+            # Establish current patient ID, study date and study description from the first series of the study
+            firstSeriesHeader = seriesList[0][1]
+            if self.converterSettings['inferpatientid'] == 'metadata': patientID = studyPatientID
+            else: patientID = patientDirName
+            if patientID == '': patientID = 'Unknown_' + str(index)
+            studyDate = str(getattr(firstSeriesHeader, 'StudyDate', ''))
+            studyDescription = str(getattr(firstSeriesHeader, 'StudyDescription', ''))
+            reconstructionsDir, segmentationsDir, resourcesDir = self.createDataHierarchy(patientID, studyDate, studyDescription)
+
+            imagePaths = []
+            volumes = self.getVolumes(seriesList, patientDirName, runLog)
+            for series, volumeName, volumeFileDict_list, fps in volumes:
+                uniqueName = getUniqueName(volumeName, usedNames)
+                try:
+                    duplicatePaths, contentFingerprint = self.getDuplicateOutputs(series, volumeFileDict_list, reconstructionsDir, patientDirName, runLog)
+                    if duplicatePaths is not None:
+                        imagePaths.extend(duplicatePaths)
+                        continue
+                    imagePaths.append(self.saveVolume(uniqueName, volumeFileDict_list, fps, reconstructionsDir, patientDirName, series, runLog, dcmReader))
+                    if contentFingerprint is not None:
+                        # Later copies in this worker see the entry at once, the other workers from the next run on
+                        self.contentIndex.record(contentFingerprint, series, imagePaths[-1:])
+                        contentEntries_dict[contentFingerprint] = self.contentIndex.contentEntries_dict[contentFingerprint]
+                except Exception as e:
+                    runLog.message('SAVEERROR: Could not save data' + uniqueName + ': ' + str(e), patient=patientDirName, series=series)
+            if not volumes:
+                runLog.message('IMAGEERROR: could not Parse Images: ' + patientDirName + ', study: ' + studyDate, patient=patientDirName, study=study)
+
+            labelPaths = []
+            if self.converterSettings['convertcontours'] != 'None' or self.contourFilters:
+                frameOfReferenceUIDs_dict = dict((series, str(getattr(seriesHeader, 'FrameOfReferenceUID', ''))) for series, seriesHeader, dicomFileDict_list in seriesList)
+                with runLog.stage('contours', patient=patientDirName, study=study):
+                    labelPaths = self.convertContours(rtStructs_Dict.get((studyPatientID, study), []), volumes, frameOfReferenceUIDs_dict, segmentationsDir, patientDirName, usedNames, runLog)
+                if not labelPaths:
+                    runLog.message('RTSTRUCTERROR: could not Parse RTSTRUCTs: ' + patientDirName + ', study: ' + studyDate, patient=patientDirName, study=study)
+
+            # A study is only complete if every volume was saved
+            if volumes and len(imagePaths) == len(volumes): status = 'complete'
+            else: status = 'failed'
+            for series in seriesFingerprints:
+                manifestEntries_dict[series] = getManifestEntry(seriesFingerprints[series], imagePaths + labelPaths, status)
+        return manifestEntries_dict, contentEntries_dict
+
+    def batchConvert(self):
+        # Only this process writes the log and the manifest; workers return their events and entries per patient
+        runLog = RunLog(self.logFilePath)
+        resumeManifestDir = self.outputPatientDir if self.converterSettings['resume'] else None
+        # Patient indices stay those of the full input directory so that every node names outputs alike
+        nodePatientDirs, workQueue = getNodeWorkItems(self.PatientDirs, self.converterSettings)
+        nodePatientDirs = set(nodePatientDirs)
+        tasks = [(index, patientDir) for index, patientDir in enumerate(self.PatientDirs) if patientDir in nodePatientDirs]
+        if self.converterSettings['convertcontours'] == 'Select':
+            # Patient directories without a study with a matching ROI are never scanned or loaded
+            with runLog.stage('discover') as stageEvent:
+                roiIndex_Dict = buildROIIndex(sorted(nodePatientDirs), self.converterSettings['discoverythreads'], runLog)
+                matchingStudies_Dict = getMatchingStudies(roiIndex_Dict, self.contourFilterSet)
+                stageEvent['patients'] = len(matchingStudies_Dict)
+            reportName = 'ROIFilterReport.csv' if not isDistributed(self.converterSettings) else 'ROIFilterReport_' + self.converterSettings['nodename'] + '.csv'
+            writeROIReport(roiIndex_Dict, self.contourFilterSet, os.path.join(self.outputPatientDir, reportName))
+            for patientDir in nodePatientDirs:
+                if patientDir not in matchingStudies_Dict:
+                    runLog.message('SKIPPED: No contours match the contour filters: ' + getPatientDirName(patientDir), patient=getPatientDirName(patientDir))
+            nodePatientDirs = set(matchingStudies_Dict)
+            tasks = [task for task in tasks if task[1] in nodePatientDirs]
+        queryPatientFiles_Dict = {}
+        if self.converterSettings['seriesquery']:
+            # Only the files of the series matching the query, and the RTSTRUCTs of their patients when contours
+            # are converted, are scanned; the metadata store lists them
+            with runLog.stage('discover') as stageEvent:
+                queryPatientFiles_Dict = getQueryPatientFiles(self.inputPatientDir, self.converterSettings, includeRTStructs=(self.converterSettings['convertcontours'] != 'None'), runLog=runLog)
+                stageEvent['patients'] = len(queryPatientFiles_Dict)
+            for patientDir in nodePatientDirs:
+                if patientDir not in queryPatientFiles_Dict:
+                    runLog.message('SKIPPED: No series match the series query: ' + getPatientDirName(patientDir), patient=getPatientDirName(patientDir))
+            nodePatientDirs = nodePatientDirs & set(queryPatientFiles_Dict)
+            tasks = [task for task in tasks if task[1] in nodePatientDirs]
+        tasks = [(index, patientDir, queryPatientFiles_Dict.get(patientDir)) for index, patientDir in tasks]
+        processes = self.converterSettings['processes']
+        memoryBudget = self.converterSettings['memorybudget'] if processes > 1 else 0
+        if memoryBudget > 0:
+            # Patients are started largest first, and only while their estimated peak memory fits in the budget
+            with runLog.stage('estimate') as stageEvent:
+                patientEstimates_dict = getPatientMemoryEstimates(self.inputPatientDir, self.converterSettings, runLog)
+                stageEvent['patients'] = len(patientEstimates_dict)
+            unknownEstimate = getUnknownEstimate(patientEstimates_dict, memoryBudget)
+            numberUnknown = sum(1 for task in tasks if task[1] not in patientEstimates_dict)
+            if numberUnknown: runLog.message('ESTIMATE: No memory estimate for ' + str(numberUnknown) + ' patients, each counted as ' + '%.0f MB' % (unknownEstimate / float(1 << 20)))
+            getTaskBytes = lambda task: patientEstimates_dict.get(task[1], unknownEstimate)
+            tasks = getLargestFirst(tasks, getTaskBytes)
+        if self.converterSettings['dryrun']:
+            return runLog.close()
+        if workQueue is not None:
+            # Claimed one at a time as workers become free
+            tasks = workQueue.claimItems(tasks, lambda task: task[1])
+            workQueue.start()
+        if processes <= 1:
+            initWorker(self.inputPatientDir, self.outputPatientDir, self.contourFilters, self.converterSettings, resumeManifestDir)
+            results = (convertPatientTask(task) for task in tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(processes, initializer=initWorker,
+                initargs=(self.inputPatientDir, self.outputPatientDir, self.contourFilters, self.converterSettings, resumeManifestDir))
+            if memoryBudget > 0: results = admitImapUnordered(pool, convertPatientTask, tasks, getTaskBytes, memoryBudget, processes, getFailedTaskResult)
+            elif workQueue is not None: results = boundedImapUnordered(pool, convertPatientTask, tasks, processes, getFailedTaskResult)
+            else: results = pool.imap_unordered(convertPatientTask, tasks)
+
+        try:
+            for ind, (patientDir, succeeded, events, manifestEntries_dict, contentEntries_dict) in enumerate(results):
+                runLog.addEvents(events)
+                runLog.flush()
+                self.manifest.update(manifestEntries_dict)
+                self.manifest.save()
+                if self.contentIndex is not None and contentEntries_dict:
+                    self.contentIndex.update(contentEntries_dict)
+                    self.contentIndex.save()
+                if workQueue is not None:
+                    # A patient that failed as a whole is released rather than marked done, so another node retries it
+                    if succeeded: workQueue.complete(patientDir)
+                    else: workQueue.release(patientDir)
+                print('Converted:', getPatientDirName(patientDir), '------', ind + 1, 'out of', len(nodePatientDirs))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if workQueue is not None: workQueue.stop()
+            summary_dict = runLog.close()
+        return summary_dict
+
+
+# Converter of each worker process, created once by initWorker
+workerLogic = None
+workerResumeManifest = None
+
+
+def initWorker(inputPatientDir, outputPatientDir, contourFilters, converterSettings, resumeManifestDir=None):
+    global workerLogic, workerResumeManifest
+    workerLogic = HeadlessBatchConverterLogic(inputPatientDir, outputPatientDir, contourFilters, converterSettings)
+    workerResumeManifest = ConversionManifest(resumeManifestDir) if resumeManifestDir is not None else None
+    if converterSettings['processes'] > 1:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(max(1, multiprocessing.cpu_count() // converterSettings['processes']))
+
+
+def convertPatientTask(task):
+    index, patientDir, selectedFiles = task
+    runLog = RunLog()
+    succeeded = True
+    try:
+        manifestEntries_dict, contentEntries_dict = workerLogic.convertPatient(index, patientDir, runLog, workerResumeManifest, selectedFiles)
+    except Exception as e:
+        runLog.message('PATIENTERROR: ' + getPatientDirName(patientDir) + ': ' + str(e), patient=getPatientDirName(patientDir))
+        manifestEntries_dict, contentEntries_dict = {}, {}
+        succeeded = False
+    return patientDir, succeeded, runLog.events, manifestEntries_dict, contentEntries_dict
+
+
+def getFailedTaskResult(task, message):
+    # Result of a patient whose task raised outside convertPatient or whose worker process died, so that it is
+    # logged and its claim released like a patient that failed
+    patientDir = task[1]
+    runLog = RunLog()
+    runLog.message('PATIENTERROR: ' + getPatientDirName(patientDir) + ': ' + message, patient=getPatientDirName(patientDir))
+    return patientDir, False, runLog.events, {}, {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch convert DICOM studies to NRRD or NIfTI without 3D Slicer')
+    parser.add_argument('inputPatientDir', help='Input directory containing one subdirectory per patient')
+    parser.add_argument('outputPatientDir', help='Output directory for the converted data hierarchy')
+    parser.add_argument('--file-format', choices=['.nrrd', '.nii'], default='.nrrd', help='Output file format (default: .nrrd)')
+    parser.add_argument('--infer-patient-id', choices=['metadata', 'inputdir'], default='metadata', help='Take patient IDs from the DICOM metadata or the input patient subdirectory names (default: metadata)')
+    parser.add_argument('--center-images', action='store_true', help='Move the centre of every image to the origin')
+    parser.add_argument('--center-labels', action='store_true', help='Move the centre of every label map to the origin')
+    parser.add_argument('--resume', action='store_true', help='Skip studies recorded as converted in the output manifest whose input files are unchanged')
+    parser.add_argument('--compression', choices=compressionModes_list, default='gzip', help='Output compression (default: gzip)')
+    parser.add_argument('--compression-level', type=int, default=6, choices=range(1, 10), help='gzip compression level of parallelgzip and of memmap-assembled volumes; gzip files written by the image writer use its default level (default: 6)')
+    parser.add_argument('--compression-threads', type=int, default=None, help='Threads per process for parallelgzip (default: cores / processes)')
+    parser.add_argument('--processes', type=int, default=1, help='Number of patient directories converted in parallel (default: 1)')
+    parser.add_argument('--scan-mode', choices=['header', 'full'], default='header', help='Read only the grouping tags of each file (header) or every complete file (full)')
+    parser.add_argument('--scan-index', default=None, help='SQLite scan index; files unchanged since the last run are not parsed again')
+    parser.add_argument('--geometry-policy', choices=['split', 'reject'], default='split', help='Split series with repeated positions, gaps or mixed orientations into several volumes, or reject them')
+    parser.add_argument('--assembly', choices=['sitk', 'memmap'], default='sitk', help='Load series with ImageSeriesReader (sitk) or write slices one at a time into a memory-mapped NRRD (memmap)')
+    parser.add_argument('--convert-contours', choices=['None', 'All', 'Select'], default='None', help='Convert no RTSTRUCT contours, all of them, or those matching --contour-filter (default: None)')
+    parser.add_argument('--contour-filter', action='append', default=[], help='INCLUDE1,INCLUDE2:EXCLUDE1,EXCLUDE2 keywords of the contour names to convert; may be repeated')
+    parser.add_argument('--segmentation-format', choices=segmentationFormats_list, default='perfile', help='One label map per ROI (perfile), all ROIs of a study in one multi-label or bit-packed file, or per ROI cropped to its bounding box (default: perfile)')
+    parser.add_argument('--dry-run', action='store_true', help='Only write ROIFilterReport.csv listing the ROIs of every patient that match the contour filters')
+    addDiscoveryArguments(parser)
+    addMetadataStoreArguments(parser)
+    addMemoryBudgetArguments(parser)
+    addDedupArguments(parser)
+    addWorkQueueArguments(parser)
+    args = parser.parse_args(argv)
+
+    converterSettings = {}
+    converterSettings['convertcontours'] = args.convert_contours
+    if args.convert_contours == 'None' and args.contour_filter: converterSettings['convertcontours'] = 'Select'
+    converterSettings['dryrun'] = args.dry_run
+    converterSettings['segmentationformat'] = args.segmentation_format
+    converterSettings['fileformat'] = args.file_format
+    converterSettings['inferpatientid'] = args.infer_patient_id
+    converterSettings['centerimages'] = args.center_images
+    converterSettings['centerlabels'] = args.center_labels
+    converterSettings['resume'] = args.resume
+    converterSettings['compression'] = args.compression
+    converterSettings['compressionlevel'] = args.compression_level
+    converterSettings['compressionthreads'] = args.compression_threads
+    converterSettings['processes'] = args.processes
+    converterSettings['scanmode'] = args.scan_mode
+    converterSettings['scanindex'] = args.scan_index
+    converterSettings['geometrypolicy'] = args.geometry_policy
+    converterSettings['assembly'] = args.assembly
+    converterSettings.update(getDiscoverySettings(args))
+    converterSettings.update(getMetadataStoreSettings(args))
+    converterSettings.update(getMemoryBudgetSettings(args))
+    converterSettings.update(getDedupSettings(args))
+    converterSettings.update(getWorkQueueSettings(args))
+    if args.processes > 1 and args.compression_threads is None:
+        converterSettings['compressionthreads'] = max(1, multiprocessing.cpu_count() // args.processes)
+
+    if not os.path.exists(args.outputPatientDir): os.makedirs(args.outputPatientDir)
+    contourFilters = [getContourFilterDict(contourFilterString) for contourFilterString in args.contour_filter] if converterSettings['convertcontours'] == 'Select' else []
+    converterLogic = HeadlessBatchConverterLogic(args.inputPatientDir, args.outputPatientDir, contourFilters, converterSettings)
+    summary_dict = converterLogic.batchConvert()
+    for slowest in summary_dict.get('slowestpatient', [])[:5]:
+        print('Slowest patient:', slowest['patient'], '------', '%.2f s' % slowest['wall'])
+
+
+if __name__ == "__main__":
+    main()
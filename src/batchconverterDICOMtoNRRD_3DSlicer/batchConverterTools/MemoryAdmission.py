@@ -0,0 +1,78 @@
+from WorkQueue import PendingTasks
+
+# Tags the memory estimate of a series is computed from
+estimateHeaderTag_list = [2621442,2621448,2621456,2621457,2621696]
+#2621442: Samples per Pixel
+#2621448: Number of Frames
+#2621456: Rows
+#2621457: Columns
+#2621696: Bits Allocated
+
+
+def addMemoryBudgetArguments(parser):
+    parser.add_argument('--memory-budget', type=float, default=0, help='MB of estimated peak memory of the patients converted at the same time; patients are started largest first and only while their estimates fit. 0 starts every patient as soon as a process is free (default: 0)')
+
+
+def getMemoryBudgetSettings(args):
+    return {'memorybudget': int(args.memory_budget * (1 << 20))}
+
+
+def getSeriesMemoryEstimate(rows, columns, bitsAllocated, numberFiles, samplesPerPixel=1, numberFrames=1):
+    # Peak bytes of converting a series: per voxel its stored values, the float image ImageSeriesReader
+    # returns after rescaling and the narrowed copy that is written
+    bytesPerVoxel = (int(bitsAllocated) + 7) // 8 * int(samplesPerPixel)
+    numberVoxels = int(rows) * int(columns) * int(numberFiles) * max(1, int(numberFrames))
+    return numberVoxels * (2 * bytesPerVoxel + 4 * int(samplesPerPixel))
+
+
+def getSeriesMemoryEstimates(seriesValues_dict):
+    # {SeriesInstanceUID: estimated peak bytes} from {SeriesInstanceUID: {tag: number, 'FileCount': count}};
+    # series without Rows, Columns or BitsAllocated are left out
+    seriesEstimates_dict = {}
+    for seriesInstanceUID, values_dict in seriesValues_dict.items():
+        try: seriesEstimates_dict[seriesInstanceUID] = getSeriesMemoryEstimate(values_dict[2621456], values_dict[2621457], values_dict[2621696], values_dict['FileCount'],
+                                                                               values_dict.get(2621442, 1), values_dict.get(2621448, 1))
+        except KeyError: continue
+    return seriesEstimates_dict
+
+
+def getUnknownEstimate(patientEstimates_dict, memoryBudget):
+    # Estimate counted for a patient without one: the largest estimate of the others, or the whole budget when
+    # none has one, so that such patients are run alone rather than admitted as if they took no memory
+    return max(patientEstimates_dict.values()) if patientEstimates_dict else memoryBudget
+
+
+def getLargestFirst(tasks, getTaskBytes):
+    # Tasks ordered by decreasing estimate, keeping the order of tasks with equal estimates; started in this order,
+    # the largest patients do not end up running alone at the end of a run
+    return sorted(tasks, key=lambda task: -getTaskBytes(task))
+
+
+def admitImapUnordered(pool, function, tasks, getTaskBytes, memoryBudget, maxPending, getFailedResult=None):
+    # Like boundedImapUnordered, but takes the next task from the iterable only while the estimates of the
+    # running tasks and of the next one fit in memoryBudget. A task is started in any case when nothing is
+    # running, so a patient larger than the budget is converted alone
+    pendingTasks = PendingTasks(pool, function, getFailedResult)
+    pendingBytes_dict = {}
+    heldBytes = 0
+    tasks = iter(tasks)
+    nextTask = None
+    exhausted = False
+    while True:
+        while not exhausted and pendingTasks.getRunningCount() < maxPending:
+            if nextTask is None:
+                try: nextTask = (next(tasks),)
+                except StopIteration:
+                    exhausted = True
+                    break
+            taskBytes = getTaskBytes(nextTask[0])
+            if pendingBytes_dict and heldBytes + taskBytes > memoryBudget: break
+            # Results are matched to their task by key, as patients complete out of order
+            resultKey = pendingTasks.submit(nextTask[0])
+            pendingBytes_dict[resultKey] = taskBytes
+            heldBytes += taskBytes
+            nextTask = None
+        if not pendingTasks: return
+        resultKey, result = pendingTasks.getNext()
+        heldBytes -= pendingBytes_dict.pop(resultKey)
+        yield result
@@ -0,0 +1,121 @@
+import csv
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class DicomMetadataExporter:
+    # Writes one row per series from the sparse header dictionaries of DicomHeaderParser. A first pass
+    # collects the tags that occur in any series, a second pass writes the rows one at a time, so the
+    # cost depends on the tags actually present rather than on the size of the DICOM dictionary
+
+    def __init__(self, headerTagsNames_dict, initHeaderTag_list, dicomSeriesInstanceUIDs_fileCounter=None, batchSize=1000):
+        self.headerTagsNames_dict = headerTagsNames_dict
+        self.initHeaderTag_list = initHeaderTag_list
+        self.dicomSeriesInstanceUIDs_fileCounter = dicomSeriesInstanceUIDs_fileCounter
+        self.batchSize = batchSize
+
+    def spillDicomFileDicts(self, dicomFileDict_iterable):
+        # Lists can be traversed twice; any other iterable is spilled to a temporary file during the first pass
+        if isinstance(dicomFileDict_iterable, list): return dicomFileDict_iterable, self.getHeaderTags(dicomFileDict_iterable)
+
+        spillFile = tempfile.TemporaryFile()
+        def spilledDicomFileDicts(dicomFileDict_iterable):
+            for dicomFileDict in dicomFileDict_iterable:
+                pickle.dump(dicomFileDict, spillFile, 2)
+                yield dicomFileDict
+        headerTag_list = self.getHeaderTags(spilledDicomFileDicts(dicomFileDict_iterable))
+
+        def readSpilledDicomFileDicts():
+            spillFile.seek(0)
+            try:
+                while True: yield pickle.load(spillFile)
+            except EOFError:
+                spillFile.close()
+        return readSpilledDicomFileDicts(), headerTag_list
+
+    def getHeaderTags(self, dicomFileDict_iterable):
+        # Returns the tags after initHeaderTag_list that have a value in at least one series, in tag order.
+        # The initial tags are only exported if there is at least one series
+        presentHeaderTag_set = set()
+        numberSeries = 0
+        for dicomFileDict in dicomFileDict_iterable:
+            numberSeries += 1
+            presentHeaderTag_set.update(tag for tag,value in dicomFileDict.items() if tag in self.headerTagsNames_dict and str(value).replace(',',''))
+
+        presentHeaderTag_set.difference_update(self.initHeaderTag_list)
+        headerTag_list = sorted(presentHeaderTag_set)
+        if numberSeries > 0: headerTag_list = list(self.initHeaderTag_list) + headerTag_list
+        return headerTag_list
+
+    def getHeaderRow(self, headerTag_list):
+        headerRow = [str(self.headerTagsNames_dict[headerTag]) for headerTag in headerTag_list]
+        if self.dicomSeriesInstanceUIDs_fileCounter: headerRow = ['FileCount'] + headerRow
+        return headerRow
+
+    def getRow(self, dicomFileDict, headerTag_list):
+        row = []
+        if self.dicomSeriesInstanceUIDs_fileCounter:
+            try: fileCountValue = str(self.dicomSeriesInstanceUIDs_fileCounter[str(dicomFileDict[2097166])])
+            except KeyError: fileCountValue = str('Unknown')
+            row.append(fileCountValue.replace(',',''))
+
+        for headerTag in headerTag_list:
+            try: dicomFileTagValue = str(dicomFileDict[headerTag])
+            except KeyError: dicomFileTagValue = ''
+            if not dicomFileTagValue and headerTag in self.initHeaderTag_list:
+                dicomFileTagValue = self.headerTagsNames_dict[headerTag] + ' Not Found'
+            row.append(dicomFileTagValue.replace(',',''))
+        return row
+
+    def getRows(self, dicomFileDict_iterable):
+        # Yields the header row followed by one row per series
+        dicomFileDict_iterable, headerTag_list = self.spillDicomFileDicts(dicomFileDict_iterable)
+        headerRow = self.getHeaderRow(headerTag_list)
+        if not headerRow: return
+        yield headerRow
+        for dicomFileDict in dicomFileDict_iterable:
+            yield self.getRow(dicomFileDict, headerTag_list)
+
+    def WriteToCSVFile(self, dicomFileDict_iterable, outputCSVFile):
+        with open(outputCSVFile, 'wb') as csvf:
+            writer = csv.writer(csvf)
+            for row in self.getRows(dicomFileDict_iterable):
+                writer.writerow(row)
+
+    def WriteToColumnarFile(self, dicomFileDict_iterable, outputFile, fileFormat='parquet'):
+        # Writes the same table as WriteToCSVFile as Parquet or Feather (Arrow IPC) in batches of rows.
+        # Requires pyarrow
+        import pyarrow
+        rows = self.getRows(dicomFileDict_iterable)
+        headerRow = next(rows, None)
+        if headerRow is None: return
+        schema = pyarrow.schema([pyarrow.field(headerName, pyarrow.string()) for headerName in headerRow])
+
+        if fileFormat == 'parquet':
+            import pyarrow.parquet
+            writer = pyarrow.parquet.ParquetWriter(outputFile, schema)
+            writeBatch = lambda batch: writer.write_table(pyarrow.Table.from_batches([batch]))
+        elif fileFormat == 'feather':
+            writer = pyarrow.RecordBatchFileWriter(outputFile, schema)
+            writeBatch = writer.write_batch
+        else:
+            raise ValueError('Unknown columnar file format: ' + str(fileFormat))
+
+        try:
+            batchRows = []
+            for row in rows:
+                batchRows.append(row)
+                if len(batchRows) >= self.batchSize:
+                    writeBatch(self.getRecordBatch(batchRows, schema))
+                    batchRows = []
+            if batchRows: writeBatch(self.getRecordBatch(batchRows, schema))
+        finally:
+            writer.close()
+
+    def getRecordBatch(self, batchRows, schema):
+        import pyarrow
+        columns = [pyarrow.array(list(column), type=pyarrow.string()) for column in zip(*batchRows)]
+        return pyarrow.RecordBatch.from_arrays(columns, schema.names)
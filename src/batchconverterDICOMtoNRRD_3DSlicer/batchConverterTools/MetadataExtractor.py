@@ -1,13 +1,199 @@
 import os
-import fnmatch
+import glob
 import dicom
 import csv
+import itertools
 import collections
+import multiprocessing
+
+from ArchiveReader import isArchive, readDicomFile, getPatientDirName
+from FileDiscovery import discoveryThreads, discoverDicomFilesList, DiscoveredFiles
+from HeaderScanner import readDicomHeader, getScanHeaderTagList
+from HeaderRecord import getHeaderRecord
+from ScanIndex import ScanIndex
+from ConversionManifest import getInputFingerprint
+from MetadataExporter import DicomMetadataExporter
+from MetadataStore import MetadataStore, getMetadataStorePath, metadataStoreVersion
+from MemoryAdmission import estimateHeaderTag_list, getSeriesMemoryEstimates
+
+# Files parsed by one task of a parallel header parser
+parserChunkSize = 1000
+# (store path, input directory) of the metadata stores this process brought up to date with openMetadataStore
+refreshedMetadataStores_set = set()
+
+
+def getFileChunks(dicomFiles_list, chunkSize=parserChunkSize):
+    # Consecutive runs of chunkSize files; dicomFiles_list may be a generator, which is consumed as the chunks are taken
+    dicomFiles_iterator = iter(dicomFiles_list)
+    while True:
+        chunk = list(itertools.islice(dicomFiles_iterator, chunkSize))
+        if not chunk: return
+        yield chunk
+
+
+def parseDicomFileChunk(dicomFiles_list, scanMode, scanHeaderTag_list, scanIndex=None):
+    # Parses a run of consecutive files: returns the series in order of first appearance with the header
+    # dictionary of their first file (None for RTSTRUCTs), [(SeriesInstanceUID, dictionary)], and the files
+    # of every series, {SeriesInstanceUID: [file paths]}. Results of consecutive chunks of a file list merged
+    # in order with mergeSeriesRecords equal the result for the whole list
+    seriesRecords_list = []
+    seriesFiles_dict = {}
+    for dicomFile in dicomFiles_list:
+        indexEntry = None
+        if scanIndex is not None: indexEntry = scanIndex.lookup(dicomFile)
+        if indexEntry is not None:
+            seriesInstanceUID, dicomFileDict, isFullHeader = indexEntry
+            if seriesInstanceUID in seriesFiles_dict:
+                seriesFiles_dict[seriesInstanceUID].append(dicomFile)
+                continue
+            elif isFullHeader:
+                seriesFiles_dict[seriesInstanceUID] = [dicomFile]
+                if dicomFileDict[524384] == 'RTSTRUCT': seriesRecords_list.append((seriesInstanceUID, None))
+                else: seriesRecords_list.append((seriesInstanceUID, dicomFileDict))
+                continue
+
+        if scanMode == 'header':
+            # Only the first file of each series needs its full header
+            dicomFileHeader = readDicomHeader(dicomFile, scanHeaderTag_list)
+            seriesInstanceUID = str(dicomFileHeader[2097166].value)
+            if seriesInstanceUID in seriesFiles_dict:
+                seriesFiles_dict[seriesInstanceUID].append(dicomFile)
+                # The converters reuse index entries as the header values of the file, so the entry holds the
+                # scan tags that were read rather than nothing
+                if scanIndex is not None: scanIndex.update(dicomFile, seriesInstanceUID, getHeaderRecord(dicomFileHeader))
+                continue
+            dicomFileHeader = readDicomHeader(dicomFile)
+        else:
+            dicomFileHeader = readDicomFile(dicomFile)
+        seriesInstanceUID = str(dicomFileHeader[2097166].value)
+        if seriesInstanceUID in seriesFiles_dict:
+            seriesFiles_dict[seriesInstanceUID].append(dicomFile)
+            if scanIndex is not None: scanIndex.update(dicomFile, seriesInstanceUID, getHeaderRecord(dicomFileHeader), isFullHeader=True)
+            continue
+        else:
+            seriesFiles_dict[seriesInstanceUID] = [dicomFile]
+            dicomFileDict = getHeaderRecord(dicomFileHeader)
+            if scanIndex is not None: scanIndex.update(dicomFile, seriesInstanceUID, dicomFileDict, isFullHeader=True)
+            if dicomFileDict[524384] == 'RTSTRUCT': seriesRecords_list.append((seriesInstanceUID, None))
+            else: seriesRecords_list.append((seriesInstanceUID, dicomFileDict))
+    return seriesRecords_list, seriesFiles_dict
+
+
+def parseDicomFileChunkTask(task):
+    # Runs in a worker process, with its own connection to the scan index
+    dicomFiles_list, scanMode, scanHeaderTag_list, scanIndexPath = task
+    scanIndex = ScanIndex(scanIndexPath) if scanIndexPath is not None else None
+    try:
+        return parseDicomFileChunk(dicomFiles_list, scanMode, scanHeaderTag_list, scanIndex)
+    finally:
+        if scanIndex is not None: scanIndex.close()
+
+
+def mergeSeriesRecords(dicomFileDict_list, dicomSeriesInstanceUIDs_fileCounter, dicomSeriesFiles_dict, seriesRecords_list, seriesFiles_dict):
+    # Adds the result of the next chunk: a series seen in an earlier chunk only adds its files and file count,
+    # a new one also its header dictionary, in the place the serial parser would have appended it
+    for seriesInstanceUID, dicomFileDict in seriesRecords_list:
+        if seriesInstanceUID in dicomSeriesInstanceUIDs_fileCounter: continue
+        dicomSeriesInstanceUIDs_fileCounter[seriesInstanceUID] = 0
+        dicomSeriesFiles_dict[seriesInstanceUID] = []
+        if dicomFileDict is not None: dicomFileDict_list.append(dicomFileDict)
+    for seriesInstanceUID, seriesFiles in seriesFiles_dict.items():
+        dicomSeriesInstanceUIDs_fileCounter[seriesInstanceUID] += len(seriesFiles)
+        dicomSeriesFiles_dict[seriesInstanceUID].extend(seriesFiles)
+
+
+def getPatientEntryFingerprint(patientEntry, threads=discoveryThreads):
+    # Fingerprint of the paths, sizes and modification times of the files of a patient directory, or of a patient
+    # archive itself
+    if isArchive(patientEntry): return getInputFingerprint([patientEntry])
+    return getInputFingerprint(discoverDicomFilesList(patientEntry, threads, sniff=False))
+
+
+def openMetadataStore(inputDir, converterSettings, runLog=None):
+    # Metadata store of converterSettings for inputDir. A metadata store that does not exist yet, or was
+    # written by an older version, is built by parsing inputDir once. Of an existing store, the patient entries
+    # of inputDir that are not in it or whose files changed since they were scanned are parsed again, and
+    # those no longer in inputDir removed, so the store lists what the converters will find. This is done once
+    # per process
+    storePath = converterSettings['metadatastore'] if converterSettings['metadatastore'] is not None else getMetadataStorePath(inputDir)
+    refreshKey = (os.path.abspath(storePath), os.path.abspath(inputDir))
+    if refreshKey in refreshedMetadataStores_set and os.path.exists(storePath): return MetadataStore(storePath)
+    if os.path.exists(storePath):
+        metadataStore = MetadataStore(storePath)
+        storeVersion = metadataStore.version
+        metadataStore.close()
+        if storeVersion < metadataStoreVersion: os.remove(storePath)
+    # Taken before parsing, so files that change while they are parsed are parsed again next time
+    patientEntries = sorted(patientEntry for patientEntry in glob.glob(os.path.join(inputDir, '*')) if os.path.isdir(patientEntry) or isArchive(patientEntry))
+    patientFingerprints_dict = dict((os.path.abspath(patientEntry), getPatientEntryFingerprint(patientEntry, converterSettings['discoverythreads'])) for patientEntry in patientEntries)
+    getParser = lambda dicomDir: DicomHeaderParser(dicomDir, scanMode='header', scanIndexPath=converterSettings['scanindex'],
+                                                   discoveryThreads=converterSettings['discoverythreads'], processes=converterSettings['processes'])
+    if not os.path.exists(storePath):
+        parser = getParser(inputDir)
+        parser.ExecuteDicomHeaderParser()
+        parser.WriteToMetadataStore(storePath)
+        metadataStore = MetadataStore(storePath)
+    else:
+        metadataStore = MetadataStore(storePath)
+        storedFingerprints_dict = metadataStore.getPatientFingerprints()
+        changedEntries = [patientEntry for patientEntry in patientEntries if storedFingerprints_dict.get(os.path.abspath(patientEntry)) != patientFingerprints_dict[os.path.abspath(patientEntry)]]
+        removedEntries = [patientEntry for patientEntry in storedFingerprints_dict if patientEntry not in patientFingerprints_dict]
+        metadataStore.removePatients(changedEntries + removedEntries, inputDir)
+        for patientEntry in changedEntries:
+            if runLog is not None:
+                runLog.message('METADATASTORE: Scanning patient not in the metadata store or changed since it was built: ' + getPatientDirName(patientEntry), patient=getPatientDirName(patientEntry))
+            parser = getParser(patientEntry)
+            parser.ExecuteDicomHeaderParser()
+            metadataStore.addSeries(parser.dicomFileDict_list, parser.dicomSeriesFiles_dict, parser.getRTStructSeriesInstanceUIDs())
+    metadataStore.setPatientFingerprints(patientFingerprints_dict)
+    refreshedMetadataStores_set.add(refreshKey)
+    return metadataStore
+
+
+def getQueryPatientFiles(inputDir, converterSettings, includeRTStructs=False, runLog=None):
+    # Files of the series matching the series query of converterSettings by patient entry of inputDir (see
+    # MetadataStore.queryPatientFiles), so a converter scans only those files; with includeRTStructs also the
+    # RTSTRUCT files of those patients, for converting their contours
+    metadataStore = openMetadataStore(inputDir, converterSettings, runLog)
+    try:
+        return metadataStore.queryPatientFiles(converterSettings['seriesquery'], inputDir, includeRTStructs)
+    finally:
+        metadataStore.close()
+
+
+def getPatientMemoryEstimates(inputDir, converterSettings, runLog=None):
+    # {patient entry of inputDir: estimated peak bytes of converting it}. A worker converts the series of a
+    # patient one after another, so the estimate of a patient is that of its largest series (matching the
+    # series query). Patients without an estimate, e.g. in a metadata store built before Rows and Columns
+    # were recorded, are left out
+    metadataStore = openMetadataStore(inputDir, converterSettings, runLog)
+    try:
+        seriesEstimates_dict = getSeriesMemoryEstimates(metadataStore.getSeriesNumericValues(estimateHeaderTag_list))
+        patientSeries_Dict = metadataStore.queryPatientSeries(converterSettings['seriesquery'], inputDir)
+    finally:
+        metadataStore.close()
+    patientEstimates_dict = {}
+    for patientDir, seriesInstanceUIDs in patientSeries_Dict.items():
+        seriesEstimates = [seriesEstimates_dict[seriesInstanceUID] for seriesInstanceUID in seriesInstanceUIDs if seriesInstanceUID in seriesEstimates_dict]
+        if seriesEstimates: patientEstimates_dict[patientDir] = max(seriesEstimates)
+    return patientEstimates_dict
+
 
 class DicomHeaderParser:
   
-    def __init__(self, dicomDir, initHeaderTag_list=None):
+    def __init__(self, dicomDir, initHeaderTag_list=None, scanMode='full', scanIndexPath=None, discoveryThreads=discoveryThreads, processes=1, chunkSize=parserChunkSize):
         self.dicomDir = dicomDir
+        # scanMode 'full' reads every file completely, 'header' reads only the tags needed for grouping
+        # and reads the full header of one representative file per series
+        self.scanMode = scanMode
+        # Files recorded unchanged in the scan index at scanIndexPath are not parsed again
+        self.scanIndexPath = scanIndexPath
+        # DICOM files are identified by their content, not their extension, on this many threads
+        self.discoveryThreads = discoveryThreads
+        # With several processes the file list is parsed in chunks of chunkSize files by a process pool;
+        # the results are the same as those of the serial parser
+        self.processes = processes
+        self.chunkSize = chunkSize
         if initHeaderTag_list is not None:
             self.initHeaderTag_list = initHeaderTag_list
         else:
@@ -27,6 +213,8 @@ class DicomHeaderParser:
         self.dicomFiles_list = []
         self.dicomFileDict_list = []
         self.dicomSeriesInstanceUIDs_fileCounter = {}
+        self.dicomSeriesFiles_dict = {}
+        self.scanIndex = None
         
         self.headerTagsNames_dict = self.setHeaderTagsToNamesDict()
       
@@ -40,16 +228,26 @@ class DicomHeaderParser:
   
       
     def getDicomFilesList(self, dicomDir):
-        dicomFiles_list = []
-        for root, directory, filenames in os.walk(dicomDir):
-            [dicomFiles_list.append(str(os.path.join(root, file))) for file in fnmatch.filter(filenames, '*.dcm')]  
-        return dicomFiles_list
+        return discoverDicomFilesList(dicomDir, self.discoveryThreads)
     
         
-    def ExecuteDicomHeaderParser(self):
-        self.dicomFiles_list = self.getDicomFilesList(self.dicomDir)
-        self.dicomFileDict_list = self.getDicomFileDictList(self.dicomFiles_list)
-        self.dicomHeaderInformationTable = self.populateDicomHeaderInformationTable(self.headerTagsNames_dict, self.dicomFileDict_list, self.initHeaderTag_list)
+    def ExecuteDicomHeaderParser(self, populateTable=False):
+        # The Write methods stream their rows from dicomFileDict_list; the dense dicomHeaderInformationTable of every
+        # tag is only built with populateTable=True
+        # Headers are parsed while the discovery threads are still walking dicomDir
+        discoveredFiles = DiscoveredFiles(self.dicomDir, self.discoveryThreads)
+        # Parallel workers open the scan index themselves
+        if self.scanIndexPath is not None and self.processes <= 1:
+            self.scanIndex = ScanIndex(self.scanIndexPath)
+            self.scanIndex.preload(self.dicomDir)
+        try:
+            self.dicomFileDict_list = self.getDicomFileDictList(discoveredFiles)
+        finally:
+            self.dicomFiles_list = discoveredFiles.dicomFiles_list
+            if self.scanIndex is not None: self.scanIndex.close()
+            self.scanIndex = None
+        if populateTable:
+            self.dicomHeaderInformationTable = self.populateDicomHeaderInformationTable(self.headerTagsNames_dict, self.dicomFileDict_list, self.initHeaderTag_list)
     
       
     def getDicomFileDictList(self, dicomFiles_list):
@@ -57,18 +255,23 @@ class DicomHeaderParser:
         # dicom file in dicomFiles_list with a unique SeriesInstanceUID
         dicomFileDict_list = []
         self.dicomSeriesInstanceUIDs_fileCounter = {}
-        for dicomFile in dicomFiles_list:
-            dicomFileHeader = dicom.read_file(dicomFile)
-            seriesInstanceUID = str(dicomFileHeader[2097166].value)
-            if seriesInstanceUID in reversed(self.dicomSeriesInstanceUIDs_fileCounter.keys()):
-                self.dicomSeriesInstanceUIDs_fileCounter[seriesInstanceUID] += 1
-                continue
-            else:
-                self.dicomSeriesInstanceUIDs_fileCounter[seriesInstanceUID] = 1
-                dicomFileDict = {tag:str(element.value) for (tag,element) in dicomFileHeader.iteritems() if '\x00' not in str(element.value)}
-                dicomFileDict = collections.OrderedDict(sorted(dicomFileDict.items(), key=lambda t: t[0]))
-                if dicomFileDict[524384] == 'RTSTRUCT': pass        
-                else: dicomFileDict_list.append(dicomFileDict)   
+        self.dicomSeriesFiles_dict = {}
+        scanHeaderTag_list = getScanHeaderTagList(self.initHeaderTag_list)
+        if self.processes <= 1:
+            seriesRecords_list, seriesFiles_dict = parseDicomFileChunk(dicomFiles_list, self.scanMode, scanHeaderTag_list, self.scanIndex)
+            mergeSeriesRecords(dicomFileDict_list, self.dicomSeriesInstanceUIDs_fileCounter, self.dicomSeriesFiles_dict, seriesRecords_list, seriesFiles_dict)
+            return dicomFileDict_list
+
+        # The pool is started before dicomFiles_list is consumed, so no discovery threads are running when it forks.
+        # Chunks come back in order and are merged as they arrive
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            tasks = ((chunk, self.scanMode, scanHeaderTag_list, self.scanIndexPath) for chunk in getFileChunks(dicomFiles_list, self.chunkSize))
+            for seriesRecords_list, seriesFiles_dict in pool.imap(parseDicomFileChunkTask, tasks):
+                mergeSeriesRecords(dicomFileDict_list, self.dicomSeriesInstanceUIDs_fileCounter, self.dicomSeriesFiles_dict, seriesRecords_list, seriesFiles_dict)
+        finally:
+            pool.close()
+            pool.join()
         return dicomFileDict_list
     
         
@@ -121,14 +324,43 @@ class DicomHeaderParser:
         return dicomHeaderInformationTable
     
       
+    def getMetadataExporter(self):
+        return DicomMetadataExporter(self.headerTagsNames_dict, self.initHeaderTag_list, self.dicomSeriesInstanceUIDs_fileCounter)
+    
+      
     def WriteToCSVFile(self, outputDir=None, outputCSVFileNameSuffix='_DICOM-Metadata.csv'):
-        #Write dicomHeaderInformationTable to a CSV file in dicomDir
+        #Write the header table (one row per series) to a CSV file in dicomDir, streaming row by row
         if outputDir is None: outputDir = self.dicomDir
      
         outputCSVFileName = os.path.basename(self.dicomDir) + outputCSVFileNameSuffix
         outputCSVFile = os.path.join(outputDir, outputCSVFileName)
         
-        with open(outputCSVFile, 'wb') as csvf:
-            writer = csv.writer(csvf)
-            for row in self.dicomHeaderInformationTable:
-                writer.writerow(row)
+        self.getMetadataExporter().WriteToCSVFile(self.dicomFileDict_list, outputCSVFile)
+    
+      
+    def getRTStructSeriesInstanceUIDs(self):
+        #The only series without a header dictionary are RTSTRUCTs
+        recordedSeriesInstanceUIDs = set(str(dicomFileDict[2097166]) for dicomFileDict in self.dicomFileDict_list)
+        return [seriesInstanceUID for seriesInstanceUID in self.dicomSeriesFiles_dict if seriesInstanceUID not in recordedSeriesInstanceUIDs]
+    
+      
+    def WriteToMetadataStore(self, storePath=None):
+        #Write the series, their header values and their files to an indexed SQLite store in dicomDir for querying
+        if storePath is None: storePath = getMetadataStorePath(self.dicomDir)
+        
+        metadataStore = MetadataStore(storePath)
+        try:
+            metadataStore.addSeries(self.dicomFileDict_list, self.dicomSeriesFiles_dict, self.getRTStructSeriesInstanceUIDs())
+        finally:
+            metadataStore.close()
+        return storePath
+    
+      
+    def WriteToColumnarFile(self, outputDir=None, fileFormat='parquet'):
+        #Write the same table as WriteToCSVFile to a Parquet or Feather file in dicomDir (requires pyarrow)
+        if outputDir is None: outputDir = self.dicomDir
+        
+        outputFileName = os.path.basename(self.dicomDir) + '_DICOM-Metadata.' + fileFormat
+        outputFile = os.path.join(outputDir, outputFileName)
+        
+        self.getMetadataExporter().WriteToColumnarFile(self.dicomFileDict_list, outputFile, fileFormat=fileFormat)
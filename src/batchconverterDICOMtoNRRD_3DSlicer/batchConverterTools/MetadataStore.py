@@ -0,0 +1,223 @@
+import os
+import re
+import sqlite3
+import collections
+import dicom
+
+from ArchiveReader import isArchiveMember, splitArchiveMemberPath, getAbsolutePath
+from ConversionManifest import ConversionManifest
+
+# A predicate of a series query is a tag (keyword or GGGG,EEEE), an operator and a value, e.g. Modality=CT,
+# SliceThickness<2, StudyDate>=20140101 or SeriesDescription~THORAX. Values that are numbers are compared
+# as numbers, others as strings; ~ matches values containing the value, ignoring case
+queryOperators_list = ['<=', '>=', '!=', '=', '<', '>', '~']
+queryPredicatePattern = re.compile(r'^\s*([A-Za-z0-9,]+?)\s*(' + '|'.join(re.escape(operator) for operator in queryOperators_list) + r')\s*(.*?)\s*$')
+
+# Layout version of the store, kept as the SQLite user_version; stores of an older version are built again.
+# Version 1 records the files of RTSTRUCT series
+metadataStoreVersion = 1
+
+
+def addMetadataStoreArguments(parser):
+    parser.add_argument('--series-query', action='append', default=[], help='Convert only the series whose header values match TAG<OP>VALUE, e.g. Modality=CT or SliceThickness<2 (operators ' + ' '.join(queryOperators_list) + '); may be repeated, all predicates must match')
+    parser.add_argument('--metadata-store', default=None, help='SQLite metadata store the series query is run on; built from the input directory by the header parser if it does not exist (default: <input directory>/<name>_DICOM-Metadata.sqlite)')
+
+
+def getMetadataStoreSettings(args):
+    return {'seriesquery': args.series_query, 'metadatastore': args.metadata_store}
+
+
+def getMetadataStorePath(dicomDir):
+    return os.path.join(dicomDir, os.path.basename(os.path.normpath(dicomDir)) + '_DICOM-Metadata.sqlite')
+
+
+def getNumericValue(value):
+    try: return float(value)
+    except ValueError: return None
+
+
+def getQueryTag(tagName):
+    # Tag of a keyword (SliceThickness) or of a hexadecimal group and element (0018,0050)
+    if ',' in tagName:
+        group, element = tagName.split(',')
+        return (int(group, 16) << 16) + int(element, 16)
+    try: return dicom.datadict.keyword_dict[tagName]
+    except KeyError: raise ValueError('Unknown DICOM keyword in series query: ' + tagName)
+
+
+def parseQueryPredicate(predicate):
+    # (tag, operator, value) of a predicate string; tuples are passed through with their tag resolved
+    if not isinstance(predicate, basestring):
+        tagName, operator, value = predicate
+        if operator not in queryOperators_list: raise ValueError('Unknown operator in series query: ' + str(operator))
+        return (tagName if isinstance(tagName, (int, long)) else getQueryTag(tagName)), operator, str(value)
+    predicateMatch = queryPredicatePattern.match(predicate)
+    if predicateMatch is None: raise ValueError('Series query predicate is not TAG<OP>VALUE: ' + predicate)
+    tagName, operator, value = predicateMatch.groups()
+    return getQueryTag(tagName), operator, value
+
+
+def getPatientEntry(dicomFile, inputDir, absoluteInputDir):
+    # Patient entry of inputDir holding dicomFile, or None for files outside inputDir or directly in it
+    relativePath = os.path.relpath(splitArchiveMemberPath(dicomFile)[0], absoluteInputDir)
+    if relativePath.startswith(os.pardir) or (os.sep not in relativePath and not isArchiveMember(dicomFile)): return None
+    return os.path.join(inputDir, relativePath.split(os.sep)[0])
+
+
+def getPredicateCondition(predicate):
+    # SQL selecting the series that match one predicate, and its parameters
+    tag, operator, value = parseQueryPredicate(predicate)
+    if operator == '~': return 'SELECT seriesInstanceUID FROM tags WHERE tag = ? AND value LIKE ?', (tag, '%' + value + '%')
+    numericValue = getNumericValue(value)
+    if numericValue is not None: return 'SELECT seriesInstanceUID FROM tags WHERE tag = ? AND numericValue ' + operator + ' ?', (tag, numericValue)
+    return 'SELECT seriesInstanceUID FROM tags WHERE tag = ? AND value ' + operator + ' ?', (tag, value)
+
+
+class MetadataStore:
+    # Indexed SQLite store of the series DicomHeaderParser found: the header values of the first file of every
+    # series, one row per tag with the value as text and, where it is a number, as a number, and the files of
+    # every series. The (tag, value) and (tag, numeric value) indexes serve as an index per tag, so a query on
+    # any tag reads only the matching rows. Predicates on a tag select the series that have the tag with a
+    # matching value; series without the tag never match. The files of RTSTRUCT series are recorded with their
+    # modality but not as series, so queries never select them; queryPatientFiles adds them to the patients
+    # it selects for contour conversion. The fingerprint of every patient entry of the input directory when it
+    # was scanned tells which entries changed since
+
+    def __init__(self, storePath):
+        self.storePath = storePath
+        storeDir = os.path.dirname(os.path.abspath(storePath))
+        if not os.path.exists(storeDir): os.makedirs(storeDir)
+
+        self.connection = sqlite3.connect(storePath, timeout=600)
+        self.connection.text_factory = str
+        isNewStore = self.connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'series'").fetchone()[0] == 0
+        if isNewStore: self.connection.execute('PRAGMA user_version = ' + str(metadataStoreVersion))
+        self.version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        self.connection.execute('CREATE TABLE IF NOT EXISTS series (seriesInstanceUID TEXT PRIMARY KEY, fileCount INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tags (seriesInstanceUID TEXT, tag INTEGER, value TEXT, numericValue REAL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, seriesInstanceUID TEXT, fileIndex INTEGER, modality TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS patients (patientEntry TEXT PRIMARY KEY, fingerprint TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tags_tag_value ON tags (tag, value)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tags_tag_numericValue ON tags (tag, numericValue)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS tags_seriesInstanceUID ON tags (seriesInstanceUID)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_seriesInstanceUID ON files (seriesInstanceUID, fileIndex)')
+        self.connection.commit()
+
+    def addFiles(self, seriesInstanceUID, seriesFiles, modality):
+        self.connection.execute('DELETE FROM files WHERE seriesInstanceUID = ?', (seriesInstanceUID,))
+        self.connection.executemany('INSERT OR REPLACE INTO files (path, seriesInstanceUID, fileIndex, modality) VALUES (?, ?, ?, ?)',
+                                    [(getAbsolutePath(dicomFile), seriesInstanceUID, fileIndex, modality) for fileIndex, dicomFile in enumerate(seriesFiles)])
+
+    def addSeries(self, dicomFileDict_list, dicomSeriesFiles_dict, rtStructSeriesInstanceUIDs=()):
+        # Records the header dictionaries and files of DicomHeaderParser, and the files of its RTSTRUCT series,
+        # replacing earlier records of the same series
+        for dicomFileDict in dicomFileDict_list:
+            seriesInstanceUID = str(dicomFileDict[2097166])
+            seriesFiles = dicomSeriesFiles_dict.get(seriesInstanceUID, [])
+            self.connection.execute('DELETE FROM tags WHERE seriesInstanceUID = ?', (seriesInstanceUID,))
+            self.connection.execute('INSERT OR REPLACE INTO series (seriesInstanceUID, fileCount) VALUES (?, ?)', (seriesInstanceUID, len(seriesFiles)))
+            self.connection.executemany('INSERT INTO tags (seriesInstanceUID, tag, value, numericValue) VALUES (?, ?, ?, ?)',
+                                        [(seriesInstanceUID, tag, str(value).strip(), getNumericValue(str(value))) for tag, value in dicomFileDict.items() if isinstance(tag, (int, long))])
+            self.addFiles(seriesInstanceUID, seriesFiles, str(dicomFileDict.get(524384, '')).strip())
+        for seriesInstanceUID in rtStructSeriesInstanceUIDs:
+            self.addFiles(seriesInstanceUID, dicomSeriesFiles_dict.get(seriesInstanceUID, []), 'RTSTRUCT')
+        self.connection.commit()
+
+    def getPatientFingerprints(self):
+        # {absolute path of a patient entry: fingerprint of its files when it was scanned}
+        return dict(self.connection.execute('SELECT patientEntry, fingerprint FROM patients'))
+
+    def setPatientFingerprints(self, patientFingerprints_dict):
+        self.connection.executemany('INSERT OR REPLACE INTO patients (patientEntry, fingerprint) VALUES (?, ?)', patientFingerprints_dict.items())
+        self.connection.commit()
+
+    def removePatients(self, patientEntries, inputDir):
+        # Removes the files of the patient entries of inputDir, their fingerprints, and the series left without files
+        absoluteInputDir = os.path.abspath(inputDir)
+        removedEntries_set = set(os.path.abspath(patientEntry) for patientEntry in patientEntries)
+        removedFiles = []
+        for (path,) in self.connection.execute('SELECT path FROM files'):
+            patientEntry = getPatientEntry(path, inputDir, absoluteInputDir)
+            if patientEntry is not None and os.path.abspath(patientEntry) in removedEntries_set: removedFiles.append((path,))
+        self.connection.executemany('DELETE FROM files WHERE path = ?', removedFiles)
+        self.connection.executemany('DELETE FROM patients WHERE patientEntry = ?', [(patientEntry,) for patientEntry in removedEntries_set])
+        self.connection.execute('DELETE FROM tags WHERE seriesInstanceUID NOT IN (SELECT seriesInstanceUID FROM files)')
+        self.connection.execute('DELETE FROM series WHERE seriesInstanceUID NOT IN (SELECT seriesInstanceUID FROM files)')
+        self.connection.commit()
+
+    def querySeries(self, predicates=()):
+        # SeriesInstanceUIDs of the series matching all predicates (strings or (tag, operator, value)), in the
+        # order they were added
+        conditions, parameters = [], []
+        for predicate in predicates:
+            condition, conditionParameters = getPredicateCondition(predicate)
+            conditions.append('seriesInstanceUID IN (' + condition + ')')
+            parameters.extend(conditionParameters)
+        query = 'SELECT seriesInstanceUID FROM series' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY rowid'
+        return [row[0] for row in self.connection.execute(query, parameters)]
+
+    def getSeriesValues(self, seriesInstanceUID):
+        # {tag: value} of the first file of a series
+        cursor = self.connection.execute('SELECT tag, value FROM tags WHERE seriesInstanceUID = ? ORDER BY tag', (seriesInstanceUID,))
+        return collections.OrderedDict(cursor.fetchall())
+
+    def getSeriesFiles(self, seriesInstanceUID):
+        cursor = self.connection.execute('SELECT path FROM files WHERE seriesInstanceUID = ? ORDER BY fileIndex', (seriesInstanceUID,))
+        return [row[0] for row in cursor]
+
+    def queryFiles(self, predicates=()):
+        # {SeriesInstanceUID: [file paths]} of the series matching all predicates
+        return collections.OrderedDict((seriesInstanceUID, self.getSeriesFiles(seriesInstanceUID)) for seriesInstanceUID in self.querySeries(predicates))
+
+    def queryOutputPaths(self, predicates, outputDir):
+        # {SeriesInstanceUID: [output paths]} of the matching series recorded as converted in the manifests of outputDir
+        manifest = ConversionManifest(outputDir)
+        outputPaths_dict = collections.OrderedDict()
+        for seriesInstanceUID in self.querySeries(predicates):
+            seriesEntry = manifest.seriesEntries_dict.get(seriesInstanceUID)
+            if seriesEntry is not None and seriesEntry['status'] == 'complete': outputPaths_dict[seriesInstanceUID] = seriesEntry['outputs']
+        return outputPaths_dict
+
+    def getRTStructFiles(self):
+        cursor = self.connection.execute("SELECT path FROM files WHERE modality = 'RTSTRUCT' ORDER BY seriesInstanceUID, fileIndex")
+        return [row[0] for row in cursor]
+
+    def queryPatientFiles(self, predicates, inputDir, includeRTStructs=False):
+        # {patient entry of inputDir: [files of its matching series]}; patient entries are the directories (or
+        # archives) directly in inputDir, joined to inputDir as given, as the converters list them. With
+        # includeRTStructs the RTSTRUCT files of the selected patients are added; the converters match them to
+        # the studies of the selected series and pass over the others
+        absoluteInputDir = os.path.abspath(inputDir)
+        patientFiles_Dict = collections.OrderedDict()
+        for seriesInstanceUID, seriesFiles in self.queryFiles(predicates).items():
+            for dicomFile in seriesFiles:
+                patientDir = getPatientEntry(dicomFile, inputDir, absoluteInputDir)
+                if patientDir is not None: patientFiles_Dict.setdefault(patientDir, []).append(dicomFile)
+        if includeRTStructs:
+            for dicomFile in self.getRTStructFiles():
+                patientDir = getPatientEntry(dicomFile, inputDir, absoluteInputDir)
+                if patientDir in patientFiles_Dict: patientFiles_Dict[patientDir].append(dicomFile)
+        return patientFiles_Dict
+
+    def queryPatientSeries(self, predicates, inputDir):
+        # {patient entry of inputDir: [SeriesInstanceUIDs of its matching series]}, see queryPatientFiles
+        absoluteInputDir = os.path.abspath(inputDir)
+        patientSeries_Dict = collections.OrderedDict()
+        for seriesInstanceUID, seriesFiles in self.queryFiles(predicates).items():
+            for patientDir in sorted(set(getPatientEntry(dicomFile, inputDir, absoluteInputDir) for dicomFile in seriesFiles) - set([None])):
+                patientSeries_Dict.setdefault(patientDir, []).append(seriesInstanceUID)
+        return patientSeries_Dict
+
+    def getSeriesNumericValues(self, tag_list):
+        # {SeriesInstanceUID: {tag: number}} of the tags in tag_list that have numeric values, and 'FileCount'
+        seriesValues_dict = collections.OrderedDict()
+        for seriesInstanceUID, fileCount in self.connection.execute('SELECT seriesInstanceUID, fileCount FROM series ORDER BY rowid'):
+            seriesValues_dict[seriesInstanceUID] = {'FileCount': fileCount}
+        cursor = self.connection.execute('SELECT seriesInstanceUID, tag, numericValue FROM tags WHERE numericValue IS NOT NULL AND tag IN (' + ', '.join('?' * len(tag_list)) + ')', list(tag_list))
+        for seriesInstanceUID, tag, numericValue in cursor:
+            if seriesInstanceUID in seriesValues_dict: seriesValues_dict[seriesInstanceUID][tag] = numericValue
+        return seriesValues_dict
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
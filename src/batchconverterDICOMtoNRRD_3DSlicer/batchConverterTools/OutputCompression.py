@@ -0,0 +1,124 @@
+import os
+import time
+import zlib
+import struct
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+compressionModes_list = ['raw', 'gzip', 'parallelgzip']
+# Uncompressed bytes per independently deflated block of the parallel encoder
+compressionBlockSize = 1 << 22
+
+
+def compressBlock(blockArgs):
+    # Raw deflate of one block. All blocks but the last end on a byte boundary (sync flush) without the
+    # final-block bit, so that the compressed blocks concatenate into one valid deflate stream
+    block, level, isLastBlock = blockArgs
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if isLastBlock else zlib.Z_SYNC_FLUSH)
+
+
+def readBlocks(inputFile, numberBytes):
+    # Yields the next numberBytes bytes of inputFile in blocks of compressionBlockSize
+    while numberBytes > 0:
+        block = inputFile.read(min(compressionBlockSize, numberBytes))
+        if not block: raise IOError('Unexpected end of file in ' + str(inputFile.name))
+        numberBytes -= len(block)
+        yield block
+
+
+def writeGzipStream(inputFile, numberBytes, outputFile, level=6, threads=1):
+    # Writes the next numberBytes bytes of inputFile to outputFile as a single gzip member, like pigz:
+    # blocks are deflated independently on a pool of threads (zlib releases the GIL) and written in
+    # order, so any gzip reader can decompress the result. At most 2 x threads blocks are held in memory.
+    # Returns the number of compressed bytes written
+    outputFile.write(struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, 0, 0, 255))
+    compressedBytes = 10
+    crc = 0
+    blocks = readBlocks(inputFile, numberBytes)
+    pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        window = list(itertools.islice(blocks, 2 * threads))
+        if not window: window = ['']
+        while window:
+            nextWindow = list(itertools.islice(blocks, 2 * threads))
+            blockArgs = [(block, level, not nextWindow and index == len(window) - 1) for index, block in enumerate(window)]
+            compressedBlocks = pool.map(compressBlock, blockArgs) if pool else map(compressBlock, blockArgs)
+            for block, compressedBlock in zip(window, compressedBlocks):
+                crc = zlib.crc32(block, crc)
+                outputFile.write(compressedBlock)
+                compressedBytes += len(compressedBlock)
+            window = nextWindow
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    outputFile.write(struct.pack('<LL', crc & 0xffffffff, numberBytes & 0xffffffff))
+    return compressedBytes + 8
+
+
+def getNrrdHeaderLength(nrrdFile):
+    # Returns (header lines, length in bytes of the header including the blank line) of an attached-header NRRD file
+    headerLines = []
+    headerLength = 0
+    while True:
+        line = nrrdFile.readline()
+        if not line: raise IOError('No data found in ' + str(nrrdFile.name))
+        headerLength += len(line)
+        if not line.strip(): return headerLines, headerLength
+        headerLines.append(line.rstrip('\r\n'))
+
+
+def getWriterCompression(outputPath, compression):
+    # (path, whether to compress) for an image writer about to write outputPath. Single-threaded gzip is left
+    # to the writer, which deflates while writing instead of the raw file being read back and compressed;
+    # NIfTI writers compress files named .nii.gz. parallelgzip outputs are written raw and compressed afterwards
+    if compression != 'gzip': return outputPath, False
+    if outputPath.endswith('.nii'): return outputPath + '.gz', True
+    return outputPath, True
+
+
+def compressOutputFile(outputPath, compression='gzip', level=6, threads=None):
+    # Compresses a raw NRRD (re-encoded in place as 'encoding: gzip') or NIfTI file (replaced by .nii.gz)
+    # written by the converter. The result is read by any standard NRRD or NIfTI reader.
+    # Returns (output path, statistics dictionary); raw mode and files that are already compressed are left unchanged
+    inputBytes = os.path.getsize(outputPath)
+    statistics_dict = {'compression': compression, 'inputbytes': inputBytes, 'outputbytes': inputBytes, 'seconds': 0.0}
+    if compression == 'raw': return outputPath, statistics_dict
+    if compression not in compressionModes_list: raise ValueError('Unknown compression: ' + str(compression))
+    if compression == 'gzip': threads = 1
+    elif threads is None: threads = multiprocessing.cpu_count()
+
+    startTime = time.time()
+    if outputPath.endswith('.nrrd'):
+        compressedPath = outputPath + '.tmp'
+        with open(outputPath, 'rb') as inputFile:
+            headerLines, headerLength = getNrrdHeaderLength(inputFile)
+            if 'encoding: raw' not in headerLines: return outputPath, statistics_dict
+            header = '\n'.join('encoding: gzip' if line == 'encoding: raw' else line for line in headerLines) + '\n\n'
+            with open(compressedPath, 'wb') as outputFile:
+                outputFile.write(header)
+                outputBytes = len(header) + writeGzipStream(inputFile, inputBytes - headerLength, outputFile, level, threads)
+        if os.name == 'nt': os.remove(outputPath)
+        os.rename(compressedPath, outputPath)
+        compressedOutputPath = outputPath
+    elif outputPath.endswith('.nii'):
+        compressedOutputPath = outputPath + '.gz'
+        with open(outputPath, 'rb') as inputFile:
+            with open(compressedOutputPath, 'wb') as outputFile:
+                outputBytes = writeGzipStream(inputFile, inputBytes, outputFile, level, threads)
+        os.remove(outputPath)
+    else:
+        return outputPath, statistics_dict
+
+    statistics_dict['outputbytes'] = outputBytes
+    statistics_dict['seconds'] = time.time() - startTime
+    return compressedOutputPath, statistics_dict
+
+
+def getCompressionLogLine(outputPath, statistics_dict):
+    seconds = max(statistics_dict['seconds'], 1e-6)
+    ratio = float(statistics_dict['inputbytes']) / max(statistics_dict['outputbytes'], 1)
+    return ('\tCOMPRESSION: ' + outputPath + ': ' + statistics_dict['compression'] + ', ratio ' + '%.2f' % ratio
+            + ', ' + '%.1f' % (statistics_dict['inputbytes'] / seconds / 1e6) + ' MB/s\n')
@@ -0,0 +1,195 @@
+import sys
+import threading
+import collections
+
+from ArchiveReader import openDicomFile, getFileStat
+
+# Size of the reads that pull prefetched files into the page cache
+readAheadChunkSize = 1 << 20
+
+
+def addPipelineArguments(parser):
+    parser.add_argument('--prefetch-depth', type=int, default=0, help='Series whose files are read ahead into the page cache while the current series is converted; 0 reads strictly serially (default: 0)')
+    parser.add_argument('--prefetch-threads', type=int, default=2, help='Threads reading files ahead (default: 2)')
+    parser.add_argument('--write-depth', type=int, default=0, help='Converted volumes queued for a background writer that saves and compresses them while the next series is decoded; 0 writes in the conversion loop (default: 0)')
+    parser.add_argument('--pipeline-memory', type=float, default=1024, help='MB of read-ahead files and queued volumes held at any time (default: 1024)')
+
+
+def getPipelineSettings(args):
+    return {'prefetchdepth': args.prefetch_depth, 'prefetchthreads': args.prefetch_threads, 'writedepth': args.write_depth,
+            'pipelinememory': int(args.pipeline_memory * (1 << 20))}
+
+
+def readAhead(filePath, stopEvent=None):
+    # Reads a file and discards its contents so that it is served from the page cache when it is decoded; for a
+    # file inside an archive the part of the archive holding it is read
+    with openDicomFile(filePath) as prefetchFile:
+        while prefetchFile.read(readAheadChunkSize):
+            if stopEvent is not None and stopEvent.is_set(): return
+
+
+class ByteBudget:
+    # Bytes held by the stages of a pipeline. acquire blocks while taking numberBytes would exceed maxBytes,
+    # except when the stage holds nothing: a single item larger than the budget still passes, and a stage never
+    # waits for bytes that only a stage waiting on it could release
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.heldBytes_dict = {}
+        self.condition = threading.Condition()
+
+    def getHeldBytes(self):
+        with self.condition: return sum(self.heldBytes_dict.values())
+
+    def acquire(self, stageName, numberBytes, stopEvent=None):
+        # Returns False without taking the bytes if stopEvent is set while waiting
+        with self.condition:
+            while self.heldBytes_dict.get(stageName, 0) > 0 and sum(self.heldBytes_dict.values()) + numberBytes > self.maxBytes:
+                if stopEvent is not None and stopEvent.is_set(): return False
+                self.condition.wait(0.5)
+            self.heldBytes_dict[stageName] = self.heldBytes_dict.get(stageName, 0) + numberBytes
+            return True
+
+    def release(self, stageName, numberBytes):
+        with self.condition:
+            self.heldBytes_dict[stageName] -= numberBytes
+            self.condition.notify_all()
+
+
+class SeriesPrefetcher:
+    # Prefetch stage: threads read the files of the work items [(key, file paths)] (series, in the order the
+    # conversion loop takes them) into the page cache ahead of the loop, so that on network storage the loop
+    # does not wait for reads while the disk waits for the loop. The loop calls consume(key) when it starts an
+    # item; at most depth items beyond the last consumed one are read ahead, and their sizes count against the
+    # budget until they are consumed. Items consumed before their turn are never read
+
+    def __init__(self, workItems, depth, budget, threads=2):
+        self.workItems = list(workItems)
+        self.itemIndices_dict = dict((key, index) for index, (key, filePaths) in enumerate(self.workItems))
+        self.depth = depth
+        self.budget = budget
+        self.numberThreads = max(1, threads)
+        self.nextIndex = 0
+        self.consumedCount = 0
+        self.heldBytes_dict = {}
+        self.condition = threading.Condition()
+        self.stopEvent = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for threadIndex in range(min(self.numberThreads, self.depth, len(self.workItems))):
+            prefetchThread = threading.Thread(target=self.prefetchItems)
+            prefetchThread.daemon = True
+            prefetchThread.start()
+            self.threads.append(prefetchThread)
+        return self
+
+    def takeNextIndex(self):
+        with self.condition:
+            while not self.stopEvent.is_set() and self.nextIndex < len(self.workItems) and self.nextIndex >= self.consumedCount + self.depth:
+                self.condition.wait(0.5)
+            if self.stopEvent.is_set() or self.nextIndex >= len(self.workItems): return None
+            self.nextIndex = max(self.nextIndex, self.consumedCount)
+            if self.nextIndex >= len(self.workItems): return None
+            index = self.nextIndex
+            self.nextIndex += 1
+            return index
+
+    def prefetchItems(self):
+        while True:
+            index = self.takeNextIndex()
+            if index is None: return
+            filePaths = self.workItems[index][1]
+            try: numberBytes = sum(getFileStat(filePath).st_size for filePath in filePaths)
+            except OSError: numberBytes = 0
+            if not self.budget.acquire('prefetch', numberBytes, self.stopEvent): return
+            with self.condition:
+                if index < self.consumedCount:
+                    self.budget.release('prefetch', numberBytes)
+                    continue
+                self.heldBytes_dict[index] = numberBytes
+            for filePath in filePaths:
+                if self.stopEvent.is_set() or index < self.consumedCount: break
+                # A file that cannot be read is reported by the conversion loop
+                try: readAhead(filePath, self.stopEvent)
+                except (IOError, OSError): pass
+
+    def consume(self, key):
+        # The loop starts on key: releases the bytes of key and of the items before it
+        with self.condition:
+            self.consumedCount = max(self.consumedCount, self.itemIndices_dict[key] + 1)
+            for index in [index for index in self.heldBytes_dict if index < self.consumedCount]:
+                self.budget.release('prefetch', self.heldBytes_dict.pop(index))
+            self.condition.notify_all()
+
+    def stop(self):
+        self.stopEvent.set()
+        with self.condition: self.condition.notify_all()
+        for prefetchThread in self.threads: prefetchThread.join()
+        with self.condition:
+            for numberBytes in self.heldBytes_dict.values(): self.budget.release('prefetch', numberBytes)
+            self.heldBytes_dict.clear()
+
+
+class PendingOutput:
+    # Result of a write submitted to OutputWriter
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.value = None
+        self.excInfo = None
+
+    def result(self):
+        # Waits for the write; returns its result or raises its exception
+        self.finished.wait()
+        if self.excInfo is not None: raise self.excInfo[1]
+        return self.value
+
+
+class OutputWriter:
+    # Writer stage: a background thread saves (and compresses) converted volumes while the loop decodes the
+    # next series. At most depth volumes wait for the writer, and their bytes count against the budget until
+    # they are written, so submit blocks when the writer falls behind
+
+    def __init__(self, depth, budget):
+        self.depth = max(1, depth)
+        self.budget = budget
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.writeOutputs)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, args, numberBytes):
+        self.budget.acquire('write', numberBytes)
+        pendingOutput = PendingOutput()
+        with self.condition:
+            while len(self.pending) >= self.depth: self.condition.wait(0.5)
+            self.pending.append((function, args, numberBytes, pendingOutput))
+            self.condition.notify_all()
+        return pendingOutput
+
+    def writeOutputs(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed: self.condition.wait(0.5)
+                if not self.pending: return
+                function, args, numberBytes, pendingOutput = self.pending[0]
+            try: pendingOutput.value = function(*args)
+            except Exception: pendingOutput.excInfo = sys.exc_info()
+            finally:
+                # Drop the volume before waiting for the next one
+                function = args = None
+                with self.condition:
+                    self.pending.popleft()
+                    self.condition.notify_all()
+                self.budget.release('write', numberBytes)
+                pendingOutput.finished.set()
+
+    def close(self):
+        # Waits until every submitted volume is written
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
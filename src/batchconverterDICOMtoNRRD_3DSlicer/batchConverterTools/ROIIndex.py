@@ -0,0 +1,107 @@
+import csv
+import collections
+
+from ArchiveReader import getPatientDirName
+from FileDiscovery import discoveryThreads, discoverDicomFiles
+from HeaderScanner import readDicomHeader
+
+# Tags read from RTSTRUCT files; parsing stops after the ROI names, before the contour data
+roiHeaderTag_list = [524384,1048608,2097165,805699616]
+#524384: Modality
+#1048608: Patient ID
+#2097165: Study Instance UID
+#805699616: Structure Set ROI Sequence
+
+roiReportColumns_list = ['PatientDirectory', 'PatientID', 'StudyInstanceUID', 'RTStruct', 'ROIName', 'Matched', 'Include', 'Exclude']
+
+
+class ContourFilterSet:
+    # The contour filters of ContourFilterWidget.getContourFilterDict, compiled once: keywords are upper-cased up
+    # front and the result for each ROI name is cached, as the same names recur throughout a cohort.
+    # match follows BatchRTStructConversionLogic.TestContourNode: it returns the first filter whose Include
+    # keywords all occur in the name and whose Exclude keywords all do not, or False. With convertAll every
+    # name matches
+
+    def __init__(self, contourFilters=None, convertAll=False):
+        self.convertAll = convertAll
+        self.compiledFilters = [(contourFilter, tuple(keyword.upper() for keyword in contourFilter['Include']),
+                                 tuple(keyword.upper() for keyword in contourFilter['Exclude'])) for contourFilter in contourFilters or []]
+        self.matches_dict = {}
+
+    def match(self, contourName):
+        if self.convertAll: return True
+        try: return self.matches_dict[contourName]
+        except KeyError: pass
+        upperContourName = contourName.upper()
+        contourFilterMatch = False
+        for contourFilter, includeKeywords, excludeKeywords in self.compiledFilters:
+            if all(keyword in upperContourName for keyword in includeKeywords) and not any(keyword in upperContourName for keyword in excludeKeywords):
+                contourFilterMatch = contourFilter
+                break
+        self.matches_dict[contourName] = contourFilterMatch
+        return contourFilterMatch
+
+    def matchAny(self, contourNames):
+        return any(self.match(contourName) for contourName in contourNames)
+
+
+def readROINames(rtStructFile):
+    # (PatientID, StudyInstanceUID, [ROIName]) of an RTSTRUCT, or None for other files
+    rtStructHeader = readDicomHeader(rtStructFile, roiHeaderTag_list, force=True)
+    if str(getattr(rtStructHeader, 'Modality', '')).strip() != 'RTSTRUCT': return None
+    roiNames = [str(getattr(structureSetROI, 'ROIName', '')).strip() for structureSetROI in getattr(rtStructHeader, 'StructureSetROISequence', [])]
+    return str(getattr(rtStructHeader, 'PatientID', '')), str(getattr(rtStructHeader, 'StudyInstanceUID', '')), roiNames
+
+
+def tryReadROINames(dicomFile, runLog=None, **fields):
+    # readROINames, or None for a file that cannot be read, which is logged with fields, so that one corrupt
+    # RTSTRUCT does not stop the index or the conversion of a cohort
+    try: return readROINames(dicomFile)
+    except Exception as e:
+        if runLog is not None: runLog.message('RTSTRUCTERROR: Could not read ROI names: ' + dicomFile + ': ' + str(e), **fields)
+        return None
+
+
+def buildROIIndex(patientDirs, threads=discoveryThreads, runLog=None):
+    # Cohort-wide index of the ROI names of every RTSTRUCT, read header-only:
+    # {patient directory: [(PatientID, StudyInstanceUID, RTSTRUCT file, [ROIName])]}. Files that cannot be
+    # read are logged to runLog and left out
+    roiIndex_Dict = collections.OrderedDict()
+    for patientDir in patientDirs:
+        patientEntries = []
+        for dicomFile, fileSize in discoverDicomFiles(patientDir, threads):
+            roiNamesEntry = tryReadROINames(dicomFile, runLog, patient=getPatientDirName(patientDir))
+            if roiNamesEntry is None: continue
+            patientID, studyInstanceUID, roiNames = roiNamesEntry
+            patientEntries.append((patientID, studyInstanceUID, dicomFile, roiNames))
+        roiIndex_Dict[patientDir] = patientEntries
+    return roiIndex_Dict
+
+
+def getMatchingStudies(roiIndex_Dict, contourFilterSet):
+    # {patient directory: {(PatientID, StudyInstanceUID): [matching ROIName]}}, leaving out studies without a
+    # matching ROI and patient directories without such a study
+    matchingStudies_Dict = collections.OrderedDict()
+    for patientDir, patientEntries in roiIndex_Dict.items():
+        patientStudies_Dict = collections.OrderedDict()
+        for patientID, studyInstanceUID, rtStructFile, roiNames in patientEntries:
+            matchingROINames = [roiName for roiName in roiNames if contourFilterSet.match(roiName)]
+            if matchingROINames: patientStudies_Dict.setdefault((patientID, studyInstanceUID), []).extend(matchingROINames)
+        if patientStudies_Dict: matchingStudies_Dict[patientDir] = patientStudies_Dict
+    return matchingStudies_Dict
+
+
+def writeROIReport(roiIndex_Dict, contourFilterSet, reportPath):
+    # Dry-run report: one row per ROI, whether it matches and the keywords of the filter it matches
+    with open(reportPath, 'wb') as reportFile:
+        writer = csv.writer(reportFile)
+        writer.writerow(roiReportColumns_list)
+        for patientDir, patientEntries in roiIndex_Dict.items():
+            for patientID, studyInstanceUID, rtStructFile, roiNames in patientEntries:
+                for roiName in roiNames:
+                    contourFilterMatch = contourFilterSet.match(roiName)
+                    if contourFilterMatch is True: includeKeywords, excludeKeywords = 'All', ''
+                    elif contourFilterMatch: includeKeywords, excludeKeywords = ','.join(contourFilterMatch['Include']), ','.join(contourFilterMatch['Exclude'])
+                    else: includeKeywords = excludeKeywords = ''
+                    writer.writerow([getPatientDirName(patientDir), patientID, studyInstanceUID, rtStructFile, roiName,
+                                     'Yes' if contourFilterMatch else 'No', includeKeywords, excludeKeywords])
@@ -0,0 +1,177 @@
+import numpy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from ArchiveReader import readDicomFile
+from HeaderScanner import readDicomHeader
+from SeriesGeometry import parseDecimalStrings
+
+# Rasterizes the CLOSED_PLANAR contours of an RTSTRUCT into binary label maps on the grid of the referenced
+# image volume, without Slicer.
+# A voxel is labelled if its centre lies inside the contours of its slice (even-odd rule, so inner contours
+# cut holes); a contour is drawn on the slice nearest to its plane and dropped if that plane lies outside the
+# volume by more than half a slice.
+# Tolerance against vtkSlicerContoursModuleLogic (GetIndexedLabelmapWithGivenGeometry): both label the voxels
+# whose centres fall inside the contour polygons, so the label maps are identical except for
+#  - boundary voxels, whose centre lies within about half a voxel of a contour line: Slicer rasterizes a
+#    surface built from the contours and can decide these voxels either way
+#  - the first and last contoured slice of a ROI, which Slicer's end capping of that surface may add or remove
+# compareLabelmaps measures this against a label map exported from Slicer on the same geometry
+
+
+def readRTStruct(rtStructFile):
+    # Returns {'referencedseries': [SeriesInstanceUID], 'referencedinstances': set of SOPInstanceUIDs,
+    # 'rois': [(ROINumber, ROIName, FrameOfReferenceUID, [N x 3 contour point arrays])]}
+    rtStruct = readDicomFile(rtStructFile, force=True)
+    referencedSeries_list = []
+    referencedInstances_set = set()
+    for frameOfReference in getattr(rtStruct, 'ReferencedFrameOfReferenceSequence', []):
+        for referencedStudy in getattr(frameOfReference, 'RTReferencedStudySequence', []):
+            for referencedSeries in getattr(referencedStudy, 'RTReferencedSeriesSequence', []):
+                referencedSeries_list.append(str(referencedSeries.SeriesInstanceUID))
+                for contourImage in getattr(referencedSeries, 'ContourImageSequence', []):
+                    referencedInstances_set.add(str(contourImage.ReferencedSOPInstanceUID))
+
+    roiNames_dict = {}
+    for structureSetROI in getattr(rtStruct, 'StructureSetROISequence', []):
+        roiNames_dict[int(structureSetROI.ROINumber)] = (str(getattr(structureSetROI, 'ROIName', '')).strip(),
+                                                         str(getattr(structureSetROI, 'ReferencedFrameOfReferenceUID', '')))
+    rois = []
+    for roiContour in getattr(rtStruct, 'ROIContourSequence', []):
+        roiNumber = int(roiContour.ReferencedROINumber)
+        contours = []
+        for contour in getattr(roiContour, 'ContourSequence', []):
+            for contourImage in getattr(contour, 'ContourImageSequence', []):
+                referencedInstances_set.add(str(contourImage.ReferencedSOPInstanceUID))
+            if str(getattr(contour, 'ContourGeometricType', 'CLOSED_PLANAR')).strip() != 'CLOSED_PLANAR': continue
+            points = numpy.array([float(value) for value in contour.ContourData], dtype=numpy.float64).reshape(-1, 3)
+            if len(points) >= 3: contours.append(points)
+        roiName, frameOfReferenceUID = roiNames_dict.get(roiNumber, ('', ''))
+        if roiName == '': roiName = 'ROI_' + str(roiNumber)
+        rois.append((roiNumber, roiName, frameOfReferenceUID, contours))
+    return {'referencedseries': referencedSeries_list, 'referencedinstances': referencedInstances_set, 'rois': rois}
+
+
+def getVolumeGeometry(volumeFileDict_list):
+    # Grid of a sorted, uniformly spaced volume (see checkSeriesGeometry) as read by ImageSeriesReader:
+    # (origin, directions, spacings, sizes), with the rows of directions, spacings and sizes ordered column, row, slice
+    firstFileHeader = readDicomHeader(volumeFileDict_list[0]['Filepath'], force=True)
+    orientation = numpy.array(parseDecimalStrings(firstFileHeader.ImageOrientationPatient))
+    origin = numpy.array(parseDecimalStrings(firstFileHeader.ImagePositionPatient))
+    normal = numpy.cross(orientation[:3], orientation[3:])
+    pixelSpacing = parseDecimalStrings(firstFileHeader.PixelSpacing)
+    if len(volumeFileDict_list) > 1:
+        lastPosition = numpy.array(parseDecimalStrings(volumeFileDict_list[-1][2097202]))
+        sliceSpacing = (lastPosition - origin).dot(normal) / (len(volumeFileDict_list) - 1)
+    else:
+        sliceSpacing = float(getattr(firstFileHeader, 'SliceThickness', '') or 1.0)
+    directions = numpy.array([orientation[:3], orientation[3:], normal])
+    spacings = numpy.array([pixelSpacing[1], pixelSpacing[0], sliceSpacing])
+    sizes = (int(firstFileHeader.Columns), int(firstFileHeader.Rows), len(volumeFileDict_list))
+    return origin, directions, spacings, sizes
+
+
+def getContinuousIndices(points, geometry):
+    # Patient (LPS) coordinates to continuous (column, row, slice) indices; voxel centres are at integers
+    origin, directions, spacings, sizes = geometry
+    return (points - origin).dot(directions.T) / spacings
+
+
+def fillSlicePolygons(polygons, rows, columns):
+    # Scanline fill of the pixels whose centres lie inside the polygons (lists of (column, row) vertices) by
+    # the even-odd rule. For every pixel row all edge crossings are found at once, each crossing toggles the
+    # pixels to its right, and a cumulative sum along the row gives the parity
+    vertices = numpy.concatenate(polygons)
+    nextVertices = numpy.concatenate([numpy.roll(polygon, -1, axis=0) for polygon in polygons])
+    x0, y0, x1, y1 = vertices[:, 0], vertices[:, 1], nextVertices[:, 0], nextVertices[:, 1]
+
+    mask = numpy.zeros((rows, columns), dtype=numpy.uint8)
+    firstRow = max(0, int(numpy.ceil(vertices[:, 1].min())))
+    lastRow = min(rows - 1, int(numpy.floor(vertices[:, 1].max())))
+    if lastRow < firstRow: return mask
+    rowCentres = numpy.arange(firstRow, lastRow + 1, dtype=numpy.float64)[:, numpy.newaxis]
+
+    # Half-open test so that a vertex on a scanline is counted once and horizontal edges never
+    crossingRows, crossingEdges = numpy.nonzero((y0 <= rowCentres) != (y1 <= rowCentres))
+    if len(crossingRows) == 0: return mask
+    xCrossing = x0[crossingEdges] + (rowCentres[crossingRows, 0] - y0[crossingEdges]) * (x1[crossingEdges] - x0[crossingEdges]) / (y1[crossingEdges] - y0[crossingEdges])
+    toggleColumns = numpy.clip(numpy.ceil(xCrossing), 0, columns).astype(numpy.intp)
+    toggles = numpy.zeros((lastRow - firstRow + 1, columns + 1), dtype=numpy.int32)
+    numpy.add.at(toggles, (crossingRows, toggleColumns), 1)
+    mask[firstRow:lastRow + 1] = numpy.cumsum(toggles, axis=1)[:, :columns] & 1
+    return mask
+
+
+def rasterizeROI(contours, geometry):
+    # Binary label map (slices, rows, columns) of the contours of one ROI
+    columns, rows, slices = geometry[3]
+    labelmap = numpy.zeros((slices, rows, columns), dtype=numpy.uint8)
+    slicePolygons_Dict = {}
+    for points in contours:
+        indices = getContinuousIndices(points, geometry)
+        sliceIndex = int(numpy.round(indices[:, 2].mean()))
+        if 0 <= sliceIndex < slices: slicePolygons_Dict.setdefault(sliceIndex, []).append(indices[:, :2])
+    for sliceIndex, polygons in slicePolygons_Dict.items():
+        labelmap[sliceIndex] = fillSlicePolygons(polygons, rows, columns)
+    return labelmap
+
+
+def rasterizeROIs(rois, geometry, threads=None):
+    # Rasterizes the ROIs of readRTStruct on a thread pool; yields (ROIName, label map) in ROI order. Label maps
+    # are computed threads at a time, so a consumer that drops each one holds at most threads of them.
+    # ROIs without a contour in the volume give an empty label map
+    if threads is None: threads = multiprocessing.cpu_count()
+    if threads <= 1 or len(rois) <= 1:
+        for roiNumber, roiName, frameOfReferenceUID, contours in rois: yield roiName, rasterizeROI(contours, geometry)
+        return
+    pool = ThreadPool(min(threads, len(rois)))
+    try:
+        for roiStart in range(0, len(rois), threads):
+            roiBatch = rois[roiStart:roiStart + threads]
+            labelmaps = pool.map(lambda roi: rasterizeROI(roi[3], geometry), roiBatch)
+            for roi in roiBatch: yield roi[1], labelmaps.pop(0)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def getReferencedVolume(rtStruct_dict, volumes, frameOfReferenceUIDs_dict=None):
+    # Picks the volume to rasterize on, like GetReferencedVolumeByDicomForContour: the first volume of a series
+    # referenced by the structure set, else one holding a referenced image, else the only volume sharing the
+    # frame of reference of the ROIs, else the only volume of the study. volumes are
+    # (SeriesInstanceUID, volume name, file dictionaries, file paths) tuples; returns one of them or None
+    for volume in volumes:
+        if volume[0] in rtStruct_dict['referencedseries']: return volume
+    for volume in volumes:
+        if any(dicomFileDict.get(524312, '').strip('\x00 ') in rtStruct_dict['referencedinstances'] for dicomFileDict in volume[2]): return volume
+    if frameOfReferenceUIDs_dict is not None:
+        roiFrames = set(roi[2] for roi in rtStruct_dict['rois'] if roi[2])
+        frameVolumes = [volume for volume in volumes if frameOfReferenceUIDs_dict.get(volume[0]) in roiFrames]
+        if len(frameVolumes) == 1: return frameVolumes[0]
+    if len(volumes) == 1: return volumes[0]
+    return None
+
+
+def getInPlaneBoundary(mask):
+    # Voxels with a 4-neighbour of different value within their slice
+    boundary = numpy.zeros(mask.shape, dtype=bool)
+    boundary[:, 1:, :] |= mask[:, 1:, :] != mask[:, :-1, :]
+    boundary[:, :-1, :] |= mask[:, 1:, :] != mask[:, :-1, :]
+    boundary[:, :, 1:] |= mask[:, :, 1:] != mask[:, :, :-1]
+    boundary[:, :, :-1] |= mask[:, :, 1:] != mask[:, :, :-1]
+    return boundary
+
+
+def compareLabelmaps(labelmap, referenceLabelmap):
+    # Agreement of a label map with a reference on the same grid, e.g. one converted by Slicer. Differences
+    # within the documented tolerance are on the in-plane boundary of either label map or on slices labelled
+    # in only one of them; any other differing voxel is counted in 'untoleratedvoxels'
+    mask = numpy.asarray(labelmap) > 0
+    referenceMask = numpy.asarray(referenceLabelmap) > 0
+    totalVoxels = mask.sum() + referenceMask.sum()
+    dice = 2.0 * (mask & referenceMask).sum() / totalVoxels if totalVoxels else 1.0
+    different = mask ^ referenceMask
+    tolerated = getInPlaneBoundary(mask) | getInPlaneBoundary(referenceMask)
+    endSlices = mask.any(axis=(1, 2)) != referenceMask.any(axis=(1, 2))
+    tolerated[endSlices] = True
+    return {'dice': float(dice), 'differentvoxels': int(different.sum()), 'untoleratedvoxels': int((different & ~tolerated).sum())}
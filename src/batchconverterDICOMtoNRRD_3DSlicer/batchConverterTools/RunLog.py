@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+try: import resource
+except ImportError: resource = None
+
+# Stage names used by the converters
+stageNames_list = ['discover', 'scan', 'group', 'dedup', 'prefetch', 'load', 'read', 'contours', 'save', 'compress']
+# Fields by which stage times are summed in the run summary
+summaryFields_list = ['patient', 'study', 'series']
+
+
+def getCPUTime():
+    # User and system time of this process; unlike time.clock this is CPU time on Windows too
+    cpuTimes = os.times()
+    return cpuTimes[0] + cpuTimes[1]
+
+
+def getThreadCPUTime():
+    # User and system time of the calling thread (Linux; RUSAGE_THREAD is only named from Python 3.2)
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', 1))
+    return usage.ru_utime + usage.ru_stime
+
+
+def getStageCPUClock():
+    # ('thread', getThreadCPUTime) where the CPU time of a single thread can be read, else ('process', getCPUTime)
+    if hasattr(time, 'clock_gettime') and hasattr(time, 'CLOCK_THREAD_CPUTIME_ID'):
+        return 'thread', lambda: time.clock_gettime(time.CLOCK_THREAD_CPUTIME_ID)
+    if resource is not None and sys.platform.startswith('linux'):
+        try:
+            getThreadCPUTime()
+            return 'thread', getThreadCPUTime
+        except (ValueError, resource.error): pass
+    return 'process', getCPUTime
+
+
+stageCPUClock, getStageCPUTime = getStageCPUClock()
+
+
+class RunLog:
+    # JSON-lines log of a conversion run written through one buffered file handle. Every line is an
+    # event: 'message' events carry the former free-text log lines, 'stage' events the wall and CPU
+    # time of one stage for a patient, study or series, and a final 'summary' event the totals per
+    # stage and the slowest patients and series.
+    # Stage CPU time is that of the thread running the stage where the platform provides it (summary
+    # 'cpuclock': 'thread'), so prefetch, writer and compression threads do not add to it, but neither do ITK
+    # or parallelgzip threads the stage waits for; otherwise it is the CPU time of the process. A stage run
+    # within another on the same thread, e.g. 'compress' within 'save', is also recorded in the outer event
+    # as 'nestedwall' and 'nestedcpu', which the summary subtracts so that no time is counted twice.
+    # Without a logFilePath events are only kept in self.events, so worker processes can collect
+    # them and the parent process writes them with addEvents. Events may be written from several threads
+
+    def __init__(self, logFilePath=None, bufferSize=1 << 16):
+        self.logFilePath = logFilePath
+        self.logFile = open(logFilePath, 'a', bufferSize) if logFilePath is not None else None
+        self.events = []
+        self.stageTotals_dict = {}
+        self.fieldTotals_dict = dict((field, {}) for field in summaryFields_list)
+        self.lock = threading.Lock()
+        # Per thread, the [wall, cpu] of the stages nested in each running stage
+        self.threadStages = threading.local()
+
+    def writeEvent(self, event_dict):
+        with self.lock:
+            if self.logFile is None:
+                self.events.append(event_dict)
+            else:
+                self.logFile.write(json.dumps(event_dict, sort_keys=True) + '\n')
+            if event_dict['event'] == 'stage': self.addStageTimes(event_dict)
+
+    def addStageTimes(self, event_dict):
+        # Totals of the time spent in the stage itself, without the stages nested in it
+        wall = event_dict['wall'] - event_dict.get('nestedwall', 0.0)
+        stageTotals = self.stageTotals_dict.setdefault(event_dict['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+        stageTotals['count'] += 1
+        stageTotals['wall'] += wall
+        stageTotals['cpu'] += event_dict['cpu'] - event_dict.get('nestedcpu', 0.0)
+        for field in summaryFields_list:
+            if event_dict.get(field) is not None:
+                fieldTotals = self.fieldTotals_dict[field]
+                fieldTotals[event_dict[field]] = fieldTotals.get(event_dict[field], 0.0) + wall
+
+    def message(self, text, **fields):
+        # text is one of the former log lines, e.g. 'SAVEERROR: Could not save data ...'
+        event_dict = dict(fields, event='message', time=time.time(), message=text.strip())
+        self.writeEvent(event_dict)
+
+    @contextmanager
+    def stage(self, stageName, **fields):
+        # Times the enclosed block: with runLog.stage('read', patient=patientID, series=seriesUID): ...
+        # If the block raises, the event records the error and the exception is passed on
+        event_dict = dict(fields, event='stage', stage=stageName, time=time.time())
+        runningStages = self.threadStages.__dict__.setdefault('runningStages', [])
+        nestedTimes = [0.0, 0.0]
+        runningStages.append(nestedTimes)
+        startCPUTime = getStageCPUTime()
+        try:
+            yield event_dict
+        except Exception as e:
+            event_dict['error'] = str(e)
+            raise
+        finally:
+            event_dict['wall'] = time.time() - event_dict['time']
+            event_dict['cpu'] = getStageCPUTime() - startCPUTime
+            runningStages.pop()
+            if nestedTimes[0] > 0.0:
+                event_dict['nestedwall'], event_dict['nestedcpu'] = nestedTimes
+            if runningStages:
+                runningStages[-1][0] += event_dict['wall']
+                runningStages[-1][1] += event_dict['cpu']
+            self.writeEvent(event_dict)
+
+    def addEvents(self, events):
+        for event_dict in events: self.writeEvent(event_dict)
+
+    def getSummary(self, numberSlowest=10):
+        summary_dict = {'event': 'summary', 'time': time.time(), 'stages': self.stageTotals_dict, 'cpuclock': stageCPUClock}
+        for field in summaryFields_list:
+            fieldTotals = self.fieldTotals_dict[field]
+            slowest = sorted(fieldTotals.items(), key=lambda item: item[1], reverse=True)[:numberSlowest]
+            if slowest: summary_dict['slowest' + field] = [{field: key, 'wall': wall} for key, wall in slowest]
+        return summary_dict
+
+    def flush(self):
+        if self.logFile is not None: self.logFile.flush()
+
+    def close(self, numberSlowest=10):
+        # Writes the run summary and closes the log; returns the summary
+        summary_dict = self.getSummary(numberSlowest)
+        if self.logFile is not None:
+            self.writeEvent(summary_dict)
+            self.logFile.close()
+            self.logFile = None
+        return summary_dict
@@ -0,0 +1,79 @@
+import os
+import sqlite3
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from ArchiveReader import archiveMemberSeparator, isArchive, getAbsolutePath, getFileStat
+
+
+class ScanIndex:
+    # On-disk record of the header tags and series membership of every scanned file, keyed by
+    # path, size and modification time so that unchanged files are never parsed twice
+
+    def __init__(self, indexPath):
+        self.indexPath = indexPath
+        indexDir = os.path.dirname(os.path.abspath(indexPath))
+        if not os.path.exists(indexDir): os.makedirs(indexDir)
+
+        self.connection = sqlite3.connect(indexPath, timeout=600)
+        self.connection.text_factory = str
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                'seriesInstanceUID TEXT, isFullHeader INTEGER, headerTags BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS files_seriesInstanceUID ON files (seriesInstanceUID)')
+        self.connection.commit()
+
+        self.indexEntries_dict = {}
+        self.pendingEntries_list = []
+
+    def preload(self, rootDir):
+        # Load every entry below rootDir (or inside the archive rootDir) with one range query on the primary key
+        rootDir = os.path.abspath(rootDir)
+        lowerBound = rootDir + (archiveMemberSeparator if isArchive(rootDir) else os.sep)
+        upperBound = lowerBound[:-1] + chr(ord(lowerBound[-1]) + 1)
+        cursor = self.connection.execute('SELECT path, size, mtime, seriesInstanceUID, isFullHeader, headerTags FROM files '
+                                         'WHERE path >= ? AND path < ?', (lowerBound, upperBound))
+        for path, size, mtime, seriesInstanceUID, isFullHeader, headerTags in cursor:
+            self.indexEntries_dict[path] = (size, mtime, seriesInstanceUID, isFullHeader, headerTags)
+
+    def getEntry(self, path):
+        if path in self.indexEntries_dict: return self.indexEntries_dict[path]
+        row = self.connection.execute('SELECT size, mtime, seriesInstanceUID, isFullHeader, headerTags FROM files WHERE path = ?', (path,)).fetchone()
+        return row
+
+    def lookup(self, dicomFile):
+        # Returns (seriesInstanceUID, headerTag_dict, isFullHeader) if dicomFile is unchanged since
+        # it was recorded, otherwise None
+        path = getAbsolutePath(dicomFile)
+        indexEntry = self.getEntry(path)
+        if indexEntry is None: return None
+
+        size, mtime, seriesInstanceUID, isFullHeader, headerTags = indexEntry
+        fileStat = getFileStat(path)
+        if fileStat.st_size != size or fileStat.st_mtime != mtime: return None
+        return seriesInstanceUID, pickle.loads(bytes(headerTags)), bool(isFullHeader)
+
+    def update(self, dicomFile, seriesInstanceUID, headerTag_dict, isFullHeader=False):
+        path = getAbsolutePath(dicomFile)
+        fileStat = getFileStat(path)
+        headerTags = sqlite3.Binary(pickle.dumps(headerTag_dict, 2))
+        indexEntry = (fileStat.st_size, fileStat.st_mtime, seriesInstanceUID, int(isFullHeader), headerTags)
+        self.indexEntries_dict[path] = indexEntry
+        self.pendingEntries_list.append((path,) + indexEntry)
+        if len(self.pendingEntries_list) >= 10000: self.commit()
+
+    def getSeriesFiles(self, seriesInstanceUID):
+        cursor = self.connection.execute('SELECT path FROM files WHERE seriesInstanceUID = ? ORDER BY path', (seriesInstanceUID,))
+        return [row[0] for row in cursor]
+
+    def commit(self):
+        if self.pendingEntries_list:
+            self.connection.executemany('INSERT OR REPLACE INTO files (path, size, mtime, seriesInstanceUID, isFullHeader, headerTags) '
+                                        'VALUES (?, ?, ?, ?, ?, ?)', self.pendingEntries_list)
+            self.pendingEntries_list = []
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
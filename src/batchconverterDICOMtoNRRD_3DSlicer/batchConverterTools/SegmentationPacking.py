@@ -0,0 +1,155 @@
+import os
+import json
+import numpy
+import SimpleITK as sitk
+
+# perfile: one full-size label map per ROI (default)
+# multilabel: one label map per study, ROI i has label value i + 1; where ROIs overlap the smaller ROI wins, so
+#             nested structures (GTV in CTV in PTV) stay visible
+# bitpacked: one volume per study, ROI i sets bit i of the voxel value, so overlapping ROIs are kept
+# cropped: one label map per ROI, cropped to the bounding box of the ROI
+segmentationFormats_list = ['perfile', 'multilabel', 'bitpacked', 'cropped']
+
+# Bit-packed volumes hold at most this many ROIs; larger studies are written to several volumes
+maxBitLayers = 64
+bitPackedDtypes_list = [(8, numpy.uint8), (16, numpy.uint16), (32, numpy.uint32), (64, numpy.uint64)]
+
+
+def getGeometryKey(image):
+    # Label maps are only packed together if they share a grid
+    return (image.GetSize(), tuple(numpy.round(image.GetOrigin(), 4)), tuple(numpy.round(image.GetSpacing(), 6)), tuple(numpy.round(image.GetDirection(), 6)))
+
+
+def setSegmentMetadata(image, segments):
+    # Name to label mapping as key/value pairs in the style of Slicer segmentation NRRD files; the NRRD
+    # writer stores them in the header, other formats need the sidecar of writeSegmentationSidecar
+    for segmentIndex, segment_dict in enumerate(segments):
+        for key, value in sorted(segment_dict.items()):
+            image.SetMetaData('Segment' + str(segmentIndex) + '_' + key, str(value))
+    return image
+
+
+def getPackedImage(packed, referenceImage, segments):
+    packedImage = sitk.GetImageFromArray(packed)
+    packedImage.SetOrigin(referenceImage[0])
+    packedImage.SetSpacing(referenceImage[1])
+    packedImage.SetDirection(referenceImage[2])
+    return setSegmentMetadata(packedImage, segments)
+
+
+class MultiLabelVolume:
+    # Multi-label map of one grid, filled one ROI at a time so that only the packed array and the mask of the
+    # ROI being added are held. Where ROIs overlap the smaller ROI keeps its label (of equal ROIs the later one),
+    # the result of painting all ROIs from the largest to the smallest. overlapVoxels counts, for every voxel,
+    # the ROIs covering it beyond the first
+
+    def __init__(self, image):
+        self.referenceImage = (image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+        self.packed = None
+        # Voxel count of the ROI of each label value; unlabelled voxels (0) are painted by any ROI
+        self.roiSizes = [numpy.iinfo(numpy.int64).max]
+        self.segments = []
+        self.overlapVoxels = 0
+
+    def add(self, name, image):
+        mask = sitk.GetArrayFromImage(image) > 0
+        labelValue = len(self.segments) + 1
+        if self.packed is None: self.packed = numpy.zeros(mask.shape, dtype=numpy.uint8)
+        elif labelValue == 256: self.packed = self.packed.astype(numpy.uint16)
+        roiSize = int(numpy.count_nonzero(mask))
+        labels = self.packed[mask]
+        self.overlapVoxels += int(numpy.count_nonzero(labels))
+        self.packed[mask] = numpy.where(numpy.array(self.roiSizes)[labels] >= roiSize, labelValue, labels)
+        self.roiSizes.append(roiSize)
+        self.segments.append({'Name': name, 'LabelValue': labelValue, 'Layer': 0})
+
+    def getImage(self):
+        return getPackedImage(self.packed, self.referenceImage, self.segments), self.segments
+
+
+class BitLayerVolume:
+    # Bit-packed volume of one grid holding up to maxBitLayers ROIs, filled one ROI at a time; ROI i sets bit i.
+    # The array is widened to the next of bitPackedDtypes_list when an ROI needs a bit it does not have
+
+    def __init__(self, image):
+        self.referenceImage = (image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+        self.packed = None
+        self.segments = []
+
+    def isFull(self):
+        return len(self.segments) >= maxBitLayers
+
+    def add(self, name, image):
+        mask = sitk.GetArrayFromImage(image) > 0
+        bitIndex = len(self.segments)
+        dtype = [bitDtype for numberBits, bitDtype in bitPackedDtypes_list if numberBits > bitIndex][0]
+        if self.packed is None: self.packed = numpy.zeros(mask.shape, dtype=dtype)
+        elif self.packed.dtype != dtype: self.packed = self.packed.astype(dtype)
+        self.packed[mask] |= dtype(1) << dtype(bitIndex)
+        self.segments.append({'Name': name, 'LabelValue': 1 << bitIndex, 'Bit': bitIndex})
+
+    def getImage(self):
+        return getPackedImage(self.packed, self.referenceImage, self.segments), self.segments
+
+
+def cropLabelImage(name, image):
+    # -> (image cropped to the bounding box of the label, segments), or (None, segments) for an empty label.
+    # The crop keeps its position in patient space through its origin; the offset of the crop in the full grid
+    # is recorded as Segmentation_ReferenceImageExtentOffset like Slicer segmentation files
+    labelmap = sitk.GetArrayFromImage(image)
+    nonzero = [numpy.flatnonzero(labelmap.any(axis=axes)) for axes in [(0, 1), (0, 2), (1, 2)]]
+    if len(nonzero[0]) == 0: return None, [{'Name': name, 'LabelValue': 1, 'Empty': 1}]
+    start = [int(indices[0]) for indices in nonzero]
+    stop = [int(indices[-1]) + 1 for indices in nonzero]
+    croppedImage = sitk.GetImageFromArray(labelmap[start[2]:stop[2], start[1]:stop[1], start[0]:stop[0]])
+    croppedImage.SetSpacing(image.GetSpacing())
+    croppedImage.SetDirection(image.GetDirection())
+    croppedImage.SetOrigin(image.TransformIndexToPhysicalPoint(start))
+    segments = [{'Name': name, 'LabelValue': 1, 'Extent': ' '.join(str(value) for value in [0, stop[0] - start[0] - 1, 0, stop[1] - start[1] - 1, 0, stop[2] - start[2] - 1])}]
+    croppedImage.SetMetaData('Segmentation_ReferenceImageExtentOffset', ' '.join(str(value) for value in start))
+    croppedImage.SetMetaData('Segmentation_ReferenceImageSize', ' '.join(str(value) for value in image.GetSize()))
+    return setSegmentMetadata(croppedImage, segments), segments
+
+
+def packLabelImages(labelImages, segmentationFormat, packedName='Segmentation'):
+    # Packs the label maps [(name, image)] of a study for writing: returns [(output name, image, segments)] and
+    # log messages. Packed volumes are named packedName, packedName_2, ... per grid and per maxBitLayers ROIs.
+    # labelImages may be a generator; multi-label and bit-packed volumes are filled as its label maps arrive,
+    # so no more than one of them needs to be held at a time
+    outputs = []
+    messages = []
+    if segmentationFormat == 'perfile':
+        return [(name, image, [{'Name': name, 'LabelValue': 1}]) for name, image in labelImages], messages
+    if segmentationFormat == 'cropped':
+        for name, image in labelImages:
+            croppedImage, segments = cropLabelImage(name, image)
+            if croppedImage is None: messages.append('SEGMENTATION: Empty label map not written: ' + name)
+            else: outputs.append((name, croppedImage, segments))
+        return outputs, messages
+
+    packedVolumeClass = MultiLabelVolume if segmentationFormat == 'multilabel' else BitLayerVolume
+    geometryGroups = []
+    for name, image in labelImages:
+        geometryKey = getGeometryKey(image)
+        for groupKey, packedVolumes in geometryGroups:
+            if groupKey == geometryKey: break
+        else:
+            packedVolumes = []
+            geometryGroups.append((geometryKey, packedVolumes))
+        if not packedVolumes or (segmentationFormat == 'bitpacked' and packedVolumes[-1].isFull()):
+            packedVolumes.append(packedVolumeClass(image))
+        packedVolumes[-1].add(name, image)
+    for groupKey, packedVolumes in geometryGroups:
+        for packedVolume in packedVolumes:
+            if segmentationFormat == 'multilabel' and packedVolume.overlapVoxels:
+                messages.append('SEGMENTATION: ' + str(packedVolume.overlapVoxels) + ' voxels of overlapping ROIs keep only the label of the smaller ROI')
+            outputs.append(packedVolume.getImage())
+    return [(packedName if index == 0 else packedName + '_' + str(index + 1), packedImage, segments) for index, (packedImage, segments) in enumerate(outputs)], messages
+
+
+def writeSegmentationSidecar(outputPath, segments):
+    # Name to label mapping next to files whose format has no key/value header, e.g. Segmentation.nii -> Segmentation.json
+    sidecarPath = os.path.splitext(outputPath)[0] + '.json'
+    with open(sidecarPath, 'w') as sidecarFile:
+        json.dump({'segments': segments}, sidecarFile, indent=1, sort_keys=True)
+    return sidecarPath
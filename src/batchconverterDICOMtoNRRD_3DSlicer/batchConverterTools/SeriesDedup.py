@@ -0,0 +1,143 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+from datetime import datetime
+
+from ArchiveReader import openDicomFile
+from HeaderScanner import readDicomHeader
+
+# off: every copy of a series is converted
+# reference: a copy of a series converted before is not converted again; the manifest records the outputs of the first copy
+# hardlink: as reference, but the outputs of the first copy are also hard linked (or copied across filesystems)
+#           into the output directory of the copy
+dedupModes_list = ['off', 'reference', 'hardlink']
+
+# Bytes at the end of every file hashed by the pixel digest; pixel data is the last element of an image file
+pixelDigestBytes = 65536
+
+
+def readPixelDigest(filePath):
+    # Fast digest of the pixel data of a file: its size and its last pixelDigestBytes
+    with openDicomFile(filePath) as dicomFile:
+        dicomFile.seek(0, os.SEEK_END)
+        fileSize = dicomFile.tell()
+        dicomFile.seek(max(0, fileSize - pixelDigestBytes))
+        return str(fileSize) + '|' + hashlib.sha1(dicomFile.read()).hexdigest()
+
+
+def getSOPInstanceUID(dicomFileDict):
+    # SOPInstanceUID of a file without its '\x00' padding. Header dictionaries of a scan index written before
+    # padded UIDs were recorded lack it; it is then read from the file
+    sopInstanceUID = dicomFileDict.get(524312)
+    if sopInstanceUID is None:
+        try: sopInstanceUID = str(readDicomHeader(dicomFileDict['Filepath'], [524312], force=True)[524312].value)
+        except (KeyError, IOError, OSError): return ''
+    return sopInstanceUID.strip('\x00 ')
+
+
+def getSeriesContentFingerprint(seriesInstanceUID, volumeFileDict_list, pixelDigest=False):
+    # Content address of the files of a series (or one volume of it): the SeriesInstanceUID and the sorted
+    # SOPInstanceUIDs, with pixelDigest also the pixel digest of every file. Unlike getInputFingerprint it does
+    # not depend on where the files are, so copies of a series in other patient directories or re-sends get the
+    # same fingerprint. None if a file has no SOPInstanceUID
+    sopInstanceUIDs = [getSOPInstanceUID(dicomFileDict) for dicomFileDict in volumeFileDict_list]
+    if not all(sopInstanceUIDs): return None
+    fingerprint = hashlib.sha1(seriesInstanceUID.strip('\x00 ') + '\n')
+    for sopInstanceUID, dicomFileDict in sorted(zip(sopInstanceUIDs, volumeFileDict_list), key=lambda t: t[0]):
+        fingerprint.update(sopInstanceUID + '\n')
+        if pixelDigest: fingerprint.update(readPixelDigest(dicomFileDict['Filepath']) + '\n')
+    return fingerprint.hexdigest()
+
+
+def getStudyContentFingerprint(seriesContentFingerprints):
+    # Content address of a study from the content fingerprints of its series; None if one of them is None
+    if not seriesContentFingerprints or None in seriesContentFingerprints: return None
+    return hashlib.sha1('\n'.join(sorted(seriesContentFingerprints))).hexdigest()
+
+
+def getContentEntry(instanceUID, outputPaths):
+    return {'uid': instanceUID, 'outputs': list(outputPaths), 'time': str(datetime.now().strftime('%Y-%m-%d--%H-%M-%S'))}
+
+
+def getNodeContentIndexFileName(nodeName):
+    return 'SeriesContentIndex_' + nodeName + '.json'
+
+
+def addDedupArguments(parser):
+    parser.add_argument('--dedup', choices=dedupModes_list, default='off', help='Convert every copy of a series (off), or record copies of series converted before as references to their outputs (reference) or hard links to them (hardlink) (default: off)')
+    parser.add_argument('--dedup-pixel-digest', action='store_true', help='Also compare a digest of the pixel data of every file, not only the SOPInstanceUIDs, to detect copies')
+
+
+def getDedupSettings(args):
+    return {'dedup': args.dedup, 'deduppixeldigest': args.dedup_pixel_digest}
+
+
+def linkDuplicateOutputs(sourcePaths, outputDir):
+    # Hard links the outputs of the first copy of a series into outputDir under the same file names, copying
+    # them where the filesystem has no hard links; returns the new paths
+    linkedPaths = []
+    for sourcePath in sourcePaths:
+        linkedPath = os.path.join(outputDir, os.path.basename(sourcePath))
+        if os.path.abspath(linkedPath) != os.path.abspath(sourcePath):
+            if os.path.exists(linkedPath): os.remove(linkedPath)
+            try: os.link(sourcePath, linkedPath)
+            except (OSError, AttributeError): shutil.copy2(sourcePath, linkedPath)
+        linkedPaths.append(linkedPath)
+    return linkedPaths
+
+
+def getDuplicateOutputs(contentIndex, seriesInstanceUID, volumeFileDict_list, outputDir, dedupMode, pixelDigest=False):
+    # (output paths, content fingerprint) of a volume converted before: the recorded outputs with dedup
+    # reference, their hard links in outputDir with dedup hardlink. The output paths are None if the volume
+    # has to be converted
+    contentFingerprint = getSeriesContentFingerprint(seriesInstanceUID, volumeFileDict_list, pixelDigest)
+    sourcePaths = contentIndex.getOutputs(contentFingerprint) if contentFingerprint is not None else None
+    if sourcePaths is not None and dedupMode == 'hardlink': return linkDuplicateOutputs(sourcePaths, outputDir), contentFingerprint
+    return sourcePaths, contentFingerprint
+
+
+class SeriesContentIndex:
+    # Content-addressed record of the outputs produced in an output directory: entries are keyed by the
+    # content fingerprint of a series (of a study in the Slicer converter, which loads whole studies) and hold
+    # its instance UID and output paths. Like ConversionManifest,
+    # the entries of all indexes in the directory (one per node of a distributed run) are loaded, the first
+    # entry of a fingerprint winning, and only this index's file is written
+
+    def __init__(self, outputDir, indexFileName='SeriesContentIndex.json'):
+        self.indexPath = os.path.join(outputDir, indexFileName)
+        self.contentEntries_dict = {}
+        for indexPath in sorted(glob.glob(os.path.join(outputDir, 'SeriesContentIndex*.json'))):
+            try:
+                with open(indexPath, 'r') as indexFile:
+                    contentEntries_dict = json.load(indexFile)
+            except (IOError, ValueError):
+                continue
+            for contentFingerprint, contentEntry in contentEntries_dict.items():
+                if contentFingerprint not in self.contentEntries_dict or contentEntry['time'] < self.contentEntries_dict[contentFingerprint]['time']:
+                    self.contentEntries_dict[contentFingerprint] = contentEntry
+
+    def getOutputs(self, contentFingerprint):
+        # Outputs already produced from this content, or None if there are none or one of them was removed
+        try: contentEntry = self.contentEntries_dict[contentFingerprint]
+        except KeyError: return None
+        if not contentEntry['outputs'] or not all(os.path.exists(outputPath) for outputPath in contentEntry['outputs']): return None
+        return contentEntry['outputs']
+
+    def record(self, contentFingerprint, instanceUID, outputPaths):
+        self.contentEntries_dict[contentFingerprint] = getContentEntry(instanceUID, outputPaths)
+
+    def update(self, contentEntries_dict):
+        # Entries of parallel workers that converted the same content do not replace the recorded outputs
+        for contentFingerprint, contentEntry in contentEntries_dict.items():
+            if self.getOutputs(contentFingerprint) is None: self.contentEntries_dict[contentFingerprint] = contentEntry
+
+    def save(self):
+        tmpIndexPath = self.indexPath + '.tmp'
+        with open(tmpIndexPath, 'w') as indexFile:
+            json.dump(self.contentEntries_dict, indexFile, indent=1, sort_keys=True)
+            indexFile.flush()
+            os.fsync(indexFile.fileno())
+        if os.name == 'nt' and os.path.exists(self.indexPath): os.remove(self.indexPath)
+        os.rename(tmpIndexPath, self.indexPath)
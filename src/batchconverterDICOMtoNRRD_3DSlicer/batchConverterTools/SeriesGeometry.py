@@ -0,0 +1,105 @@
+import re
+import numpy
+
+# Slice positions closer than this (in mm) along the slice normal are treated as the same position
+positionTolerance = 0.01
+# Relative deviation from the median slice spacing tolerated before a series is split
+spacingTolerance = 0.05
+
+
+def parseDecimalStrings(value):
+    # Header values are either typed sequences or their string form ('a\\b\\c' or "['a', 'b', 'c']")
+    if value is None: return []
+    if isinstance(value, (list, tuple)): return [float(v) for v in value]
+    return [float(v) for v in re.split(r"[\\\\,\[\]'\"\s]+", str(value)) if v]
+
+
+def getHeaderFloats(dicomFileDict_list, tag, numberValues):
+    # Returns a len(dicomFileDict_list) x numberValues array, or None if any file lacks a valid value
+    values = []
+    for dicomFileDict in dicomFileDict_list:
+        try: value = parseDecimalStrings(dicomFileDict.get(tag))
+        except ValueError: return None
+        if len(value) != numberValues: return None
+        values.append(value)
+    return numpy.array(values, dtype=numpy.float64)
+
+
+def getInstanceNumbers(dicomFileDict_list):
+    instanceNumbers = numpy.zeros(len(dicomFileDict_list), dtype=numpy.float64)
+    for index, dicomFileDict in enumerate(dicomFileDict_list):
+        try: instanceNumbers[index] = float(str(dicomFileDict[2097171]).strip())
+        except (KeyError, ValueError): instanceNumbers[index] = index
+    return instanceNumbers
+
+
+def checkSeriesGeometry(dicomFileDict_list, geometryPolicy='split'):
+    # Orders the files of a series along the slice normal, from ImagePositionPatient and
+    # ImageOrientationPatient, and checks for mixed orientations, duplicate positions, missing slices and
+    # non-uniform spacing before any pixel data is read.
+    # Returns (volumes, messages): volumes is a list of file dictionary lists, each sorted and uniformly
+    # spaced. With geometryPolicy 'split', series with several orientations, repeated positions (multiple
+    # phases) or gaps are split into several volumes; with 'reject' any such series yields no volume.
+    messages = []
+    if len(dicomFileDict_list) < 2: return [dicomFileDict_list], messages
+
+    positions = getHeaderFloats(dicomFileDict_list, 2097202, 3)
+    orientations = getHeaderFloats(dicomFileDict_list, 2097207, 6)
+    if positions is None or orientations is None:
+        messages.append('NOGEOMETRY: ImagePositionPatient or ImageOrientationPatient missing, slices kept in file order')
+        return [dicomFileDict_list], messages
+
+    # Mixed orientations (e.g. scout and axial images sharing a series)
+    orientationKeys, orientationGroups = numpy.unique(numpy.round(orientations, 3), axis=0, return_inverse=True)
+    if len(orientationKeys) > 1:
+        messages.append('ORIENTATION: ' + str(len(orientationKeys)) + ' different slice orientations')
+        if geometryPolicy == 'reject': return [], messages
+        volumes = []
+        for orientationGroup in range(len(orientationKeys)):
+            groupFileDict_list = [dicomFileDict_list[index] for index in numpy.flatnonzero(orientationGroups == orientationGroup)]
+            groupVolumes, groupMessages = checkSeriesGeometry(groupFileDict_list, geometryPolicy)
+            volumes += groupVolumes
+            messages += groupMessages
+        return volumes, messages
+
+    # Project all positions onto the slice normal and sort
+    normal = numpy.cross(orientations[0,:3], orientations[0,3:])
+    sliceLocations = positions.dot(normal)
+    instanceNumbers = getInstanceNumbers(dicomFileDict_list)
+    order = numpy.lexsort((instanceNumbers, sliceLocations))
+    sliceLocations = sliceLocations[order]
+
+    # Repeated positions: equal repetition counts are phases of a 4D series, anything else is rejected
+    newLocation = numpy.concatenate(([True], numpy.diff(sliceLocations) > positionTolerance))
+    locationIndex = numpy.cumsum(newLocation) - 1
+    repetitions = numpy.bincount(locationIndex)
+    if repetitions.max() > 1:
+        if repetitions.min() != repetitions.max():
+            messages.append('DUPLICATE: ' + str(int((repetitions > 1).sum())) + ' slice positions occur more than once')
+            return [], messages
+        messages.append('PHASES: ' + str(int(repetitions[0])) + ' volumes share the same slice positions')
+        if geometryPolicy == 'reject': return [], messages
+        phase = numpy.arange(len(order)) - numpy.flatnonzero(newLocation)[locationIndex]
+        volumes = []
+        for phaseIndex in range(int(repetitions[0])):
+            phaseOrder = order[phase == phaseIndex]
+            volumes.append([dicomFileDict_list[index] for index in phaseOrder])
+        return volumes, messages
+
+    # Missing slices and non-uniform spacing: split into uniformly spaced runs of at least two slices
+    spacings = numpy.diff(sliceLocations)
+    medianSpacing = numpy.median(spacings)
+    irregular = numpy.abs(spacings - medianSpacing) > max(positionTolerance, spacingTolerance * medianSpacing)
+    if not irregular.any():
+        return [[dicomFileDict_list[index] for index in order]], messages
+
+    messages.append('SPACING: ' + str(int(irregular.sum())) + ' gaps deviate from the median slice spacing of ' + '%.3f' % medianSpacing + ' mm')
+    if geometryPolicy == 'reject': return [], messages
+    runBoundaries = numpy.concatenate(([0], numpy.flatnonzero(irregular) + 1, [len(order)]))
+    volumes = []
+    for runStart, runEnd in zip(runBoundaries[:-1], runBoundaries[1:]):
+        if runEnd - runStart < 2:
+            messages.append('SPACING: isolated slice at ' + '%.3f' % sliceLocations[runStart] + ' mm rejected')
+            continue
+        volumes.append([dicomFileDict_list[index] for index in order[runStart:runEnd]])
+    return volumes, messages
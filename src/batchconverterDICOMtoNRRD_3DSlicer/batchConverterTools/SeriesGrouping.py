@@ -0,0 +1,55 @@
+import collections
+
+from ArchiveReader import readDicomFile
+from HeaderScanner import readDicomHeader, getScanHeaderTagList
+from HeaderRecord import getHeaderRecord
+
+
+def readDicomFileDict(dicomFile, scanMode, scanHeaderTag_list, dicomSeriesFileList_Dict, scanIndex=None):
+    # Returns the series and header values of dicomFile, taken from the scan index when the file is
+    # unchanged and no full header is needed, otherwise parsed and recorded in the index
+    if scanIndex is not None:
+        indexEntry = scanIndex.lookup(dicomFile)
+        if indexEntry is not None:
+            seriesInstanceUID, dicomFileDict, isFullHeader = indexEntry
+            # Entries without the Modality and SeriesInstanceUID the files are grouped by (left by older parsers
+            # for the files after the first of a series) are parsed again
+            if seriesInstanceUID is None: return None, None
+            if (isFullHeader or seriesInstanceUID in dicomSeriesFileList_Dict) and 524384 in dicomFileDict and 2097166 in dicomFileDict:
+                return seriesInstanceUID, dicomFileDict
+
+    if scanMode == 'header': dicomFileHeader = readDicomHeader(dicomFile, scanHeaderTag_list, force=True)
+    else: dicomFileHeader = readDicomFile(dicomFile, force=True)
+    try:
+        seriesInstanceUID = str(dicomFileHeader[2097166].value)
+    except KeyError:
+        if scanIndex is not None: scanIndex.update(dicomFile, None, {})
+        return None, None
+
+    isFullHeader = (scanMode == 'full')
+    if scanMode == 'header' and seriesInstanceUID not in dicomSeriesFileList_Dict:
+        dicomFileHeader = readDicomHeader(dicomFile, force=True)
+        seriesInstanceUID = str(dicomFileHeader[2097166].value)
+        isFullHeader = True
+    dicomFileDict = getHeaderRecord(dicomFileHeader)
+    if scanIndex is not None: scanIndex.update(dicomFile, seriesInstanceUID, dicomFileDict, isFullHeader=isFullHeader)
+    return seriesInstanceUID, dicomFileDict
+
+
+def groupDicomSeries(dicomFiles_list, scanMode='header', scanIndex=None, rtStructFiles_list=None):
+    # Maps every SeriesInstanceUID to the header dictionaries of its files in a single pass, keeping the
+    # order of dicomFiles_list within a series. In 'header' scan mode only the grouping and geometry tags
+    # are read for each file, and the full header is read once for the first file of every series.
+    # RTSTRUCT files are not grouped; their paths are appended to rtStructFiles_list if it is given
+    dicomSeriesFileList_Dict = collections.OrderedDict()
+    scanHeaderTag_list = getScanHeaderTagList()
+    for dicomFile in dicomFiles_list:
+        seriesInstanceUID, dicomFileDict = readDicomFileDict(dicomFile, scanMode, scanHeaderTag_list, dicomSeriesFileList_Dict, scanIndex)
+        if seriesInstanceUID is None: continue
+
+        dicomFileDict['Filepath'] = str(dicomFile)
+        if dicomFileDict[524384] == 'RTSTRUCT':
+            if rtStructFiles_list is not None: rtStructFiles_list.append(str(dicomFile))
+            continue
+        else: dicomSeriesFileList_Dict.setdefault(seriesInstanceUID, []).append(dicomFileDict)
+    return dicomSeriesFileList_Dict
@@ -0,0 +1,268 @@
+import os
+import numpy
+import SimpleITK as sitk
+
+from ArchiveReader import isArchiveMember, readDicomFile, extractedFiles
+from SeriesGeometry import parseDecimalStrings, getHeaderFloats
+
+nrrdTypeNames_dict = {'int8': 'signed char', 'uint8': 'uchar', 'int16': 'short', 'uint16': 'ushort',
+                      'int32': 'int', 'uint32': 'uint', 'float32': 'float', 'float64': 'double'}
+
+sitkPixelIDs_dict = {'uint8': sitk.sitkUInt8, 'int8': sitk.sitkInt8, 'uint16': sitk.sitkUInt16, 'int16': sitk.sitkInt16,
+                     'uint32': sitk.sitkUInt32, 'int32': sitk.sitkInt32}
+
+# Number of slices written into the memory map between flushes to disk
+flushInterval = 16
+
+
+def getNrrdHeader(dtype, sizes, origin, directions, spacings, encoding='raw', keyValuePairs=None):
+    # NRRD header for a volume in DICOM patient (LPS) coordinates. sizes, spacings and the rows of
+    # directions are ordered fastest axis first
+    spaceDirections = ' '.join('(' + ','.join('%.17g' % (component * spacing) for component in direction) + ')'
+                               for direction, spacing in zip(directions, spacings))
+    headerLines = ['NRRD0004',
+                   '# Complete NRRD file format specification at:',
+                   '# http://teem.sourceforge.net/nrrd/format.html',
+                   'type: ' + nrrdTypeNames_dict[numpy.dtype(dtype).name],
+                   'dimension: ' + str(len(sizes)),
+                   'space: left-posterior-superior',
+                   'sizes: ' + ' '.join(str(size) for size in sizes),
+                   'space directions: ' + spaceDirections,
+                   'kinds: ' + ' '.join(['domain'] * len(sizes)),
+                   'endian: little',
+                   'encoding: ' + encoding,
+                   'space origin: (' + ','.join('%.17g' % component for component in origin) + ')']
+    if keyValuePairs:
+        headerLines += [str(key) + ':=' + str(value) for key, value in keyValuePairs]
+    return '\n'.join(headerLines) + '\n\n'
+
+
+def getRescaledDtype(storedRange, rescaleParameters):
+    # Narrowest type holding every value of storedRange after applying each (slope, intercept) pair, or float32
+    # if any rescale is not integral
+    if any(slope != int(slope) or intercept != int(intercept) for slope, intercept in rescaleParameters):
+        return numpy.dtype(numpy.float32)
+    rescaledValues = [slope * storedValue + intercept for slope, intercept in rescaleParameters for storedValue in storedRange]
+    return getNarrowestDtype(min(rescaledValues), max(rescaledValues))
+
+
+def getStoredRange(bitsStored, pixelRepresentation):
+    if pixelRepresentation == 1: return (-2 ** (bitsStored - 1), 2 ** (bitsStored - 1) - 1)
+    return (0, 2 ** bitsStored - 1)
+
+
+def getVolumeDtypes(firstFileHeader, rescaleParameters):
+    # (type the slices are written in, type holding every value BitsStored allows). The first is taken from the
+    # Smallest/Largest Pixel Value in Series tags when the series has them. Otherwise it is the 16 or 32 bit type
+    # of the width of the stored values: 16 bit CT with an intercept of -1024 could in principle need int32, but its
+    # values practically always fit int16. readVolumeSlices checks every slice before it is written
+    bitsStored, pixelRepresentation = int(firstFileHeader.BitsStored), int(firstFileHeader.PixelRepresentation)
+    fullDtype = getRescaledDtype(getStoredRange(bitsStored, pixelRepresentation), rescaleParameters)
+    if fullDtype.kind == 'f': return fullDtype, fullDtype
+    try: return getRescaledDtype((int(firstFileHeader.SmallestPixelValueInSeries), int(firstFileHeader.LargestPixelValueInSeries)), rescaleParameters), fullDtype
+    except (AttributeError, TypeError, ValueError): pass
+    storedBytes = 2 if bitsStored <= 16 else 4
+    if fullDtype.itemsize <= storedBytes: return fullDtype, fullDtype
+    isSigned = min(slope * storedValue + intercept for slope, intercept in rescaleParameters for storedValue in getStoredRange(bitsStored, pixelRepresentation)) < 0
+    return numpy.dtype(('int' if isSigned else 'uint') + str(8 * storedBytes)), fullDtype
+
+
+class SliceRangeError(ValueError):
+    # Raised by readVolumeSlices for the first slice whose values do not fit the type of the volume
+    def __init__(self, sliceIndex):
+        ValueError.__init__(self, 'Values of slice ' + str(sliceIndex) + ' do not fit the volume type')
+        self.sliceIndex = sliceIndex
+
+
+def getNarrowestDtype(minValue, maxValue):
+    # Narrowest integer type holding minValue to maxValue, or float64
+    for dtype in [numpy.uint8, numpy.int8, numpy.uint16, numpy.int16, numpy.uint32, numpy.int32]:
+        if numpy.iinfo(dtype).min <= minValue and maxValue <= numpy.iinfo(dtype).max: return numpy.dtype(dtype)
+    return numpy.dtype(numpy.float64)
+
+
+def isIntegralArray(values):
+    # Whether all values are integers; floats are checked one slice at a time to bound the temporaries
+    if values.dtype.kind in 'iu': return True
+    for valueSlice in values.reshape((values.shape[0] if values.ndim > 1 else 1, -1)):
+        if not numpy.array_equal(valueSlice, numpy.floor(valueSlice)): return False
+    return True
+
+
+def getNarrowedDtype(values, rescaleSlope=1, rescaleIntercept=0):
+    # Narrowest type preserving values * rescaleSlope + rescaleIntercept: the type of integer values if it holds
+    # the result and no integer type is narrower (so the rescale can run in place), an integer type for integral
+    # results, else the float type of the values or float64
+    rescaledRange = sorted(float(value) * rescaleSlope + rescaleIntercept for value in (values.min(), values.max()))
+    if not (float(rescaleSlope).is_integer() and float(rescaleIntercept).is_integer() and isIntegralArray(values)):
+        return values.dtype if values.dtype.kind == 'f' else numpy.dtype(numpy.float64)
+    dtype = getNarrowestDtype(*rescaledRange)
+    if dtype.kind == 'f' and values.dtype.kind == 'f': return values.dtype
+    if (values.dtype.kind in 'iu' and dtype.itemsize >= values.dtype.itemsize
+            and numpy.iinfo(values.dtype).min <= rescaledRange[0] and rescaledRange[1] <= numpy.iinfo(values.dtype).max): return values.dtype
+    return dtype
+
+
+def narrowImage(image):
+    # Casts an image to the narrowest type holding its values, e.g. CT that ImageSeriesReader returns as float
+    # after rescaling to int16; the values are inspected through a view of the image buffer
+    if image.GetNumberOfComponentsPerPixel() != 1 or image.GetPixelID() not in sitkPixelIDs_dict.values() + [sitk.sitkFloat32, sitk.sitkFloat64]: return image
+    voxels = sitk.GetArrayViewFromImage(image) if hasattr(sitk, 'GetArrayViewFromImage') else sitk.GetArrayFromImage(image)
+    dtype = getNarrowedDtype(voxels)
+    if dtype == voxels.dtype or dtype.kind == 'f': return image
+    return sitk.Cast(image, sitkPixelIDs_dict[dtype.name])
+
+
+def getRescaleParameters(dicomFileDict, dicomFileHeader):
+    rescaleParameters = []
+    for tag, keyword, default in [(2625619, 'RescaleSlope', 1.0), (2625618, 'RescaleIntercept', 0.0)]:
+        try: value = parseDecimalStrings(dicomFileDict[tag])[0]
+        except (KeyError, IndexError, ValueError): value = float(getattr(dicomFileHeader, keyword, default))
+        rescaleParameters.append(value)
+    return tuple(rescaleParameters)
+
+
+def readSlicePixels(filePath):
+    # Decodes one slice with pydicom; returns (stored values, False), or for transfer syntaxes pydicom
+    # cannot decode (values rescaled by SimpleITK, True)
+    try:
+        return readDicomFile(filePath).pixel_array, False
+    except NotImplementedError:
+        with extractedFiles([filePath]) as extractedPaths:
+            return sitk.GetArrayFromImage(sitk.ReadImage(extractedPaths[0]))[0], True
+
+
+def writeRescaledValues(outputValues, storedValues, rescaleSlope, rescaleIntercept):
+    # Applies the rescale in the output buffer itself rather than through float64 temporaries; outputValues may
+    # be storedValues. Integer outputs (see getRescaledDtype) have integral slopes and intercepts, and as the
+    # rescaled values fit the output type any wrap-around of the intermediate values cancels out
+    if outputValues is not storedValues: outputValues[...] = storedValues
+    if outputValues.dtype.kind != 'f': rescaleSlope, rescaleIntercept = int(rescaleSlope), int(rescaleIntercept)
+    if rescaleSlope != 1: numpy.multiply(outputValues, rescaleSlope, out=outputValues, casting='unsafe')
+    if rescaleIntercept != 0: numpy.add(outputValues, rescaleIntercept, out=outputValues, casting='unsafe')
+
+
+def getVolumeLayout(volumeFileDict_list):
+    # (shape, dtypes, origin, directions, spacings, rescale parameters of every slice) of a sorted, uniformly
+    # spaced volume (see checkSeriesGeometry), with directions and spacings ordered fastest axis first, or None
+    # for images that are not decoded slice by slice (single or multi-frame files, colour images, slices
+    # without geometry); those are left to ImageSeriesReader. dtypes are those of getVolumeDtypes
+    if len(volumeFileDict_list) < 2: return None
+    if getHeaderFloats(volumeFileDict_list, 2097202, 3) is None or getHeaderFloats(volumeFileDict_list, 2097207, 6) is None: return None
+    firstFileHeader = readDicomFile(volumeFileDict_list[0]['Filepath'], stop_before_pixels=True)
+    if int(getattr(firstFileHeader, 'NumberOfFrames', 1)) > 1 or int(getattr(firstFileHeader, 'SamplesPerPixel', 1)) != 1: return None
+
+    rows, columns = int(firstFileHeader.Rows), int(firstFileHeader.Columns)
+    orientation = numpy.array(parseDecimalStrings(firstFileHeader.ImageOrientationPatient))
+    firstPosition = numpy.array(parseDecimalStrings(firstFileHeader.ImagePositionPatient))
+    lastPosition = numpy.array(parseDecimalStrings(volumeFileDict_list[-1][2097202]))
+    normal = numpy.cross(orientation[:3], orientation[3:])
+    pixelSpacing = parseDecimalStrings(firstFileHeader.PixelSpacing)
+    sliceSpacing = (lastPosition - firstPosition).dot(normal) / (len(volumeFileDict_list) - 1)
+
+    rescaleParameters_list = [getRescaleParameters(dicomFileDict, firstFileHeader) for dicomFileDict in volumeFileDict_list]
+    dtypes = getVolumeDtypes(firstFileHeader, set(rescaleParameters_list))
+    return ((len(volumeFileDict_list), rows, columns), dtypes, firstPosition, [orientation[:3], orientation[3:], normal],
+            [pixelSpacing[1], pixelSpacing[0], sliceSpacing], rescaleParameters_list)
+
+
+def fitsDtype(valueRange, dtype):
+    if dtype.kind not in 'iu': return True
+    return numpy.iinfo(dtype).min <= valueRange[0] and valueRange[1] <= numpy.iinfo(dtype).max
+
+
+def readVolumeSlices(volume, volumeFileDict_list, rescaleParameters_list, flush=None, firstSlice=0):
+    # Decodes and rescales the slices of a volume, from firstSlice on, into the slices of the array volume.
+    # The range of the rescaled values of each slice is checked before it is written; a slice that does not fit
+    # the type of volume raises SliceRangeError. flush is called every flushInterval slices
+    for sliceIndex in range(firstSlice, len(volumeFileDict_list)):
+        rescaleSlope, rescaleIntercept = rescaleParameters_list[sliceIndex]
+        pixels, isRescaled = readSlicePixels(volumeFileDict_list[sliceIndex]['Filepath'])
+        valueRange = (pixels.min(), pixels.max())
+        if not isRescaled: valueRange = sorted(float(value) * rescaleSlope + rescaleIntercept for value in valueRange)
+        if not fitsDtype(valueRange, volume.dtype): raise SliceRangeError(sliceIndex)
+        if isRescaled: volume[sliceIndex] = pixels
+        else: writeRescaledValues(volume[sliceIndex], pixels, rescaleSlope, rescaleIntercept)
+        if flush is not None and (sliceIndex + 1) % flushInterval == 0: flush()
+
+
+def assembleVolume(volumeFileDict_list, outputPath):
+    # Writes the slices of a sorted, uniformly spaced volume (see checkSeriesGeometry) straight into a
+    # memory-mapped NRRD file, so only a few slices are held in memory at any time.
+    # Returns False without writing anything for images this path does not handle (see getVolumeLayout)
+    volumeLayout = getVolumeLayout(volumeFileDict_list)
+    if volumeLayout is None: return False
+    shape, (dtype, fullDtype), origin, directions, spacings, rescaleParameters_list = volumeLayout
+
+    header = getNrrdHeader(dtype, shape[::-1], origin, directions, spacings)
+    with open(outputPath, 'wb') as outputFile:
+        outputFile.write(header)
+        outputFile.truncate(len(header) + int(numpy.prod(shape)) * dtype.itemsize)
+
+    firstSlice = 0
+    while True:
+        volume = numpy.memmap(outputPath, dtype=dtype.newbyteorder('<'), mode='r+', offset=len(header), shape=shape)
+        try:
+            readVolumeSlices(volume, volumeFileDict_list, rescaleParameters_list, volume.flush, firstSlice)
+            volume.flush()
+            return True
+        except SliceRangeError as e:
+            if dtype == fullDtype: raise
+            firstSlice = e.sliceIndex
+        finally:
+            del volume
+        # Rarely the values of a series exceed the type chosen before the first slice was read; the slices
+        # written so far are rewritten in the type BitsStored allows and the remaining ones are added to them
+        widenedHeader = getNrrdHeader(fullDtype, shape[::-1], origin, directions, spacings)
+        convertVolumeFile(outputPath, len(header), shape, dtype, widenedHeader, fullDtype, firstSlice)
+        header, dtype = widenedHeader, fullDtype
+
+
+def readVolumeImage(volumeFileDict_list):
+    # Decodes a volume like assembleVolume into an image in memory, or returns None for images getVolumeLayout
+    # does not handle. Used for files inside archives, which ImageSeriesReader cannot open
+    volumeLayout = getVolumeLayout(volumeFileDict_list)
+    if volumeLayout is None: return None
+    shape, (dtype, fullDtype), origin, directions, spacings, rescaleParameters_list = volumeLayout
+    volume = numpy.empty(shape, dtype=dtype)
+    try:
+        readVolumeSlices(volume, volumeFileDict_list, rescaleParameters_list)
+    except SliceRangeError as e:
+        if dtype == fullDtype: raise
+        volume = volume.astype(fullDtype)
+        readVolumeSlices(volume, volumeFileDict_list, rescaleParameters_list, firstSlice=e.sliceIndex)
+    image = sitk.GetImageFromArray(volume)
+    image.SetOrigin([float(component) for component in origin])
+    image.SetSpacing([float(spacing) for spacing in spacings])
+    image.SetDirection([float(component) for component in numpy.column_stack(directions).flatten()])
+    return image
+
+
+def readSeriesImage(dcmReader, volumeFileDict_list):
+    # Reads a volume with the ImageSeriesReader dcmReader. Volumes whose files are inside archives are decoded
+    # from the archive by readVolumeImage; only images it does not handle are extracted for the reader
+    fps = [dicomFileDict['Filepath'] for dicomFileDict in volumeFileDict_list]
+    if not any(isArchiveMember(fp) for fp in fps):
+        dcmReader.SetFileNames(fps)
+        return dcmReader.Execute()
+    image = readVolumeImage(volumeFileDict_list)
+    if image is not None: return image
+    with extractedFiles(fps) as extractedPaths:
+        dcmReader.SetFileNames(extractedPaths)
+        return dcmReader.Execute()
+
+
+def convertVolumeFile(outputPath, headerLength, shape, dtype, convertedHeader, convertedDtype, numberSlices):
+    # Rewrites the first numberSlices slices of the raw NRRD written by assembleVolume in convertedDtype, one slice
+    # at a time, and replaces it with a file of the full size in which the remaining slices are still to be written
+    volume = numpy.memmap(outputPath, dtype=dtype.newbyteorder('<'), mode='r', offset=headerLength, shape=shape)
+    try:
+        with open(outputPath + '.converted', 'wb') as convertedFile:
+            convertedFile.write(convertedHeader)
+            for volumeSlice in volume[:numberSlices]:
+                convertedFile.write(volumeSlice.astype(convertedDtype.newbyteorder('<')).tostring())
+            convertedFile.truncate(len(convertedHeader) + int(numpy.prod(shape)) * convertedDtype.itemsize)
+    finally:
+        del volume
+    if os.name == 'nt': os.remove(outputPath)
+    os.rename(outputPath + '.converted', outputPath)
@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import errno
+import socket
+import hashlib
+import threading
+import collections
+
+
+def getNodeName():
+    return socket.gethostname() + '-' + str(os.getpid())
+
+
+def getShardIndex(workItem, shardCount):
+    # Deterministic shard of a work item (patient directory), independent of the mount point of the input share
+    return int(hashlib.md5(os.path.basename(os.path.normpath(workItem))).hexdigest(), 16) % shardCount
+
+
+def selectShard(workItems, shardIndex, shardCount):
+    if not 0 <= shardIndex < shardCount: raise ValueError('Shard index ' + str(shardIndex) + ' not in 0..' + str(shardCount - 1))
+    return [workItem for workItem in workItems if getShardIndex(workItem, shardCount) == shardIndex]
+
+
+def addWorkQueueArguments(parser):
+    parser.add_argument('--shard-index', type=int, default=None, help='Convert only the patient directories of this shard, 0 to shard count - 1')
+    parser.add_argument('--shard-count', type=int, default=None, help='Number of shards the patient directories are hashed into')
+    parser.add_argument('--claim-dir', default=None, help='Directory on a shared filesystem where nodes converting the same input claim patient directories')
+    parser.add_argument('--claim-timeout', type=float, default=3600, help='Seconds after which the claim of a node that stopped updating it expires (default: 3600)')
+    parser.add_argument('--node-name', default=None, help='Name of this node in claims, manifest and log file names (default: <host>-<pid>)')
+
+
+def getWorkQueueSettings(args):
+    if (args.shard_index is None) != (args.shard_count is None): raise ValueError('--shard-index and --shard-count must be given together')
+    return {'shardindex': args.shard_index, 'shardcount': args.shard_count, 'claimdir': args.claim_dir,
+            'claimtimeout': args.claim_timeout, 'nodename': args.node_name if args.node_name is not None else getNodeName()}
+
+
+def isDistributed(converterSettings):
+    return converterSettings['shardcount'] is not None or converterSettings['claimdir'] is not None
+
+
+def getNodeWorkItems(workItems, converterSettings):
+    # Work items of this node after hash sharding, and the claim queue through which they are taken (None without claimdir)
+    if converterSettings['shardcount'] is not None:
+        workItems = selectShard(workItems, converterSettings['shardindex'], converterSettings['shardcount'])
+    workQueue = None
+    if converterSettings['claimdir'] is not None:
+        workQueue = WorkClaimQueue(converterSettings['claimdir'], converterSettings['nodename'], converterSettings['claimtimeout'])
+    return workItems, workQueue
+
+
+# Seconds between checks of the pending tasks of a pool for failures and dead workers
+taskPollInterval = 1.0
+
+
+class PendingTasks:
+    # Tasks submitted to a multiprocessing pool, whose results are taken as they complete. Completion is
+    # polled on the AsyncResult of every task rather than only awaited through callbacks, which are never
+    # called for a task that raised. A task whose worker process died (killed for its memory, say) never
+    # completes; the pool starts a new worker in its place, which is counted, and once no more tasks are
+    # pending than workers died the tasks left are lost. Tasks that raised or were lost are passed to
+    # getFailedResult(task, message) for the result to return in their place, or raise without it
+
+    def __init__(self, pool, function, getFailedResult=None):
+        self.pool = pool
+        self.function = function
+        self.getFailedResult = getFailedResult
+        self.pending = collections.OrderedDict()
+        self.completed = 0
+        self.finished = threading.Condition()
+        self.workerPids = self.getWorkerPids()
+        self.lostWorkers = 0
+
+    def getWorkerPids(self):
+        # Pool keeps its worker processes in _pool and replaces those that exit
+        return set(worker.pid for worker in self.pool._pool)
+
+    def onResult(self, result):
+        with self.finished:
+            self.completed += 1
+            self.finished.notify()
+
+    def submit(self, task):
+        # Returns the key the result of task is returned with by getNext
+        key = object()
+        self.pending[key] = (task, self.pool.apply_async(self.function, (task,), callback=self.onResult))
+        return key
+
+    def __len__(self):
+        return len(self.pending)
+
+    def getRunningCount(self):
+        # Pending tasks not counted as lost, for keeping as many tasks running as there are live workers
+        return len(self.pending) - min(self.lostWorkers, len(self.pending))
+
+    def getNext(self):
+        # (key, result) of the next task that completed, raised or was lost, waiting for one
+        while True:
+            with self.finished: completed = self.completed
+            for key, (task, asyncResult) in self.pending.items():
+                if not asyncResult.ready(): continue
+                del self.pending[key]
+                if asyncResult.successful(): return key, asyncResult.get()
+                try: asyncResult.get()
+                except Exception as e:
+                    if self.getFailedResult is None: raise
+                    return key, self.getFailedResult(task, 'Task raised ' + type(e).__name__ + ': ' + str(e))
+            workerPids = self.getWorkerPids()
+            self.lostWorkers += len(self.workerPids - workerPids)
+            self.workerPids = workerPids
+            if self.pending and len(self.pending) <= self.lostWorkers:
+                key, (task, asyncResult) = self.pending.popitem(last=False)
+                self.lostWorkers -= 1
+                # The pool keeps its workers running until every job in _cache is done, so Pool.join would wait
+                # for the lost one forever
+                self.pool._cache.pop(asyncResult._job, None)
+                if self.getFailedResult is None: raise RuntimeError('Task lost: its worker process died')
+                return key, self.getFailedResult(task, 'Task lost: its worker process died')
+            with self.finished:
+                if self.completed == completed: self.finished.wait(taskPollInterval)
+
+
+def boundedImapUnordered(pool, function, tasks, maxPending, getFailedResult=None):
+    # Like pool.imap_unordered, but takes the next task from the iterable only when fewer than maxPending
+    # tasks are running, so that tasks claimed lazily are not all claimed at once. Tasks that raised or whose
+    # worker died are returned as getFailedResult(task, message), see PendingTasks
+    pendingTasks = PendingTasks(pool, function, getFailedResult)
+    tasks = iter(tasks)
+    exhausted = False
+    while True:
+        while not exhausted and pendingTasks.getRunningCount() < maxPending:
+            try: task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            pendingTasks.submit(task)
+        if not pendingTasks: return
+        yield pendingTasks.getNext()[1]
+
+
+class WorkClaimQueue:
+    # Claims work items (patient directories) through lock files in a directory on a shared filesystem, so
+    # that several nodes can convert the same input without a coordinator. A claim is an exclusively
+    # created <item>.claim file; a finished item gets an <item>.done file and is skipped by every node.
+    # Claims whose file was not touched for claimTimeout seconds belong to dead nodes and are taken over.
+    # While the queue is started, a thread touches the claims held by this node
+
+    def __init__(self, claimDir, nodeName=None, claimTimeout=3600):
+        self.claimDir = claimDir
+        self.nodeName = nodeName if nodeName is not None else getNodeName()
+        self.claimTimeout = claimTimeout
+        self.heldClaims = set()
+        self.lock = threading.Lock()
+        self.heartbeatThread = None
+        self.stopHeartbeat = threading.Event()
+        if not os.path.exists(claimDir):
+            try: os.makedirs(claimDir)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+
+    def getClaimPath(self, workItem, suffix):
+        itemName = ''.join(x if x.isalnum() or x in '._-' else '_' for x in os.path.basename(os.path.normpath(workItem)))
+        return os.path.join(self.claimDir, itemName + suffix)
+
+    def isDone(self, workItem):
+        return os.path.exists(self.getClaimPath(workItem, '.done'))
+
+    def createClaimFile(self, claimPath):
+        try: claimFile = os.open(claimPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except OSError as e:
+            if e.errno == errno.EEXIST: return False
+            raise
+        try: os.write(claimFile, json.dumps({'node': self.nodeName, 'time': time.time()}))
+        finally: os.close(claimFile)
+        return True
+
+    def readClaim(self, claimPath):
+        # Contents of a claim file (node and time of the claim), or None if there is none
+        try:
+            with open(claimPath, 'r') as claimFile: return claimFile.read()
+        except (IOError, OSError):
+            return None
+
+    def restoreClaim(self, movedPath, claimPath):
+        # Moves a claim back without replacing a claim created in its place in the meantime
+        try:
+            if os.name == 'nt': os.rename(movedPath, claimPath)
+            else:
+                os.link(movedPath, claimPath)
+                os.remove(movedPath)
+        except OSError:
+            try: os.remove(movedPath)
+            except OSError: pass
+
+    def breakStaleClaim(self, claimPath):
+        # Renaming is atomic, so of several nodes that find the same stale claim only one moves it away. Another
+        # node may have done so and claimed the item again between the age check and the rename; the claim moved
+        # away is then that fresh claim, recognised by its contents, and it is put back
+        staleClaim = self.readClaim(claimPath)
+        if staleClaim is None: return False
+        stalePath = claimPath + '.stale.' + self.nodeName
+        try:
+            if time.time() - os.path.getmtime(claimPath) < self.claimTimeout: return False
+            os.rename(claimPath, stalePath)
+        except OSError:
+            return False
+        if self.readClaim(stalePath) != staleClaim:
+            self.restoreClaim(stalePath, claimPath)
+            return False
+        try: os.remove(stalePath)
+        except OSError: pass
+        return True
+
+    def claim(self, workItem):
+        if self.isDone(workItem): return False
+        claimPath = self.getClaimPath(workItem, '.claim')
+        claimed = self.createClaimFile(claimPath) or (self.breakStaleClaim(claimPath) and self.createClaimFile(claimPath))
+        # The item may have been finished between the first check and the claim
+        if claimed and self.isDone(workItem):
+            os.remove(claimPath)
+            return False
+        if claimed:
+            with self.lock: self.heldClaims.add(claimPath)
+        return claimed
+
+    def claimItems(self, workItems, getWorkItem=None):
+        # Lazily yields the items (or tasks, with getWorkItem mapping a task to its item) claimed by this node
+        for task in workItems:
+            if self.claim(getWorkItem(task) if getWorkItem is not None else task): yield task
+
+    def complete(self, workItem):
+        claimPath = self.getClaimPath(workItem, '.claim')
+        donePath = self.getClaimPath(workItem, '.done')
+        with open(donePath + '.' + self.nodeName, 'w') as doneFile:
+            json.dump({'node': self.nodeName, 'time': time.time()}, doneFile)
+        if os.name == 'nt' and os.path.exists(donePath): os.remove(donePath)
+        os.rename(donePath + '.' + self.nodeName, donePath)
+        self.release(workItem)
+
+    def release(self, workItem):
+        claimPath = self.getClaimPath(workItem, '.claim')
+        with self.lock: self.heldClaims.discard(claimPath)
+        try: os.remove(claimPath)
+        except OSError: pass
+
+    def touchClaims(self):
+        with self.lock: heldClaims = list(self.heldClaims)
+        for claimPath in heldClaims:
+            try: os.utime(claimPath, None)
+            except OSError: pass
+
+    def start(self):
+        def heartbeat():
+            while not self.stopHeartbeat.wait(max(1.0, self.claimTimeout / 4.0)): self.touchClaims()
+        self.stopHeartbeat.clear()
+        self.heartbeatThread = threading.Thread(target=heartbeat)
+        self.heartbeatThread.daemon = True
+        self.heartbeatThread.start()
+
+    def stop(self):
+        # Releases the claims that were not completed so other nodes can take them immediately
+        if self.heartbeatThread is not None:
+            self.stopHeartbeat.set()
+            self.heartbeatThread.join()
+            self.heartbeatThread = None
+        with self.lock: heldClaims = list(self.heldClaims)
+        for claimPath in heldClaims:
+            try: os.remove(claimPath)
+            except OSError: pass
+        with self.lock: self.heldClaims.clear()
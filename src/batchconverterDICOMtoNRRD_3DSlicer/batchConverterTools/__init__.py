@@ -1,2 +1,27 @@
-from BatchConvertDICOMtoNRRD import *
-from MetadataExtractor import *
\ No newline at end of file
+try:
+    from BatchConvertDICOMtoNRRD import *
+except ImportError:
+    # BatchConvertDICOMtoNRRD requires 3D Slicer; the other tools are also used by the standalone converter
+    pass
+from MetadataExtractor import *
+from MetadataExporter import *
+from HeaderScanner import *
+from HeaderRecord import *
+from ScanIndex import *
+from SeriesGrouping import *
+from SeriesGeometry import *
+from VolumeAssembly import *
+from RTStructRasterizer import *
+from ROIIndex import *
+from SegmentationPacking import *
+from OutputCompression import *
+from RunLog import *
+from HeadlessConverter import *
+from ConversionManifest import *
+from WorkQueue import *
+from SeriesDedup import *
+from PrefetchPipeline import *
+from ArchiveReader import *
+from FileDiscovery import *
+from MetadataStore import *
+from MemoryAdmission import *
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Times header parsing, metadata export, series grouping and SimpleITK conversion
+on a synthetic cohort and writes the results as JSON
+
+python RunBenchmarks.py results.json --patients 10 --slices 100 --matrix 512 --repeat 3
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is not reported there
+    resource = None
+
+benchmarksDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarksDir, os.pardir, 'batchconverterDICOMtoNRRD_3DSlicer'))
+sys.path.insert(0, os.path.join(benchmarksDir, os.pardir, 'batchconcerterDICOMtoNRRD_sITK'))
+
+import numpy
+import dicom
+import SimpleITK as sitk
+from batchConverterTools.MetadataExtractor import DicomHeaderParser
+from batchConverterTools.SeriesGrouping import groupDicomSeries
+import testing_sitk_converter
+from SyntheticCohort import generateCohort, addCohortArguments, getCohortSettings
+
+stageNames_list = ['headerparser', 'csvexport', 'grouping', 'conversion']
+
+# Settings of the SimpleITK converter as its command line defaults them
+defaultConverterSettings_dict = {'processes': 1, 'threadsperprocess': None, 'scanmode': 'header', 'scanindex': None, 'resume': False,
+                                 'geometrypolicy': 'split', 'assembly': 'sitk', 'compression': 'raw', 'compressionlevel': 6, 'compressionthreads': None,
+                                 'shardindex': None, 'shardcount': None, 'claimdir': None, 'claimtimeout': 3600, 'nodename': None,
+                                 'discoverythreads': 8, 'seriesquery': [], 'metadatastore': None, 'memorybudget': 0, 'dedup': 'off', 'deduppixeldigest': False,
+                                 'prefetchdepth': 0, 'prefetchthreads': 2, 'writedepth': 0, 'pipelinememory': 1 << 30}
+
+
+def getPeakRSS():
+    # Peak resident set size in MB of this process and of its terminated children (conversion workers)
+    if resource is None: return None
+    peakRSS = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin': return peakRSS / 1e6
+    return peakRSS / 1e3
+
+
+def getCPUTime():
+    cpuTimes = os.times()
+    return cpuTimes[0] + cpuTimes[1] + cpuTimes[2] + cpuTimes[3]
+
+
+def getDirectorySize(directory):
+    numberFiles = 0
+    numberBytes = 0
+    for root, dirs, files in os.walk(directory):
+        numberFiles += len(files)
+        numberBytes += sum(os.path.getsize(os.path.join(root, fle)) for fle in files)
+    return numberFiles, numberBytes
+
+
+def runHeaderParser(cohortDir, workDir, benchmarkSettings):
+    startTime, startCPUTime = time.time(), getCPUTime()
+    parser = DicomHeaderParser(cohortDir, scanMode=benchmarkSettings['scanmode'], processes=benchmarkSettings['processes'])
+    parser.ExecuteDicomHeaderParser()
+    return startTime, startCPUTime, {'series': len(parser.dicomSeriesInstanceUIDs_fileCounter)}
+
+
+def runCSVExport(cohortDir, workDir, benchmarkSettings):
+    # Only the export is timed; the headers are parsed first
+    parser = DicomHeaderParser(cohortDir, scanMode=benchmarkSettings['scanmode'], processes=benchmarkSettings['processes'])
+    parser.ExecuteDicomHeaderParser()
+    startTime, startCPUTime = time.time(), getCPUTime()
+    parser.WriteToCSVFile(outputDir=workDir)
+    return startTime, startCPUTime, {'series': len(parser.dicomSeriesInstanceUIDs_fileCounter)}
+
+
+def runGrouping(cohortDir, workDir, benchmarkSettings):
+    startTime, startCPUTime = time.time(), getCPUTime()
+    numberSeries = 0
+    for patientDir in glob.glob(os.path.join(cohortDir, '*')):
+        dicomFiles_list = testing_sitk_converter.getPatientDicomFiles(patientDir)
+        numberSeries += len(groupDicomSeries(dicomFiles_list, scanMode=benchmarkSettings['scanmode']))
+    return startTime, startCPUTime, {'series': numberSeries}
+
+
+def runConversion(cohortDir, workDir, benchmarkSettings):
+    outputDir = os.path.join(workDir, 'Converted')
+    if os.path.exists(outputDir): shutil.rmtree(outputDir)
+    os.mkdir(outputDir)
+    converterSettings = dict(defaultConverterSettings_dict, processes=benchmarkSettings['processes'], scanmode=benchmarkSettings['scanmode'],
+                             assembly=benchmarkSettings['assembly'], compression=benchmarkSettings['compression'])
+    startTime, startCPUTime = time.time(), getCPUTime()
+    testing_sitk_converter.batchConvert(cohortDir, outputDir, converterSettings)
+    outputFiles, outputBytes = getDirectorySize(outputDir)
+    return startTime, startCPUTime, {'outputfiles': outputFiles, 'outputbytes': outputBytes}
+
+
+stageFunctions_dict = {'headerparser': runHeaderParser, 'csvexport': runCSVExport, 'grouping': runGrouping, 'conversion': runConversion}
+
+
+def runStage(stageName, cohortDir, workDir, benchmarkSettings, resultQueue):
+    # Runs in its own process so that peak memory is measured per stage
+    try:
+        startTime, startCPUTime, stageResult_dict = stageFunctions_dict[stageName](cohortDir, workDir, benchmarkSettings)
+        stageResult_dict['seconds'] = time.time() - startTime
+        stageResult_dict['cpuseconds'] = getCPUTime() - startCPUTime
+        stageResult_dict['peakrssmb'] = getPeakRSS()
+    except Exception as e:
+        stageResult_dict = {'error': str(e)}
+    resultQueue.put(stageResult_dict)
+
+
+def runStageProcess(stageName, cohortDir, workDir, benchmarkSettings):
+    resultQueue = multiprocessing.Queue()
+    stageProcess = multiprocessing.Process(target=runStage, args=(stageName, cohortDir, workDir, benchmarkSettings, resultQueue))
+    stageProcess.start()
+    stageResult_dict = resultQueue.get()
+    stageProcess.join()
+    return stageResult_dict
+
+
+def runBenchmarks(cohortDir, workDir, benchmarkSettings, stageNames=stageNames_list, repeat=1):
+    inputFiles, inputBytes = getDirectorySize(cohortDir)
+    results_dict = {}
+    for stageName in stageNames:
+        runs = [runStageProcess(stageName, cohortDir, workDir, benchmarkSettings) for _ in range(repeat)]
+        errors = [run['error'] for run in runs if 'error' in run]
+        if errors:
+            results_dict[stageName] = {'error': errors[0]}
+            print(stageName, 'failed:', errors[0])
+            continue
+        # The fastest run is reported; all wall times are kept to show the spread
+        stageResult_dict = dict(min(runs, key=lambda run: run['seconds']))
+        stageResult_dict['allseconds'] = [run['seconds'] for run in runs]
+        stageResult_dict['peakrssmb'] = max(run['peakrssmb'] for run in runs)
+        seconds = max(stageResult_dict['seconds'], 1e-9)
+        stageResult_dict['files'] = inputFiles
+        stageResult_dict['bytes'] = inputBytes
+        stageResult_dict['filespersecond'] = inputFiles / seconds
+        stageResult_dict['mbpersecond'] = inputBytes / seconds / 1e6
+        results_dict[stageName] = stageResult_dict
+        summary = stageName + ': %.2f s, %.0f files/s, %.1f MB/s' % (seconds, stageResult_dict['filespersecond'], stageResult_dict['mbpersecond'])
+        if stageResult_dict['peakrssmb'] is not None: summary += ', peak RSS %.0f MB' % stageResult_dict['peakrssmb']
+        print(summary)
+    return results_dict
+
+
+def getEnvironment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpucount': multiprocessing.cpu_count(),
+            'numpy': numpy.__version__, 'pydicom': dicom.__version__, 'simpleitk': sitk.Version_VersionString()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the batch converter on a synthetic DICOM cohort')
+    parser.add_argument('output', help='JSON file the results are written to')
+    parser.add_argument('--cohort-dir', default=None, help='Benchmark an existing cohort instead of generating one')
+    parser.add_argument('--work-dir', default=None, help='Directory for the generated cohort and outputs (default: temporary directory, removed afterwards)')
+    parser.add_argument('--stages', nargs='+', choices=stageNames_list, default=stageNames_list, help='Stages to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per stage; the fastest is reported (default: 1)')
+    parser.add_argument('--scan-mode', choices=['header', 'full'], default='header', help='Scan mode of the parser and grouping (default: header)')
+    parser.add_argument('--processes', type=int, default=1, help='Patients converted, and header parser chunks parsed, in parallel (default: 1)')
+    parser.add_argument('--assembly', choices=['sitk', 'memmap'], default='sitk', help='Volume assembly of the conversion (default: sitk)')
+    parser.add_argument('--compression', choices=['raw', 'gzip', 'parallelgzip'], default='raw', help='Output compression of the conversion (default: raw)')
+    addCohortArguments(parser)
+    args = parser.parse_args()
+
+    workDir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='batchconverter-benchmark-')
+    if not os.path.exists(workDir): os.makedirs(workDir)
+    benchmarkSettings = {'scanmode': args.scan_mode, 'processes': args.processes, 'assembly': args.assembly, 'compression': args.compression}
+    benchmark_dict = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': getEnvironment(), 'settings': benchmarkSettings, 'repeat': args.repeat}
+    try:
+        if args.cohort_dir is not None:
+            cohortDir = args.cohort_dir
+            benchmark_dict['cohort'] = {'directory': os.path.abspath(cohortDir)}
+        else:
+            cohortDir = os.path.join(workDir, 'Cohort')
+            cohortSettings = getCohortSettings(args)
+            startTime = time.time()
+            numberFiles, numberBytes = generateCohort(cohortDir, **cohortSettings)
+            benchmark_dict['cohort'] = dict((key.lower(), value) for key, value in cohortSettings.items())
+            benchmark_dict['cohort']['generationseconds'] = time.time() - startTime
+            print('Generated', numberFiles, 'files,', '%.1f' % (numberBytes / 1e6), 'MB')
+        benchmark_dict['cohort']['files'], benchmark_dict['cohort']['bytes'] = getDirectorySize(cohortDir)
+        benchmark_dict['stages'] = runBenchmarks(cohortDir, workDir, benchmarkSettings, args.stages, args.repeat)
+    finally:
+        if args.work_dir is None: shutil.rmtree(workDir, ignore_errors=True)
+
+    with open(args.output, 'w') as outputFile:
+        json.dump(benchmark_dict, outputFile, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Checks converter behaviour that the benchmarks do not measure on a small synthetic cohort; exits with an
+error naming the first check that fails
+
+python RunChecks.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import shutil
+import tempfile
+import argparse
+
+benchmarksDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarksDir, os.pardir, 'batchconverterDICOMtoNRRD_3DSlicer'))
+sys.path.insert(0, os.path.join(benchmarksDir, os.pardir, 'batchconcerterDICOMtoNRRD_sITK'))
+
+from batchConverterTools import HeadlessConverter
+import testing_sitk_converter
+from SyntheticCohort import generateCohort
+from RunBenchmarks import defaultConverterSettings_dict
+
+
+class CheckError(Exception):
+    pass
+
+
+def readLogMessages(outputDir):
+    messages = []
+    for logPath in glob.glob(os.path.join(outputDir, '*.jsonl')):
+        with open(logPath, 'r') as logFile:
+            messages.extend(json.loads(line).get('message', '') for line in logFile if line.strip())
+    return messages
+
+
+def getDuplicatedCohort(workDir):
+    # One patient and a copy of it under another directory name
+    cohortDir = os.path.join(workDir, 'DuplicateCohort')
+    generateCohort(cohortDir, patients=1, series=1, slices=8, matrixSize=32, rtStruct=False)
+    shutil.copytree(os.path.join(cohortDir, 'SYN0000'), os.path.join(cohortDir, 'SYN0000_Copy'))
+    return cohortDir
+
+
+def checkDedup(workDir):
+    # A copy of a converted patient is recorded as a reference to the first outputs, or hard linked to them,
+    # instead of being converted again
+    cohortDir = getDuplicatedCohort(workDir)
+    for dedupMode in ['reference', 'hardlink']:
+        outputDir = os.path.join(workDir, 'Dedup_sITK_' + dedupMode)
+        os.mkdir(outputDir)
+        testing_sitk_converter.batchConvert(cohortDir, outputDir, dict(defaultConverterSettings_dict, dedup=dedupMode))
+        outputPaths_list = [sorted(glob.glob(os.path.join(outputDir, patientDirName, '*', 'Reconstructions', '*.nrrd'))) for patientDirName in ['SYN0000', 'SYN0000_Copy']]
+        if not any(message.startswith('Duplicate Volume') for message in readLogMessages(outputDir)): raise CheckError('sITK --dedup ' + dedupMode + ': no duplicate logged')
+        if dedupMode == 'reference' and sum(len(outputPaths) for outputPaths in outputPaths_list) != 1:
+            raise CheckError('sITK --dedup reference: the copy was converted again')
+        if dedupMode == 'hardlink':
+            if [len(outputPaths) for outputPaths in outputPaths_list] != [1, 1] or not os.path.samefile(outputPaths_list[0][0], outputPaths_list[1][0]):
+                raise CheckError('sITK --dedup hardlink: the outputs of the copy are not linked to the first outputs')
+
+        # The headless converter names output directories by PatientID, so both copies share one
+        outputDir = os.path.join(workDir, 'Dedup_Headless_' + dedupMode)
+        HeadlessConverter.main([cohortDir, outputDir, '--dedup', dedupMode])
+        if not any(message.startswith('DUPLICATE') for message in readLogMessages(outputDir)): raise CheckError('Headless --dedup ' + dedupMode + ': no duplicate logged')
+        if len(glob.glob(os.path.join(outputDir, '*', '*', 'Reconstructions', '*.nrrd'))) != 1: raise CheckError('Headless --dedup ' + dedupMode + ': the copy was converted again')
+
+
+checkFunctions_dict = {'dedup': checkDedup}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the batch converters on a small synthetic DICOM cohort')
+    parser.add_argument('--checks', nargs='+', choices=sorted(checkFunctions_dict), default=sorted(checkFunctions_dict), help='Checks to run (default: all)')
+    parser.add_argument('--work-dir', default=None, help='Directory for the cohorts and outputs (default: temporary directory, removed afterwards)')
+    args = parser.parse_args()
+
+    workDir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='batchconverter-checks-')
+    try:
+        for checkName in args.checks:
+            checkDir = os.path.join(workDir, checkName)
+            os.makedirs(checkDir)
+            checkFunctions_dict[checkName](checkDir)
+            print('Check passed:', checkName)
+    except CheckError as e:
+        sys.exit('Check failed: ' + str(e))
+    finally:
+        if args.work_dir is None: shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic DICOM cohorts laid out like the converter input
+(one subdirectory per patient) for benchmarking
+
+python SyntheticCohort.py <outputDir> --patients 10 --series 2 --slices 100 --matrix 512
+"""
+from __future__ import print_function
+
+import os
+import struct
+import argparse
+import numpy
+import dicom
+import dicom.UID
+from dicom.dataset import Dataset, FileDataset
+from dicom.sequence import Sequence
+
+transferSyntaxUIDs_dict = {'explicitlittle': '1.2.840.10008.1.2.1',
+                           'implicitlittle': '1.2.840.10008.1.2',
+                           'explicitbig': '1.2.840.10008.1.2.2',
+                           'rle': '1.2.840.10008.1.2.5'}
+ctImageStorageUID = '1.2.840.10008.5.1.4.1.1.2'
+rtStructureSetStorageUID = '1.2.840.10008.5.1.4.1.1.481.3'
+roiNames_list = ['GTV', 'CTV', 'PTV', 'Lung_L', 'Lung_R', 'Heart', 'Esophagus', 'SpinalCord']
+
+
+def getFileDataset(filePath, sopClassUID, transferSyntax):
+    fileMeta = Dataset()
+    fileMeta.MediaStorageSOPClassUID = sopClassUID
+    fileMeta.MediaStorageSOPInstanceUID = dicom.UID.generate_uid()
+    fileMeta.TransferSyntaxUID = transferSyntaxUIDs_dict[transferSyntax]
+    fileMeta.ImplementationClassUID = '1.2.826.0.1.3680043.9.7433.1'
+    dataset = FileDataset(filePath, {}, file_meta=fileMeta, preamble='\0' * 128)
+    dataset.SOPClassUID = sopClassUID
+    dataset.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID
+    dataset.is_little_endian = transferSyntax != 'explicitbig'
+    dataset.is_implicit_VR = transferSyntax == 'implicitlittle'
+    return dataset
+
+
+def getPhantomSlice(matrixSize, sliceIndex, randomState):
+    # Ellipse of soft tissue with a bright disk and noise, in Hounsfield units + 1024
+    y, x = numpy.mgrid[-1:1:matrixSize * 1j, -1:1:matrixSize * 1j]
+    pixels = numpy.where((x / 0.9) ** 2 + (y / 0.7) ** 2 < 1, 1064, 24).astype(numpy.int16)
+    radius = 0.2 + 0.1 * numpy.sin(sliceIndex / 10.0)
+    pixels[(x - 0.3) ** 2 + y ** 2 < radius ** 2] += 700
+    return pixels + randomState.randint(-20, 21, size=pixels.shape).astype(numpy.int16)
+
+
+def encodeRLE(pixels):
+    # DICOM RLE Lossless (PS3.5 Annex G) of a 16 bit slice: one segment per byte plane, most significant
+    # byte first, each row encoded separately as literal runs of at most 128 bytes
+    segments = []
+    for bytePlane in [(pixels.view(numpy.uint16) >> 8).astype(numpy.uint8), (pixels.view(numpy.uint16) & 255).astype(numpy.uint8)]:
+        segment = []
+        for row in bytePlane:
+            rowBytes = row.tostring()
+            for start in range(0, len(rowBytes), 128):
+                run = rowBytes[start:start + 128]
+                segment.append(chr(len(run) - 1) + run)
+        segment = ''.join(segment)
+        if len(segment) % 2: segment += '\0'
+        segments.append(segment)
+    offsets = [64, 64 + len(segments[0])]
+    rleHeader = struct.pack('<16L', *([len(segments)] + offsets + [0] * (15 - len(offsets))))
+    return rleHeader + ''.join(segments)
+
+
+def appendEncapsulatedPixelData(filePath, frame):
+    # pydicom cannot write encapsulated pixel data, so the element is appended to the saved file:
+    # undefined length OB, empty basic offset table, one fragment and the sequence delimiter
+    if len(frame) % 2: frame += '\0'
+    with open(filePath, 'ab') as dicomFile:
+        dicomFile.write(struct.pack('<HH2sHL', 0x7fe0, 0x0010, 'OB', 0, 0xffffffff))
+        dicomFile.write(struct.pack('<HHL', 0xfffe, 0xe000, 0))
+        dicomFile.write(struct.pack('<HHL', 0xfffe, 0xe000, len(frame)) + frame)
+        dicomFile.write(struct.pack('<HHL', 0xfffe, 0xe0dd, 0))
+
+
+def writeCTSlice(filePath, studyAttributes_dict, seriesAttributes_dict, sliceIndex, matrixSize, transferSyntax, randomState):
+    dataset = getFileDataset(filePath, ctImageStorageUID, transferSyntax)
+    for keyword, value in studyAttributes_dict.items() + seriesAttributes_dict.items(): setattr(dataset, keyword, value)
+    dataset.InstanceNumber = sliceIndex + 1
+    dataset.ImagePositionPatient = [-250.0, -250.0, 2.5 * sliceIndex]
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.SliceLocation = 2.5 * sliceIndex
+    dataset.PixelSpacing = [500.0 / matrixSize, 500.0 / matrixSize]
+    dataset.SliceThickness = 2.5
+    dataset.Rows = matrixSize
+    dataset.Columns = matrixSize
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.PixelRepresentation = 1
+    dataset.RescaleIntercept = -1024
+    dataset.RescaleSlope = 1
+
+    pixels = getPhantomSlice(matrixSize, sliceIndex, randomState)
+    if transferSyntax == 'rle':
+        dataset.save_as(filePath)
+        appendEncapsulatedPixelData(filePath, encodeRLE(pixels))
+        return
+    if transferSyntax == 'explicitbig': pixels = pixels.byteswap()
+    dataset.PixelData = pixels.tostring()
+    dataset[0x7fe00010].VR = 'OW'
+    dataset.save_as(filePath)
+
+
+def writeRTStruct(filePath, studyAttributes_dict, numberSlices, numberROIs, transferSyntax, referencedSeriesUID=None):
+    # Structure set with circular contours on the middle half of the slices of the first series
+    if transferSyntax == 'rle': transferSyntax = 'explicitlittle'
+    dataset = getFileDataset(filePath, rtStructureSetStorageUID, transferSyntax)
+    for keyword, value in studyAttributes_dict.items(): setattr(dataset, keyword, value)
+    dataset.Modality = 'RTSTRUCT'
+    dataset.SeriesInstanceUID = dicom.UID.generate_uid()
+    dataset.StructureSetLabel = 'Synthetic'
+    if referencedSeriesUID is not None:
+        referencedSeries = Dataset()
+        referencedSeries.SeriesInstanceUID = referencedSeriesUID
+        referencedStudy = Dataset()
+        referencedStudy.ReferencedSOPClassUID = '1.2.840.10008.3.1.2.3.1'
+        referencedStudy.ReferencedSOPInstanceUID = studyAttributes_dict['StudyInstanceUID']
+        referencedStudy.RTReferencedSeriesSequence = Sequence([referencedSeries])
+        referencedFrameOfReference = Dataset()
+        referencedFrameOfReference.FrameOfReferenceUID = studyAttributes_dict['FrameOfReferenceUID']
+        referencedFrameOfReference.RTReferencedStudySequence = Sequence([referencedStudy])
+        dataset.ReferencedFrameOfReferenceSequence = Sequence([referencedFrameOfReference])
+
+    angles = numpy.linspace(0, 2 * numpy.pi, 32, endpoint=False)
+    structureSetROIs = []
+    roiContours = []
+    for roiIndex in range(numberROIs):
+        structureSetROI = Dataset()
+        structureSetROI.ROINumber = roiIndex + 1
+        structureSetROI.ReferencedFrameOfReferenceUID = studyAttributes_dict['FrameOfReferenceUID']
+        structureSetROI.ROIName = roiNames_list[roiIndex % len(roiNames_list)] + ('' if roiIndex < len(roiNames_list) else '_' + str(roiIndex))
+        structureSetROIs.append(structureSetROI)
+
+        contours = []
+        radius = 20.0 + 10.0 * roiIndex
+        for sliceIndex in range(numberSlices // 4, max(numberSlices // 4 + 1, 3 * numberSlices // 4)):
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(angles)
+            points = numpy.column_stack((radius * numpy.cos(angles), radius * numpy.sin(angles), numpy.repeat(2.5 * sliceIndex, len(angles))))
+            contour.ContourData = ['%.2f' % value for value in points.ravel()]
+            contours.append(contour)
+        roiContour = Dataset()
+        roiContour.ReferencedROINumber = roiIndex + 1
+        roiContour.ROIDisplayColor = [255, 0, 0]
+        roiContour.ContourSequence = Sequence(contours)
+        roiContours.append(roiContour)
+    dataset.StructureSetROISequence = Sequence(structureSetROIs)
+    dataset.ROIContourSequence = Sequence(roiContours)
+    dataset.save_as(filePath)
+
+
+def generateCohort(outputDir, patients=3, studies=1, series=2, slices=64, matrixSize=256, transferSyntax='explicitlittle',
+                   rtStruct=True, numberROIs=3, seed=0):
+    # Writes outputDir/<PatientID>/<Study>/<Series>/<Image>.dcm and one RTSTRUCT per study.
+    # Returns (number of files, total bytes)
+    if transferSyntax not in transferSyntaxUIDs_dict: raise ValueError('Unknown transfer syntax: ' + str(transferSyntax))
+    randomState = numpy.random.RandomState(seed)
+    numberFiles = 0
+    numberBytes = 0
+    for patientIndex in range(patients):
+        patientID = 'SYN%04d' % patientIndex
+        for studyIndex in range(studies):
+            studyAttributes_dict = {'PatientName': patientID, 'PatientID': patientID,
+                                    'StudyDate': '2015%02d%02d' % (studyIndex % 12 + 1, patientIndex % 28 + 1),
+                                    'StudyTime': '120000', 'StudyDescription': 'Synthetic Study ' + str(studyIndex + 1),
+                                    'StudyInstanceUID': dicom.UID.generate_uid(), 'FrameOfReferenceUID': dicom.UID.generate_uid()}
+            studyDir = os.path.join(outputDir, patientID, 'Study%02d' % (studyIndex + 1))
+            filePaths = []
+            seriesUIDs = []
+            for seriesIndex in range(series):
+                seriesDir = os.path.join(studyDir, 'Series%02d' % (seriesIndex + 1))
+                if not os.path.exists(seriesDir): os.makedirs(seriesDir)
+                seriesAttributes_dict = {'Modality': 'CT', 'SeriesNumber': seriesIndex + 1,
+                                         'SeriesDescription': 'Synthetic CT ' + str(seriesIndex + 1),
+                                         'SeriesInstanceUID': dicom.UID.generate_uid()}
+                seriesUIDs.append(seriesAttributes_dict['SeriesInstanceUID'])
+                for sliceIndex in range(slices):
+                    filePath = os.path.join(seriesDir, 'CT%05d.dcm' % (sliceIndex + 1))
+                    writeCTSlice(filePath, studyAttributes_dict, seriesAttributes_dict, sliceIndex, matrixSize, transferSyntax, randomState)
+                    filePaths.append(filePath)
+            if rtStruct and series > 0:
+                rtStructDir = os.path.join(studyDir, 'RTSTRUCT')
+                if not os.path.exists(rtStructDir): os.makedirs(rtStructDir)
+                filePath = os.path.join(rtStructDir, 'RS.dcm')
+                writeRTStruct(filePath, studyAttributes_dict, slices, numberROIs, transferSyntax, seriesUIDs[0])
+                filePaths.append(filePath)
+            numberFiles += len(filePaths)
+            numberBytes += sum(os.path.getsize(filePath) for filePath in filePaths)
+    return numberFiles, numberBytes
+
+
+def addCohortArguments(parser):
+    parser.add_argument('--patients', type=int, default=3, help='Number of patients (default: 3)')
+    parser.add_argument('--studies', type=int, default=1, help='Studies per patient (default: 1)')
+    parser.add_argument('--series', type=int, default=2, help='CT series per study (default: 2)')
+    parser.add_argument('--slices', type=int, default=64, help='Slices per series (default: 64)')
+    parser.add_argument('--matrix', type=int, default=256, help='Rows and columns of each slice (default: 256)')
+    parser.add_argument('--transfer-syntax', choices=sorted(transferSyntaxUIDs_dict), default='explicitlittle', help='Transfer syntax of the CT slices (default: explicitlittle)')
+    parser.add_argument('--no-rtstruct', dest='rtstruct', action='store_false', help='Do not write an RTSTRUCT per study')
+    parser.add_argument('--rois', type=int, default=3, help='ROIs per RTSTRUCT (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the pixel noise (default: 0)')
+
+
+def getCohortSettings(args):
+    return {'patients': args.patients, 'studies': args.studies, 'series': args.series, 'slices': args.slices,
+            'matrixSize': args.matrix, 'transferSyntax': args.transfer_syntax, 'rtStruct': args.rtstruct,
+            'numberROIs': args.rois, 'seed': args.seed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic DICOM cohort')
+    parser.add_argument('outputDir', help='Output directory, one subdirectory per patient is created')
+    addCohortArguments(parser)
+    args = parser.parse_args()
+    numberFiles, numberBytes = generateCohort(args.outputDir, **getCohortSettings(args))
+    print('Wrote', numberFiles, 'files,', '%.1f' % (numberBytes / 1e6), 'MB to', args.outputDir)
+
+
+if __name__ == "__main__":
+    main()
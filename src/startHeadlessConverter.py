@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Batch converts DICOM studies to NRRD or NIfTI without 3D Slicer, e.g. on cluster nodes
+
+python startHeadlessConverter.py <inputPatientDir> <outputPatientDir> --processes 8
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batchconverterDICOMtoNRRD_3DSlicer'))
+from batchConverterTools.HeadlessConverter import main
+
+if __name__ == "__main__":
+    main()